@@ -0,0 +1,102 @@
+""" Benchmark the vcf ingest of the native reader against pyVCF3 on a synthetic VEP annotated vcf file """
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from querynator.helper_functions import CsqSchema, open_vcf_reader
+
+CSQ_FIELDS = ["Allele", "Consequence", "IMPACT", "SYMBOL", "Gene", "Feature_type", "Feature", "BIOTYPE", "EXON"]
+CSQ_FIELDS += ["INTRON", "HGVSc", "HGVSp", "cDNA_position", "CDS_position", "Protein_position", "Amino_acids"]
+CSQ_FIELDS += ["Codons", "Existing_variation", "DISTANCE", "STRAND", "FLAGS", "VARIANT_CLASS", "CANONICAL"]
+CSQ_FIELDS += ["MANE_SELECT", "SIFT", "PolyPhen", "AF", "gnomAD_AF", "CLIN_SIG", "SOMATIC", "PHENO", "PUBMED"]
+
+
+def write_vcf(path, n_records, n_transcripts, seed=0):
+    """
+    Write a vcf file with VEP annotation and two sample columns
+
+    :param path: path of the vcf file
+    :type path: str
+    :param n_records: number of records
+    :type n_records: int
+    :param n_transcripts: number of CSQ entries per record
+    :type n_transcripts: int
+    :return: None
+    """
+    rng = random.Random(seed)
+    with open(path, "w") as f:
+        f.write("##fileformat=VCFv4.2\n")
+        f.write('##INFO=<ID=DP,Number=1,Type=Integer,Description="Total depth">\n')
+        f.write(
+            '##INFO=<ID=CSQ,Number=.,Type=String,Description="Consequence annotations from Ensembl VEP. '
+            f'Format: {"|".join(CSQ_FIELDS)}">\n'
+        )
+        f.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+        f.write('##FORMAT=<ID=AD,Number=R,Type=Integer,Description="Allelic depths">\n')
+        f.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tNORMAL\tTUMOR\n")
+        pos = 10000
+        for i in range(n_records):
+            pos += rng.randint(1, 3000)
+            ref, alt = rng.sample("ACGT", 2)
+            csq = ",".join(
+                "|".join(
+                    [alt, "missense_variant", "MODERATE", f"GENE{i % 500}", f"ENSG{i:011d}", "Transcript"]
+                    + [f"ENST{i:08d}{t}", "protein_coding", "3/10", "", f"ENST{i:08d}{t}:c.{t + 100}{ref}>{alt}"]
+                    + [f"ENSP{i:08d}{t}:p.Val{t + 33}Glu", "", "", "", "V/E", "gTg/gAg", "", "", "1", "", "SNV"]
+                    + ["YES" if t == 0 else "", "", "deleterious(0)", "probably_damaging(0.99)", "0.01", "0.02"]
+                    + ["", "", "", ""]
+                )
+                for t in range(n_transcripts)
+            )
+            f.write(
+                f"{1 + i * 22 // n_records}\t{pos}\t.\t{ref}\t{alt}\t50\tPASS\tDP=100;CSQ={csq}\t"
+                "GT:AD\t0/0:50,0\t0/1:30,20\n"
+            )
+
+
+def ingest(path, native):
+    """
+    Read the fields querynator uses from every record: position, alleles and the IMPACT of the CSQ entries
+
+    :param path: path of the vcf file
+    :type path: str
+    :param native: whether to use the native reader, else pyVCF3
+    :type native: bool
+    :return: number of records and runtime in seconds
+    :rtype: tuple
+    """
+    start = time.perf_counter()
+    with open_vcf_reader(path, native=native) as reader:
+        decode = CsqSchema.from_header(reader).decoder("IMPACT")
+        n_records = 0
+        for record in reader:
+            (record.CHROM, record.POS, record.REF, [str(alt) for alt in record.ALT])
+            [decode(csq) for csq in record.INFO["CSQ"]]
+            n_records += 1
+    return n_records, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--records", type=int, default=1000000, help="number of vcf records")
+    parser.add_argument("--transcripts", type=int, default=3, help="number of CSQ entries per record")
+    parser.add_argument("--vcf", help="benchmark this vcf file instead of a synthetic one")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = args.vcf
+        if path is None:
+            path = os.path.join(tmp_dir, "benchmark.vcf")
+            write_vcf(path, args.records, args.transcripts)
+        results = {name: ingest(path, native) for name, native in [("pyVCF3", False), ("native", True)]}
+
+    for name, (n_records, seconds) in results.items():
+        print(f"{name:>8}: {n_records} records in {seconds:.1f} s ({n_records / seconds:,.0f} records/s)")
+    print(f" speedup: {results['pyVCF3'][1] / results['native'][1]:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
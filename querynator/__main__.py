@@ -3,25 +3,46 @@
 import json
 import logging
 import os
-import random
 import shutil
 from collections import defaultdict
 from enum import Enum
 
 import click
 import vcf
-from vcf.parser import _Info as VcfInfo
 from vcf.parser import field_counts as vcf_field_counts
 
 import querynator
-from querynator.helper_functions import gunzip_compressed_files, gzipped
-from querynator.query_api import query_cgi, query_civic, vcf_file
+from querynator.helper_functions import (
+    TRANSCRIPT_MODES,
+    CsqSchema,
+    QuerynatorIds,
+    check_tabix_index,
+    fetch_vcf_regions,
+    get_unindexed_chromosomes,
+    open_vcf_reader,
+    open_vcf_writer,
+    parse_region,
+    read_bed_regions,
+)
+from querynator.query_api import (
+    CIVIC_CACHE_MODES,
+    CIVIC_MATCH_MODES,
+    CIVIC_RESULT_CACHE_SIZE,
+    compile_civic_snapshot,
+    load_civic_cache,
+    query_cgi,
+    query_civic,
+    resolve_civic_fields,
+    vcf_file,
+)
 from querynator.report_scripts import (
     add_tiers_and_scores_to_df,
     combine_cgi,
     combine_cgi_civic,
     combine_civic,
     create_report_htmls,
+    get_civic_results_path,
+    read_shared_vep_table,
 )
 
 # Create logger
@@ -94,14 +115,40 @@ def Cancer():
     return Cancer_enum
 
 
-def filter_vcf_by_vep(vcf_path, logger):
+def passes_vep_filter(record, csq_schema):
     """
-    Function to filter given vcf to remove synonymous and low impact variants based on VEP annotation
+    Check whether a variant passes the VEP filter, i.e. not all of its VEP annotations are low impact synonymous variants
+
+    :param record: vcf record as returned by open_vcf_reader
+    :type record: VcfRecord or vcf.model._Record
+    :param csq_schema: CSQ schema of the vcf file
+    :type csq_schema: CsqSchema
+    :return: True if the variant is kept
+    :rtype: bool
+    """
+    decode = csq_schema.decoder("IMPACT", "Consequence")
+    return not all(decode(annotation) == ("LOW", "synonymous_variant") for annotation in record.INFO["CSQ"])
+
+
+def filter_vcf_by_vep(vcf_path, logger, filtered_path, removed_path, querynator_ids, regions=None):
+    """
+    Function to filter given vcf to remove synonymous and low impact variants based on VEP annotation.
+    The records are streamed: each record gets its querynator ID and is written to the filtered or the removed
+    vcf file as soon as it is read, so memory use does not depend on the size of the vcf file.
+    Both vcf files are complete once the returned generator is exhausted
 
     :param vcf_path: Variant Call Format (VCF) file (Version 4.2)
     :type vcf_path: str
-    :return: list of lists of pyVCF3 records (input file, removed, filtered)
-    :rtype: list
+    :param filtered_path: path of the vcf file of the kept variants
+    :type filtered_path: str
+    :param removed_path: path of the vcf file of the removed variants
+    :type removed_path: str
+    :param querynator_ids: querynator IDs of the run
+    :type querynator_ids: QuerynatorIds
+    :param regions: if given, only the records of these regions are read from the tabix-indexed vcf file
+    :type regions: list
+    :return: generator of the kept vcf records
+    :rtype: generator
 
     """
 
@@ -109,143 +156,114 @@ def filter_vcf_by_vep(vcf_path, logger):
         logger.error("Can only filter variants in vcf files.")
         exit(1)
 
-    if gzipped(vcf_path):
-        vcf_path = gunzip_compressed_files(vcf_path, logger)
-
-    # read vcf file in pyVCF
-    in_vcf = vcf.Reader(open(vcf_path))
-
-    # creates dictionary with VEP info names as keys and index in list as columns
-    # Name must be VEPs default "CSQ"
-    if "CSQ" in in_vcf.infos:
-        logger.info("Filtering vcf file")
-
-        vep_dict = {name: pos for pos, name in enumerate(in_vcf.infos["CSQ"].desc.split(":")[1].strip().split("|"))}
-        """
-        Exemplary for nf-core/sarek (https://nf-co.re/sarek) output
-        {'Allele': 0,
-        'Consequence': 1,
-        'IMPACT': 2,
-        'SYMBOL': 3,
-        'Gene': 4,
-        'Feature_type': 5,
-        'Feature': 6,
-        'BIOTYPE': 7,
-        'EXON': 8,
-        'INTRON': 9,
-        'HGVSc': 10,
-        'HGVSp': 11,
-        'cDNA_position': 12,
-        'CDS_position': 13,
-        'Protein_position': 14,
-        'Amino_acids': 15,
-        'Codons': 16,
-        'Existing_variation': 17,
-        'DISTANCE': 18,
-        'STRAND': 19,
-        'FLAGS': 20,
-        'VARIANT_CLASS': 21,
-        'SYMBOL_SOURCE': 22,
-        'HGNC_ID': 23,
-        'CANONICAL': 24,
-        'MANE_SELECT': 25,
-        'MANE_PLUS_CLINICAL': 26,
-        'TSL': 27,
-        'APPRIS': 28,
-        'CCDS': 29,
-        'ENSP': 30,
-        'SWISSPROT': 31,
-        'TREMBL': 32,
-        'UNIPARC': 33,
-        'UNIPROT_ISOFORM': 34,
-        'GENE_PHENO': 35,
-        'SIFT': 36,
-        'PolyPhen': 37,
-        'DOMAINS': 38,
-        'miRNA': 39,
-        'AF': 40,
-        'AFR_AF': 41,
-        'AMR_AF': 42,
-        'EAS_AF': 43,
-        'EUR_AF': 44,
-        'SAS_AF': 45,
-        'AA_AF': 46,
-        'EA_AF': 47,
-        'gnomAD_AF': 48,
-        'gnomAD_AFR_AF': 49,
-        'gnomAD_AMR_AF': 50,
-        'gnomAD_ASJ_AF': 51,
-        'gnomAD_EAS_AF': 52,
-        'gnomAD_FIN_AF': 53,
-        'gnomAD_NFE_AF': 54,
-        'gnomAD_OTH_AF': 55,
-        'gnomAD_SAS_AF': 56,
-        'MAX_AF': 57,
-        'MAX_AF_POPS': 58,
-        'FREQS': 59,
-        'CLIN_SIG': 60,
-        'SOMATIC': 61,
-        'PHENO': 62,
-        'PUBMED': 63,
-        'MOTIF_NAME': 64,
-        'MOTIF_POS': 65,
-        'HIGH_INF_POS': 66,
-        'MOTIF_SCORE_CHANGE': 67,
-        'TRANSCRIPTION_FACTORS': 68}
-        """
-
-        to_remove = []
-        to_keep = []
-        for record in in_vcf:
-            if len(record.INFO["CSQ"]) > 1:
-                # filter out low impact & synonymous variants from variants with multiple vep annotations
-                if all(
-                    info_list[vep_dict["IMPACT"]] == "LOW"
-                    and info_list[vep_dict["Consequence"]] == "synonymous_variant"
-                    for info_list in [i.split("|") for i in record.INFO["CSQ"]]
-                ):
-                    to_remove.append(record)
-                else:
-                    to_keep.append(record)
-            else:
-                # filter out low impact & synonymous variants from variants with single vep annotations
-                if (
-                    record.INFO["CSQ"][0].split("|")[vep_dict["IMPACT"]] == "LOW"
-                    and record.INFO["CSQ"][0].split("|")[vep_dict["Consequence"]] == "synonymous_variant"
-                ):
-                    to_remove.append(record)
-                else:
-                    to_keep.append(record)
+    # read vcf file, compressed files are decompressed in-stream
+    in_vcf = open_vcf_reader(vcf_path)
 
-        return [in_vcf, to_keep, to_remove]
-
-    else:
+    # compiles the offsets of the VEP info names in the CSQ annotation
+    csq_schema = CsqSchema.from_header(in_vcf)
+    if csq_schema is None:
         logger.error("vcf file does not include required VEP INFO fields (key must be default 'CSQ')")
         exit(1)
+    missing_fields = [name for name in ["IMPACT", "Consequence"] if name not in csq_schema]
+    if missing_fields:
+        logger.error(f"VEP annotation is missing fields required for filtering: {', '.join(missing_fields)}")
+        exit(1)
 
-
-def write_vcf(vcf_template, vcf_record_list, out_name):
+    logger.info("Filtering vcf file")
     """
-    Function to write a vcf file from list of pyvcf3 records to result directory
-
-    :param vcf_header: pysam header object from input vcf
-    :type vcf_header: pysam header object
-    :param vcf_record_list: list of pysam records
-    :type vcf_record_list: list
-    :param out_name: name for the created vcf file
-    :type out_name: str
-    :return: None
-    :rtype: None
+    Offsets of the CSQ fields, exemplary for nf-core/sarek (https://nf-co.re/sarek) output
+    {'Allele': 0,
+    'Consequence': 1,
+    'IMPACT': 2,
+    'SYMBOL': 3,
+    'Gene': 4,
+    'Feature_type': 5,
+    'Feature': 6,
+    'BIOTYPE': 7,
+    'EXON': 8,
+    'INTRON': 9,
+    'HGVSc': 10,
+    'HGVSp': 11,
+    'cDNA_position': 12,
+    'CDS_position': 13,
+    'Protein_position': 14,
+    'Amino_acids': 15,
+    'Codons': 16,
+    'Existing_variation': 17,
+    'DISTANCE': 18,
+    'STRAND': 19,
+    'FLAGS': 20,
+    'VARIANT_CLASS': 21,
+    'SYMBOL_SOURCE': 22,
+    'HGNC_ID': 23,
+    'CANONICAL': 24,
+    'MANE_SELECT': 25,
+    'MANE_PLUS_CLINICAL': 26,
+    'TSL': 27,
+    'APPRIS': 28,
+    'CCDS': 29,
+    'ENSP': 30,
+    'SWISSPROT': 31,
+    'TREMBL': 32,
+    'UNIPARC': 33,
+    'UNIPROT_ISOFORM': 34,
+    'GENE_PHENO': 35,
+    'SIFT': 36,
+    'PolyPhen': 37,
+    'DOMAINS': 38,
+    'miRNA': 39,
+    'AF': 40,
+    'AFR_AF': 41,
+    'AMR_AF': 42,
+    'EAS_AF': 43,
+    'EUR_AF': 44,
+    'SAS_AF': 45,
+    'AA_AF': 46,
+    'EA_AF': 47,
+    'gnomAD_AF': 48,
+    'gnomAD_AFR_AF': 49,
+    'gnomAD_AMR_AF': 50,
+    'gnomAD_ASJ_AF': 51,
+    'gnomAD_EAS_AF': 52,
+    'gnomAD_FIN_AF': 53,
+    'gnomAD_NFE_AF': 54,
+    'gnomAD_OTH_AF': 55,
+    'gnomAD_SAS_AF': 56,
+    'MAX_AF': 57,
+    'MAX_AF_POPS': 58,
+    'FREQS': 59,
+    'CLIN_SIG': 60,
+    'SOMATIC': 61,
+    'PHENO': 62,
+    'PUBMED': 63,
+    'MOTIF_NAME': 64,
+    'MOTIF_POS': 65,
+    'HIGH_INF_POS': 66,
+    'MOTIF_SCORE_CHANGE': 67,
+    'TRANSCRIPTION_FACTORS': 68}
     """
 
     # add querynator_id info to header
-    vcf_template.infos["QID"] = VcfInfo("QID", ".", "String", "Querynator ID", ".", ".", ".")
-    writer = vcf.Writer(open(f"{out_name}", "w"), vcf_template, lineterminator="\n")
+    infos = [("QID", ".", "String", "Querynator ID")]
+
+    def route_records():
+        n_kept = n_removed = 0
+        with in_vcf, open(filtered_path, "w") as filtered_file, open(removed_path, "w") as removed_file:
+            filtered_writer = open_vcf_writer(filtered_file, in_vcf, infos)
+            removed_writer = open_vcf_writer(removed_file, in_vcf, infos)
+            for record in fetch_vcf_regions(in_vcf, regions) if regions is not None else in_vcf:
+                # add querynator_id to record
+                record.add_info("QID", querynator_ids.from_record(record))
+                if passes_vep_filter(record, csq_schema):
+                    n_kept += 1
+                    filtered_writer.write_record(record)
+                    yield record
+                else:
+                    n_removed += 1
+                    removed_writer.write_record(record)
+        logger.info(f"Kept {n_kept} variants, removed {n_removed} synonymous and low impact variants")
 
-    for record in vcf_record_list:
-        # add querynator_id to record
-        record.add_info("QID", random.randint(1000000, 9999999))
-        writer.write_record(record)
+    return route_records()
 
 
 def get_unique_querynator_dir(querynator_output):
@@ -267,6 +285,38 @@ def get_unique_querynator_dir(querynator_output):
     return querynator_output
 
 
+def get_regions(region, bed, vcf_path, logger):
+    """
+    Collect the regions given by --region and --bed and check that the vcf file is tabix-indexed
+
+    :param region: regions as chr:start-end
+    :type region: tuple
+    :param bed: path of a BED file
+    :type bed: str
+    :param vcf_path: vcf file to query
+    :type vcf_path: str
+    :return: chromosome, 0-based start and end of the regions, None if no region is given
+    :rtype: list
+    :raises click.UsageError: if a region or the BED file is malformed or the input is no vcf file
+    """
+    if not region and bed is None:
+        return None
+    if vcf_path is None or not vcf_file(vcf_path):
+        raise click.UsageError("--region and --bed can only be used with vcf files.")
+    try:
+        regions = [parse_region(i) for i in region]
+        if bed is not None:
+            regions.extend(read_bed_regions(bed))
+    except ValueError as err:
+        raise click.UsageError(str(err))
+    check_tabix_index(vcf_path, logger)
+    unindexed = get_unindexed_chromosomes(vcf_path, regions)
+    if unindexed:
+        logger.warning(f"{vcf_path} has no records on chromosome(s) {', '.join(unindexed)}, their regions are skipped")
+    logger.info(f"Restricting the query to {len(regions)} regions")
+    return regions
+
+
 def validate_evidence_filters(evidence_filters):
     """validate the evidence filters, given as key-value pairs
     :return: None
@@ -407,11 +457,35 @@ def querynator_cli():
     show_default=True,
     default=False,
 )
-def query_api_cgi(mutations, cnas, translocations, cancer, genome, token, email, outdir, filter_vep):
+@click.option(
+    "--scratch_dir",
+    help="Directory for the decompressed copies of gzipped input files uploaded to CGI, ideally local NVMe or tmpfs. "
+    "Defaults to the system's temporary directory, the copies are removed after the upload",
+    type=click.Path(exists=True, file_okay=False),
+    default=None,
+)
+@click.option(
+    "--region",
+    help="Only query variants overlapping this region (chr:start-end, 1-based, inclusive). Can be given several "
+    "times. Requires a tabix-indexed vcf file, only the index blocks of the regions are read",
+    type=click.STRING,
+    multiple=True,
+)
+@click.option(
+    "--bed",
+    help="Only query variants overlapping the regions of this BED file, e.g. a gene panel. "
+    "Requires a tabix-indexed vcf file, only the index blocks of the regions are read",
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+)
+def query_api_cgi(
+    mutations, cnas, translocations, cancer, genome, token, email, outdir, filter_vep, scratch_dir, region, bed
+):
     if mutations is None and cnas is None and translocations is None:
         raise click.UsageError(
             "No input file provided. Please provide at least one of [mutations/cnas/translocations] as input."
         )
+    regions = get_regions(region, bed, mutations, logger)
 
     try:
         result_dir = get_unique_querynator_dir(f"{outdir}")
@@ -419,21 +493,40 @@ def query_api_cgi(mutations, cnas, translocations, cancer, genome, token, email,
         original_input = {"mutations": mutations, "translocations": translocations, "cnas": cnas}
         # filter vcf file if required
         if mutations is not None and filter_vep:
-            in_vcf_header, candidate_variants, removed_variants = filter_vcf_by_vep(mutations, logger)
-
             # create result directories
             os.makedirs(f"{result_dir}/vcf_files")
-            write_vcf(in_vcf_header, removed_variants, f"{result_dir}/vcf_files/{basename}.removed_variants.vcf")
-            write_vcf(in_vcf_header, candidate_variants, f"{result_dir}/vcf_files/{basename}.filtered_variants.vcf")
+            candidate_variants = filter_vcf_by_vep(
+                mutations,
+                logger,
+                f"{result_dir}/vcf_files/{basename}.filtered_variants.vcf",
+                f"{result_dir}/vcf_files/{basename}.removed_variants.vcf",
+                QuerynatorIds(genome, logger),
+                regions,
+            )
+            # CGI is queried with the filtered vcf file, write it completely
+            for _ in candidate_variants:
+                pass
 
-            # create and set new input file for cgi query
+            # create and set new input file for cgi query, it only contains the records of the regions
             mutations = f"{result_dir}/vcf_files/{basename}.filtered_variants.vcf"
+            regions = None
 
         logger.info("Query the cancergenomeinterpreter (CGI)")
         headers = {"Authorization": email + " " + token}
         # run analysis
         query_cgi(
-            mutations, cnas, translocations, genome, cancer, headers, logger, result_dir, original_input, filter_vep
+            mutations,
+            cnas,
+            translocations,
+            genome,
+            cancer,
+            headers,
+            logger,
+            result_dir,
+            original_input,
+            filter_vep,
+            scratch_dir,
+            regions,
         )
 
         # move downloaded results to result dir
@@ -479,8 +572,9 @@ def query_api_cgi(mutations, cnas, translocations, cancer, genome, token, email,
 @click.option(
     "-c",
     "--cancer",
-    help="the cancer DOID (id or name) to be searched.",
-    default=None,
+    help="the cancer DOID (id or name) to be searched. "
+    "Can be given several times, then one result table is written per cancer type.",
+    multiple=True,
     type=click.STRING,
 )
 @click.option(
@@ -497,25 +591,233 @@ def query_api_cgi(mutations, cnas, translocations, cancer, genome, token, email,
     help="Key-Value pairs to filter the evidence items. Example: 'type=Predictive'",
     multiple=True,
 )
-def query_api_civic(vcf, outdir, genome, cancer, filter_vep, filter_evidence):
+@click.option(
+    "--cache_mode",
+    help="How to load the CIViCpy cache. auto: update if stale (CIViCpy default), offline: never update "
+    "(other builds than GRCh37 require --match_mode hgvs, as coordinates are resolved via the allele registry), "
+    "ttl: update if the cache file is older than --cache_ttl days, refresh: always update",
+    type=click.Choice(CIVIC_CACHE_MODES, case_sensitive=True),
+    show_default=True,
+    default="auto",
+)
+@click.option(
+    "--cache_path",
+    help="Path to the CIViCpy cache file, e.g. a pinned snapshot. Defaults to the local CIViCpy cache",
+    type=click.Path(dir_okay=False),
+    default=None,
+)
+@click.option(
+    "--cache_ttl",
+    help="Maximum age of the CIViCpy cache file in days before it is updated, used with --cache_mode ttl",
+    type=click.FloatRange(min=0),
+    show_default=True,
+    default=7,
+)
+@click.option(
+    "--snapshot",
+    help="Path to a CIViC snapshot created with build-civic-snapshot. If set, the CIViCpy cache is not loaded",
+    type=click.Path(exists=True, file_okay=False),
+    default=None,
+)
+@click.option(
+    "--civic_tsv",
+    help="Path to a directory with the TSV files of a CIViC release (e.g. nightly-VariantSummaries.tsv, "
+    "nightly-MolecularProfileSummaries.tsv, nightly-ClinicalEvidenceSummaries.tsv). "
+    "If set, CIViC is queried from these files instead of the CIViCpy cache. "
+    "Other builds than GRCh37 require --match_mode hgvs",
+    type=click.Path(exists=True, file_okay=False),
+    default=None,
+)
+@click.option(
+    "-t",
+    "--threads",
+    help="Number of worker threads for the allele registry requests and the creation of the result table",
+    type=click.IntRange(min=1),
+    show_default=True,
+    default=1,
+)
+@click.option(
+    "--result_cache",
+    help="Directory of a CIViC result cache shared between runs. Variants found in the cache are not queried again, "
+    "entries are kept per CIViC data version",
+    type=click.Path(file_okay=False),
+    default=None,
+)
+@click.option(
+    "--result_cache_size",
+    help="Maximum number of variants in the CIViC result cache, the least recently used ones are evicted",
+    type=click.IntRange(min=1),
+    show_default=True,
+    default=CIVIC_RESULT_CACHE_SIZE,
+)
+@click.option(
+    "--fields",
+    help="Columns of the CIViC result table, as comma separated list of profiles (minimal, report, full), "
+    "groups (variant, gene, mol_profile, assertion, evidence) or single columns. "
+    "Only the selected information is extracted from CIViC. create-report requires the report profile",
+    type=str,
+    show_default=True,
+    default="full",
+)
+@click.option(
+    "--match_mode",
+    help="How variants are matched to CIViC variants: by coordinates, by the HGVS expressions and protein changes "
+    "(SYMBOL, HGVSc, HGVSp) of their VEP annotation, or combined, using the VEP annotation for variants without "
+    "coordinate hit. The matching path is written to the match_type column",
+    type=click.Choice(CIVIC_MATCH_MODES),
+    show_default=True,
+    default="coordinate",
+)
+@click.option(
+    "--region",
+    help="Only query variants overlapping this region (chr:start-end, 1-based, inclusive). Can be given several "
+    "times. Requires a tabix-indexed vcf file, only the index blocks of the regions are read",
+    type=click.STRING,
+    multiple=True,
+)
+@click.option(
+    "--bed",
+    help="Only query variants overlapping the regions of this BED file, e.g. a gene panel. "
+    "Requires a tabix-indexed vcf file, only the index blocks of the regions are read",
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+)
+def query_api_civic(
+    vcf,
+    outdir,
+    genome,
+    cancer,
+    filter_vep,
+    filter_evidence,
+    cache_mode,
+    cache_path,
+    cache_ttl,
+    snapshot,
+    civic_tsv,
+    threads,
+    result_cache,
+    result_cache_size,
+    fields,
+    match_mode,
+    region,
+    bed,
+):
     validate_evidence_filters(filter_evidence)
+    if civic_tsv and genome != "GRCh37" and match_mode != "hgvs":
+        # other builds are matched via the allele registry, which requires network access
+        raise click.UsageError(
+            f"--civic_tsv matches {genome} variants only with --match_mode hgvs. "
+            "Coordinates are matched offline for GRCh37 only"
+        )
+    if cache_mode == "offline" and not (snapshot or civic_tsv) and genome != "GRCh37" and match_mode != "hgvs":
+        # same restriction as for --civic_tsv, the CIViCpy cache does not cover the allele registry
+        raise click.UsageError(
+            f"--cache_mode offline matches {genome} variants only with --match_mode hgvs. "
+            "Coordinates are matched offline for GRCh37 only"
+        )
+    try:
+        fields = resolve_civic_fields(fields)
+    except ValueError as err:
+        raise click.UsageError(str(err))
     evidence_filters = parse_filters(filter_evidence)
+    regions = get_regions(region, bed, vcf, logger)
     result_dir = get_unique_querynator_dir(f"{outdir}")
     dirname, basename = os.path.split(result_dir)
     if filter_vep:
-        in_vcf_header, candidate_variants, removed_variants = filter_vcf_by_vep(vcf, logger)
         # create result directories
         os.makedirs(f"{result_dir}/vcf_files")
-        write_vcf(in_vcf_header, removed_variants, f"{result_dir}/vcf_files/{basename}.removed_variants.vcf")
-        write_vcf(in_vcf_header, candidate_variants, f"{result_dir}/vcf_files/{basename}.filtered_variants.vcf")
+        # the kept records are written to the filtered vcf file while they are consumed by the CIViC query
+        candidate_variants = filter_vcf_by_vep(
+            vcf,
+            logger,
+            f"{result_dir}/vcf_files/{basename}.filtered_variants.vcf",
+            f"{result_dir}/vcf_files/{basename}.removed_variants.vcf",
+            QuerynatorIds(genome, logger),
+            regions,
+        )
 
         logger.info("Query the Clinical Interpretations of Variants In Cancer (CIViC)")
         # run analysis
-        query_civic(candidate_variants, result_dir, logger, vcf, genome, cancer, filter_vep, evidence_filters)
+        query_civic(
+            candidate_variants,
+            result_dir,
+            logger,
+            vcf,
+            genome,
+            cancer,
+            filter_vep,
+            evidence_filters,
+            cache_mode,
+            cache_path,
+            cache_ttl,
+            snapshot,
+            civic_tsv,
+            threads,
+            result_cache,
+            result_cache_size,
+            fields,
+            match_mode,
+            regions,
+        )
 
     else:
         logger.info("Query the Clinical Interpretations of Variants In Cancer (CIViC)")
-        query_civic(vcf, result_dir, logger, vcf, genome, cancer, filter_vep, evidence_filters)
+        query_civic(
+            vcf,
+            result_dir,
+            logger,
+            vcf,
+            genome,
+            cancer,
+            filter_vep,
+            evidence_filters,
+            cache_mode,
+            cache_path,
+            cache_ttl,
+            snapshot,
+            civic_tsv,
+            threads,
+            result_cache,
+            result_cache_size,
+            fields,
+            match_mode,
+            regions,
+        )
+
+
+# querynator build civic snapshot
+@querynator_cli.command()
+@click.option(
+    "-o",
+    "--outdir",
+    required=True,
+    type=click.STRING,
+    help="Directory in which the CIViC snapshot will be stored.",
+)
+@click.option(
+    "--cache_mode",
+    help="How to load the CIViCpy cache the snapshot is compiled from, see query-api-civic",
+    type=click.Choice(CIVIC_CACHE_MODES, case_sensitive=True),
+    show_default=True,
+    default="auto",
+)
+@click.option(
+    "--cache_path",
+    help="Path to the CIViCpy cache file. Defaults to the local CIViCpy cache",
+    type=click.Path(dir_okay=False),
+    default=None,
+)
+@click.option(
+    "--cache_ttl",
+    help="Maximum age of the CIViCpy cache file in days before it is updated, used with --cache_mode ttl",
+    type=click.FloatRange(min=0),
+    show_default=True,
+    default=7,
+)
+def build_civic_snapshot(outdir, cache_mode, cache_path, cache_ttl):
+    logger.info("Compile the CIViCpy cache into a CIViC snapshot")
+    load_civic_cache(logger, cache_mode, cache_path, cache_ttl)
+    compile_civic_snapshot(outdir, logger)
 
 
 # querynator create report
@@ -541,7 +843,25 @@ def query_api_civic(vcf, outdir, genome, cancer, filter_vep, filter_evidence):
     type=click.STRING,
     help="Name of new directory in which reports will be stored.",
 )
-def create_report(cgi_path, civic_path, outdir):
+@click.option(
+    "--transcript_mode",
+    help="VEP annotation reported per variant: all transcripts (comma separated values), the canonical transcript, "
+    "the MANE Select transcript or the transcript with the most severe impact. "
+    "mane falls back to canonical and canonical to worst if no transcript qualifies",
+    type=click.Choice(TRANSCRIPT_MODES),
+    show_default=True,
+    default="all",
+)
+@click.option(
+    "--civic_cancer",
+    help="DOID of the cancer type whose CIViC results are reported (e.g. DOID:1909), "
+    "required if query-api-civic was run for several cancer types",
+    type=click.STRING,
+    default=None,
+)
+def create_report(cgi_path, civic_path, outdir, transcript_mode, civic_cancer):
+    civic_results = get_civic_results_path(civic_path, logger, civic_cancer)
+
     # create outdir
     report_dir = get_unique_querynator_dir(outdir)
     dirname, basename = os.path.split(report_dir)
@@ -549,9 +869,10 @@ def create_report(cgi_path, civic_path, outdir):
     os.makedirs(f"{report_dir}/report/variant_reports")
     os.makedirs(f"{report_dir}/report/plots")
 
-    # combine the results
-    combine_civic(civic_path, report_dir, logger)
-    combine_cgi(cgi_path, report_dir, logger)
+    # combine the results, the VEP annotation is parsed once for both
+    civic_vep_df, cgi_vep_df = read_shared_vep_table(cgi_path, civic_path, logger, transcript_mode)
+    combine_civic(civic_path, report_dir, logger, transcript_mode, civic_vep_df, civic_results)
+    combine_cgi(cgi_path, report_dir, logger, transcript_mode, cgi_vep_df)
     combine_cgi_civic(report_dir, logger)
 
     # add tiers & ranking-score to merged results
@@ -1,8 +1,21 @@
 """ Functions that are used by multiple scripts bundled """
 
 import gzip
+import hashlib
 import os
+import re
 import shutil
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import pysam
+import vcf
+from vcf.parser import _Info as VcfInfo
+
+# INFO header line, the description may contain commas and escaped quotes
+VCF_INFO_HEADER = re.compile(r'^##INFO=<ID=([^,>]+),Number=([^,>]+),Type=([^,>]+),Description="((?:[^"\\]|\\.)*)"')
+# INFO header of the native vcf reader, with the attribute names of pyVCF3's
+VcfInfoHeader = namedtuple("VcfInfoHeader", ["id", "num", "type", "desc"])
 
 
 def flatten(l_l):
@@ -35,23 +48,369 @@ def gzipped(file_path):
         return test_f.read(2) == b"\x1f\x8b"
 
 
-def gunzip_compressed_files(file_path, logger):
+def gunzip_compressed_files(file_path, logger, out_dir):
     """
-    gunzips gzipped vcf file
+    gunzips gzipped (or BGZF compressed) file into a scratch directory, the input file is left untouched
 
     :param file_path: Path to gzipped input file
     :type file_path: str
+    :param out_dir: directory of the decompressed file, e.g. on local NVMe or tmpfs
+    :type out_dir: str
+    :return: path of the decompressed file
+    :rtype: str
+    """
+    logger.info(f"Unzipping input file ({os.path.basename(os.path.normpath(file_path))}) to {out_dir}")
+
+    file_name = os.path.basename(file_path)
+    for suffix in [".gz", ".bgz"]:
+        if file_name.endswith(suffix):
+            file_name = file_name[: -len(suffix)]
+    out_path = os.path.join(out_dir, file_name)
+    with gzip.open(file_path, "rb") as f_in:
+        with open(out_path, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out)
+    return out_path
+
+
+class VcfRecord:
+    """
+    Record of the native vcf reader. Only CHROM, POS, REF and ALT are parsed when the record is read,
+    the INFO column is parsed on first access and the FORMAT and sample columns are never parsed.
+    Like in pyVCF3, INFO values are lists of strings (True for flags) and a missing ALT is [None]
+    """
+
+    __slots__ = ("CHROM", "POS", "REF", "ALT", "_fields", "_info")
+
+    def __init__(self, line):
+        """
+        :param line: data line of a vcf file
+        :type line: str
+        """
+        # FORMAT and sample columns stay in one unsplit field
+        self._fields = line.rstrip("\r\n").split("\t", 8)
+        self.CHROM = self._fields[0]
+        self.POS = int(self._fields[1])
+        self.REF = self._fields[3]
+        self.ALT = [None] if self._fields[4] == "." else self._fields[4].split(",")
+        self._info = None
+
+    @property
+    def start(self):
+        """0-based start of the record"""
+        return self.POS - 1
+
+    @property
+    def end(self):
+        """0-based, exclusive end of the reference allele"""
+        return self.POS - 1 + len(self.REF)
+
+    @property
+    def INFO(self):
+        if self._info is None:
+            self._info = {}
+            if self._fields[7] != ".":
+                for item in self._fields[7].split(";"):
+                    key, has_value, value = item.partition("=")
+                    self._info[key] = value.split(",") if has_value else True
+        return self._info
+
+    def add_info(self, key, value):
+        """
+        Add or replace an INFO field
+
+        :param key: INFO key
+        :type key: str
+        :param value: INFO value
+        :type value: str or int
+        :return: None
+        """
+        items = [item for item in self._fields[7].split(";") if item != "." and item.partition("=")[0] != key]
+        items.append(f"{key}={value}")
+        self._fields[7] = ";".join(items)
+        self._info = None
+
+    def __str__(self):
+        return "\t".join(self._fields)
+
+
+class VcfReader:
+    """
+    Minimal streaming vcf reader for the fields querynator uses, see VcfRecord.
+    gzip and BGZF compressed files are decompressed while they are read.
+    The file is closed once all records are read, or when the reader is used as context manager
+    """
+
+    def __init__(self, vcf_path):
+        """
+        :param vcf_path: path of the vcf file, uncompressed or compressed
+        :type vcf_path: str
+        :raises ValueError: if the vcf file has no tab separated #CHROM header line
+        """
+        self.filename = vcf_path
+        self._file = gzip.open(vcf_path, "rt") if gzipped(vcf_path) else open(vcf_path)
+        self.header_lines = []
+        for line in self._file:
+            self.header_lines.append(line.rstrip("\r\n"))
+            if line.startswith("#CHROM") or not line.startswith("##"):
+                break
+        if not self.header_lines or not self.header_lines[-1].startswith("#CHROM\t"):
+            self._file.close()
+            raise ValueError(f"{vcf_path} has no tab separated #CHROM header line")
+        self.infos = {}
+        for line in self.header_lines:
+            match = VCF_INFO_HEADER.match(line)
+            if match:
+                self.infos[match.group(1)] = VcfInfoHeader(*match.groups())
+
+    def __iter__(self):
+        for line in self._file:
+            if line.strip():
+                yield VcfRecord(line)
+        self._file.close()
+
+    def fetch(self, chrom, start=None, end=None):
+        """
+        Fetch the records of a region of a tabix-indexed vcf file
+
+        :param chrom: chromosome as named in the vcf file
+        :type chrom: str
+        :param start: 0-based start of the region
+        :type start: int
+        :param end: 0-based, exclusive end of the region
+        :type end: int
+        :return: generator of records
+        :rtype: generator
+        """
+        with pysam.TabixFile(self.filename) as tabix:
+            for line in tabix.fetch(chrom, start, end):
+                yield VcfRecord(line)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class PyVcfReader(vcf.Reader):
+    """
+    pyVCF3 reader, which can be closed and used as context manager like VcfReader
+    """
+
+    def close(self):
+        self._reader.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class VcfWriter:
+    """
+    Writer of the records of the native vcf reader, the lines are written as read apart from added INFO fields
+    """
+
+    def __init__(self, stream, header_lines):
+        """
+        :param stream: writable text stream
+        :type stream: file object
+        :param header_lines: header lines, the last one is the #CHROM line
+        :type header_lines: list
+        """
+        self.stream = stream
+        self.stream.write("\n".join(header_lines) + "\n")
+
+    def write_record(self, record):
+        self.stream.write(f"{record}\n")
+
+
+def open_vcf_reader(vcf_path, native=True):
+    """
+    Open a vcf file. gzip and BGZF compressed files are decompressed while they are read.
+    The native reader only parses the fields querynator uses, pyVCF3 is used as fallback
+    for files the native reader cannot read, e.g. with space separated columns
+
+    :param vcf_path: path of the vcf file, uncompressed or compressed
+    :type vcf_path: str
+    :param native: whether to use the native reader if possible, else pyVCF3
+    :type native: bool
+    :return: vcf reader, to be used as context manager
+    :rtype: VcfReader or PyVcfReader
+    """
+    if native:
+        try:
+            return VcfReader(vcf_path)
+        except ValueError:
+            pass
+    return PyVcfReader(filename=vcf_path, compressed=gzipped(vcf_path))
+
+
+def open_vcf_writer(stream, vcf_reader, infos=()):
+    """
+    Open a vcf writer with the header of the given reader
+
+    :param stream: writable text stream
+    :type stream: file object
+    :param vcf_reader: reader as returned by open_vcf_reader
+    :type vcf_reader: VcfReader or vcf.Reader
+    :param infos: INFO fields added to the header as (ID, Number, Type, Description)
+    :type infos: list
+    :return: vcf writer of the records of the reader
+    :rtype: VcfWriter or vcf.Writer
+    """
+    if isinstance(vcf_reader, VcfReader):
+        # like pyVCF3, existing INFO fields are redefined in place and new ones are added after the last INFO line
+        header_lines = list(vcf_reader.header_lines)
+        info_lines = [n for n, line in enumerate(header_lines) if VCF_INFO_HEADER.match(line)]
+        position = info_lines[-1] + 1 if info_lines else len(header_lines) - 1
+        for id, number, type, description in infos:
+            line = f'##INFO=<ID={id},Number={number},Type={type},Description="{description}">'
+            existing = [n for n in info_lines if VCF_INFO_HEADER.match(header_lines[n]).group(1) == id]
+            if existing:
+                header_lines[existing[0]] = line
+            else:
+                header_lines.insert(position, line)
+                position += 1
+        return VcfWriter(stream, header_lines)
+    for id, number, type, description in infos:
+        vcf_reader.infos[id] = VcfInfo(id, number, type, description, None, None, None)
+    return vcf.Writer(stream, vcf_reader, lineterminator="\n")
+
+
+def parse_region(region):
     """
-    logger.info(f"Unzipping input file ({os.path.basename(os.path.normpath(file_path))})")
+    Parse a region given as chr:start-end (1-based, inclusive), chr:start or chr
+
+    :param region: region
+    :type region: str
+    :return: chromosome, 0-based start and end of the region, None for open ends
+    :rtype: tuple
+    :raises ValueError: if the region is malformed
+    """
+    match = re.fullmatch(r"([^:\s]+)(?::([\d,]+)(?:-([\d,]+))?)?", region.strip())
+    if not match:
+        raise ValueError(f"invalid region '{region}', expected chr:start-end")
+    chrom, start, end = match.groups()
+    start = int(start.replace(",", "")) - 1 if start else 0
+    end = int(end.replace(",", "")) if end else None
+    if start < 0 or (end is not None and end <= start):
+        raise ValueError(f"invalid region '{region}', start must be positive and not after end")
+    return chrom, start, end
+
 
-    if not file_path.endswith(".gz"):
-        logger.error("Given file does not end with '.gz'")
+def read_bed_regions(bed_path):
+    """
+    Read the regions of a BED file, e.g. a gene panel
+
+    :param bed_path: path of the BED file, uncompressed or gzipped
+    :type bed_path: str
+    :return: chromosome, 0-based start and end of the regions
+    :rtype: list
+    :raises ValueError: if a line is malformed
+    """
+    regions = []
+    with gzip.open(bed_path, "rt") if gzipped(bed_path) else open(bed_path) as f:
+        for n, line in enumerate(f, 1):
+            if not line.strip() or line.startswith(("#", "track", "browser")):
+                continue
+            fields = line.split("\t")
+            try:
+                regions.append((fields[0].strip(), int(fields[1]), int(fields[2])))
+            except (IndexError, ValueError):
+                raise ValueError(f"invalid BED line {n} in {bed_path}: {line.strip()}")
+    return regions
+
+
+def check_tabix_index(vcf_path, logger):
+    """
+    Checks whether a vcf file is BGZF compressed and tabix-indexed, exit if not
+
+    :param vcf_path: path of the vcf file
+    :type vcf_path: str
+    :return: None
+    """
+    try:
+        pysam.TabixFile(vcf_path).close()
+    except (OSError, ValueError) as err:
+        logger.error(f"Querying regions requires a BGZF compressed, tabix-indexed vcf file ({vcf_path}): {err}")
         exit(1)
-    else:
-        with gzip.open(file_path, "rb") as f_in:
-            with open(file_path[: -len(".gz")], "wb") as f_out:
-                shutil.copyfileobj(f_in, f_out)
-        return file_path[: -len(".gz")]
+
+
+def get_region_contig(chrom, contigs):
+    """
+    Get the contig of a tabix index a region refers to, the chromosome may be named with or without "chr" prefix
+
+    :param chrom: chromosome of the region
+    :type chrom: str
+    :param contigs: contigs of the tabix index
+    :type contigs: dict or set
+    :return: contig, None if the chromosome is not part of the index
+    :rtype: str
+    """
+    for contig in [chrom, get_num_from_chr(chrom), f"chr{chrom}"]:
+        if contig in contigs:
+            return contig
+    return None
+
+
+def get_unindexed_chromosomes(vcf_path, regions):
+    """
+    Get the chromosomes of the regions that have no records in a tabix-indexed vcf file
+
+    :param vcf_path: path of the tabix-indexed vcf file
+    :type vcf_path: str
+    :param regions: chromosome, 0-based start and end of the regions
+    :type regions: list
+    :return: chromosomes as given in the regions, sorted
+    :rtype: list
+    """
+    with pysam.TabixFile(vcf_path) as tabix:
+        contigs = set(tabix.contigs)
+    return sorted({chrom for chrom, _, _ in regions if get_region_contig(chrom, contigs) is None})
+
+
+def fetch_vcf_regions(vcf_reader, regions):
+    """
+    Fetch the records of a tabix-indexed vcf file that overlap the given regions.
+    Only the BGZF blocks of the regions are read, each record is returned once, in the order of the vcf file
+
+    :param vcf_reader: reader of the vcf file as returned by open_vcf_reader
+    :type vcf_reader: VcfReader or vcf.Reader
+    :param regions: chromosome, 0-based start and end (None for open ends) of the regions
+    :type regions: list
+    :return: generator of vcf records
+    :rtype: generator
+    """
+    with pysam.TabixFile(vcf_reader.filename) as tabix:
+        contigs = {contig: i for i, contig in enumerate(tabix.contigs)}
+
+    # regions of chromosomes named with or without "chr" prefix, sorted like the vcf file and merged.
+    # regions of chromosomes without records are skipped, see get_unindexed_chromosomes
+    intervals = []
+    for chrom, start, end in regions:
+        contig = get_region_contig(chrom, contigs)
+        if contig is not None:
+            intervals.append((contigs[contig], contig, start, end if end is not None else float("inf")))
+    merged = []
+    for i, contig, start, end in sorted(intervals):
+        if merged and merged[-1][1] == contig and start <= merged[-1][3]:
+            merged[-1][3] = max(merged[-1][3], end)
+        else:
+            merged.append([i, contig, start, end])
+
+    previous = None
+    for _, contig, start, end in merged:
+        for record in vcf_reader.fetch(contig, start, None if end == float("inf") else end):
+            # records overlapping the previous region of the chromosome were fetched with it
+            if previous is not None and previous[0] == contig and record.start < previous[1]:
+                continue
+            yield record
+        previous = (contig, end)
 
 
 def get_num_from_chr(s):
@@ -64,3 +423,262 @@ def get_num_from_chr(s):
     """
     int_chr = s.split("chr")[1] if str(s).startswith("chr") else s
     return str(int_chr)
+
+
+# querynator IDs stay below 2**53, so they survive pandas' conversion of integer columns with missing values to float
+QUERYNATOR_ID_RANGE = 10**15
+# reference genome names that denote the same build
+BUILD_ALIASES = {"HG19": "GRCH37", "HG38": "GRCH38", "HG18": "NCBI36"}
+
+
+def create_querynator_id(chrom, pos, ref, alt, build, salt=0):
+    """
+    Derive the querynator ID of a variant from a hash of its position, alleles and reference genome,
+    so the same variant gets the same ID in every sample and run
+
+    :param chrom: chromosome, with or without "chr" prefix
+    :type chrom: str
+    :param pos: position as given in the vcf file
+    :type pos: int
+    :param ref: reference allele
+    :type ref: str
+    :param alt: alternate allele(s), comma separated
+    :type alt: str
+    :param build: reference genome
+    :type build: str
+    :param salt: changes the ID of a variant, used to resolve collisions
+    :type salt: int
+    :return: querynator ID
+    :rtype: int
+    """
+    build = str(build).strip().upper()
+    fields = [
+        get_num_from_chr(str(chrom)),
+        str(int(pos)),
+        str(ref).upper(),
+        str(alt).upper(),
+        BUILD_ALIASES.get(build, build),
+    ]
+    if salt:
+        fields.append(str(salt))
+    digest = hashlib.blake2b("\t".join(fields).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % QUERYNATOR_ID_RANGE
+
+
+class QuerynatorIds:
+    """
+    Assigns the querynator IDs of a run and checks them for collisions.
+    A variant whose ID is already taken by another variant gets the ID of the next salt
+    """
+
+    def __init__(self, build, logger):
+        """
+        :param build: reference genome of the variants
+        :type build: str
+        """
+        self.build = build
+        self.logger = logger
+        self.variants = {}
+
+    def get(self, chrom, pos, ref, alt):
+        """
+        Get the querynator ID of a variant
+
+        :param chrom: chromosome, with or without "chr" prefix
+        :type chrom: str
+        :param pos: position as given in the vcf file
+        :type pos: int
+        :param ref: reference allele
+        :type ref: str
+        :param alt: alternate allele(s), comma separated
+        :type alt: str
+        :return: querynator ID
+        :rtype: int
+        """
+        variant = (get_num_from_chr(str(chrom)), int(pos), str(ref).upper(), str(alt).upper())
+        salt = 0
+        while True:
+            querynator_id = create_querynator_id(*variant, self.build, salt)
+            known_variant = self.variants.setdefault(querynator_id, variant)
+            if known_variant == variant:
+                return querynator_id
+            self.logger.warning(f"Querynator ID {querynator_id} of {variant} is already used by {known_variant}")
+            salt += 1
+
+    def from_record(self, record):
+        """
+        Get the querynator ID of a vcf record
+
+        :param record: vcf record as returned by open_vcf_reader
+        :type record: VcfRecord or vcf.model._Record
+        :return: querynator ID
+        :rtype: int
+        """
+        return self.get(record.CHROM, record.POS, record.REF, ",".join(str(alt) for alt in record.ALT))
+
+
+class CsqSchema:
+    """
+    Decoder of VEP's CSQ annotation, compiled once from the vcf header into the offsets of the fields.
+    Each annotation is split once, and only as far as the last requested field
+    """
+
+    def __init__(self, fields):
+        """
+        :param fields: CSQ field names in annotation order
+        :type fields: list
+        """
+        self.fields = list(fields)
+        self.offsets = {name: i for i, name in enumerate(self.fields)}
+        self._decoders = {}
+
+    @classmethod
+    def from_header(cls, vcf_reader):
+        """
+        Compile the CSQ schema of a vcf file
+
+        :param vcf_reader: reader of the vcf file
+        :type vcf_reader: VcfReader or vcf.Reader
+        :return: CSQ schema, None if the vcf file has no CSQ annotation
+        :rtype: CsqSchema
+        """
+        # Name must be VEPs default "CSQ"
+        if "CSQ" not in vcf_reader.infos:
+            return None
+        return cls(vcf_reader.infos["CSQ"].desc.split(":")[1].strip().split("|"))
+
+    def __contains__(self, name):
+        return name in self.offsets
+
+    def decoder(self, *names):
+        """
+        Get the decoder of the given fields, e.g. decoder("IMPACT", "Consequence")
+
+        :param names: CSQ field names, all fields if none are given
+        :type names: str
+        :return: function mapping an annotation to the tuple of its values of the given fields,
+            "" for fields missing in a truncated annotation
+        :rtype: function
+        :raises KeyError: if a field is not part of the CSQ annotation
+        """
+        names = names or tuple(self.fields)
+        if names not in self._decoders:
+            offsets = [self.offsets[name] for name in names]
+            maxsplit = max(offsets) + 1
+            padding = [""] * maxsplit
+
+            def decode(annotation):
+                values = annotation.split("|", maxsplit)
+                if len(values) < maxsplit:
+                    values += padding
+                return tuple(values[i] for i in offsets)
+
+            self._decoders[names] = decode
+        return self._decoders[names]
+
+
+# CSQ entries reported per variant, see select_csq
+TRANSCRIPT_MODES = ["all", "canonical", "mane", "worst"]
+# order in which the transcript modes fall back if no CSQ entry qualifies
+TRANSCRIPT_MODE_FALLBACKS = {"mane": ["mane", "canonical"], "canonical": ["canonical"], "worst": []}
+# VEP IMPACT ratings, most severe first
+VEP_IMPACT_RANKS = {"HIGH": 0, "MODERATE": 1, "LOW": 2, "MODIFIER": 3}
+
+
+def select_csq(annotations, csq_schema, transcript_mode="all"):
+    """
+    Select the CSQ entries of a record that are reported in the VEP annotation table.
+    all: every entry, canonical: the entry of the canonical transcript (CANONICAL),
+    mane: the entry of the MANE Select transcript (MANE_SELECT), worst: the entry with the most severe IMPACT.
+    If no entry qualifies, mane falls back to canonical and canonical to worst.
+    Entries are selected per ALT allele (Allele), so multiallelic records keep the annotation of each allele
+
+    :param annotations: CSQ entries of the record
+    :type annotations: list
+    :param csq_schema: CSQ schema of the vcf file
+    :type csq_schema: CsqSchema
+    :param transcript_mode: one of TRANSCRIPT_MODES
+    :type transcript_mode: str
+    :return: selected CSQ entries, a single one per allele unless transcript_mode is all
+    :rtype: list
+    """
+    if transcript_mode == "all" or len(annotations) < 2:
+        return annotations
+    names = [name for name in ["Allele", "MANE_SELECT", "CANONICAL", "IMPACT"] if name in csq_schema]
+    if not names:
+        return annotations[:1]
+    decode = csq_schema.decoder(*names)
+
+    # entries grouped by allele, in the order of their first entry
+    alleles = {}
+    for annotation in annotations:
+        values = dict(zip(names, decode(annotation)))
+        alleles.setdefault(values.get("Allele"), []).append((annotation, values))
+
+    def select(entries):
+        for mode in TRANSCRIPT_MODE_FALLBACKS[transcript_mode]:
+            if mode == "mane":
+                selected = [annotation for annotation, values in entries if values.get("MANE_SELECT")]
+            else:
+                selected = [annotation for annotation, values in entries if values.get("CANONICAL") == "YES"]
+            if selected:
+                return selected[0]
+        # ties keep VEP's order
+        return min(entries, key=lambda entry: VEP_IMPACT_RANKS.get(entry[1].get("IMPACT"), len(VEP_IMPACT_RANKS)))[0]
+
+    return [select(entries) for entries in alleles.values()]
+
+
+def collapse_csq(annotations, decode):
+    """
+    Collapse the CSQ entries of a record, e.g. one per transcript, into one value per field.
+    The distinct non-empty values of each field are accumulated in an ordered set and joined once,
+    sorted and comma separated, so the cost is linear in the number of entries
+
+    :param annotations: CSQ entries of the record
+    :type annotations: list
+    :param decode: decoder of the CSQ fields, see CsqSchema.decoder
+    :type decode: function
+    :return: collapsed value of each decoded field, "" if no entry has a value
+    :rtype: list
+    """
+    fields = None
+    for annotation in annotations:
+        values = decode(annotation)
+        if fields is None:
+            fields = [{} for _ in values]
+        for field, value in zip(fields, values):
+            if value:
+                field[value] = None
+    return [",".join(sorted(field)) for field in fields or []]
+
+
+def ordered_map(func, iterable, threads=1, max_pending=None):
+    """
+    Apply a function to all items on a pool of worker threads and yield the results in input order.
+    Items are submitted lazily, at most max_pending results are held ahead of the consumer
+
+    :param func: function applied to every item
+    :type func: function
+    :param iterable: items
+    :type iterable: iterable
+    :param threads: number of worker threads, 1 runs sequentially in the calling thread
+    :type threads: int
+    :param max_pending: maximum number of submitted but not yet consumed items, defaults to 4 * threads
+    :type max_pending: int
+    :return: results in input order
+    :rtype: generator
+    """
+    if threads <= 1:
+        yield from map(func, iterable)
+        return
+
+    max_pending = max_pending or 4 * threads
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = deque()
+        for item in iterable:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -1,2 +1,6 @@
 from .cgi_api import *
 from .civic_api import *
+from .civic_index import *
+from .civic_result_cache import *
+from .civic_snapshot import *
+from .civic_tsv import *
@@ -7,6 +7,7 @@ import os
 import os.path
 import shutil
 import sys
+import tempfile
 import time
 from datetime import date
 from zipfile import BadZipfile, ZipFile
@@ -17,7 +18,13 @@ import requests
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 
-from querynator.helper_functions import gunzip_compressed_files, gzipped
+from querynator.helper_functions import (
+    fetch_vcf_regions,
+    gunzip_compressed_files,
+    gzipped,
+    open_vcf_reader,
+    open_vcf_writer,
+)
 
 
 def hg_assembly(genome):
@@ -89,6 +96,10 @@ def submit_query_cgi(mutations, cnas, translocations, genome, cancer, headers, l
     except requests.exceptions.HTTPError as err:
         raise SystemExit(err)
 
+    finally:
+        for f in input_files.values():
+            f.close()
+
 
 def status_done(url, headers, logger):
     """
@@ -232,7 +243,41 @@ def add_cgi_metadata(url, output, original_input, genome, filter_vep, logger):
         logger.exception("Oops, sth went wrong with the zip archive. Please check your input format.")
 
 
-def query_cgi(mutations, cnas, translocations, genome, cancer, headers, logger, output, original_input, filter_vep):
+def write_vcf_regions(vcf_path, regions, out_dir):
+    """
+    Write the records of the given regions of a tabix-indexed vcf file to an uncompressed vcf file
+
+    :param vcf_path: path of the tabix-indexed vcf file
+    :type vcf_path: str
+    :param regions: chromosome, 0-based start and end of the regions
+    :type regions: list
+    :param out_dir: directory of the written vcf file
+    :type out_dir: str
+    :return: path of the written vcf file
+    :rtype: str
+    """
+    out_path = os.path.join(out_dir, "regions.vcf")
+    with open_vcf_reader(vcf_path) as in_vcf, open(out_path, "w") as f:
+        writer = open_vcf_writer(f, in_vcf)
+        for record in fetch_vcf_regions(in_vcf, regions):
+            writer.write_record(record)
+    return out_path
+
+
+def query_cgi(
+    mutations,
+    cnas,
+    translocations,
+    genome,
+    cancer,
+    headers,
+    logger,
+    output,
+    original_input,
+    filter_vep,
+    scratch_dir=None,
+    regions=None,
+):
     """
     Actual query to cgi
 
@@ -251,19 +296,32 @@ def query_cgi(mutations, cnas, translocations, genome, cancer, headers, logger,
     :param logger: prints info to console
     :param output: sample name
     :type output: str
+    :param scratch_dir: directory for the decompressed input files, defaults to the system's temporary directory
+    :type scratch_dir: str
+    :param regions: if given, only the mutations of these regions are uploaded, read from the tabix-indexed vcf file
+    :type regions: list
 
     """
 
     input_files = {"mutations": mutations, "cnas": cnas, "translocations": translocations}
-    # unzip files if necessary
-    for key, file_path in input_files.items():
-        if file_path is not None:
-            if gzipped(file_path):
-                input_files[key] = gunzip_compressed_files(file_path, logger)
-
-    url = submit_query_cgi(
-        input_files["mutations"], input_files["cnas"], input_files["translocations"], genome, cancer, headers, logger
-    )
+    # CGI expects uncompressed files: unzip them once into a scratch directory, removed after the upload
+    with tempfile.TemporaryDirectory(prefix="querynator_", dir=scratch_dir) as scratch:
+        if regions is not None and mutations is not None:
+            input_files["mutations"] = write_vcf_regions(mutations, regions, scratch)
+        for key, file_path in input_files.items():
+            if file_path is not None:
+                if gzipped(file_path):
+                    input_files[key] = gunzip_compressed_files(file_path, logger, scratch)
+
+        url = submit_query_cgi(
+            input_files["mutations"],
+            input_files["cnas"],
+            input_files["translocations"],
+            genome,
+            cancer,
+            headers,
+            logger,
+        )
     done = status_done(url, headers, logger)
     logger.info("CGI Query finished")
     if done:
@@ -4,23 +4,51 @@ import warnings
 
 warnings.simplefilter(action="ignore", category=FutureWarning)
 
+import csv
+import hashlib
+import json
 import os
-import random
+import re
+import threading
+import time
+from collections import Counter, defaultdict
 from datetime import date
+from functools import lru_cache
 from os.path import abspath, dirname
 
 import civicpy
 import numpy as np
-import pandas as pd
-import vcf
 from civicpy import civic
 
 from querynator.helper_functions import (
+    CsqSchema,
+    QuerynatorIds,
+    fetch_vcf_regions,
     get_num_from_chr,
-    gunzip_compressed_files,
-    gzipped,
     ontology,
+    open_vcf_reader,
+    ordered_map,
 )
+from querynator.query_api.civic_index import (
+    bulk_search_by_allele_registry,
+    get_coordinate_index,
+    get_locus_filter,
+    get_protein_index,
+    hgvs_keys,
+    protein_change,
+)
+from querynator.query_api.civic_result_cache import open_civic_result_cache
+from querynator.query_api.civic_snapshot import load_civic_snapshot
+from querynator.query_api.civic_tsv import load_civic_tsv_release
+
+# how queried variants are matched to CIViC variants, see access_civic_by_coordinate
+CIVIC_MATCH_MODES = ["coordinate", "hgvs", "combined"]
+# CSQ fields decoded for the hgvs and combined match modes
+VEP_MATCH_FIELDS = ["Allele", "SYMBOL", "HGVSc", "HGVSp"]
+# how the CIViCpy cache is loaded before querying, see load_civic_cache
+CIVIC_CACHE_MODES = ["auto", "offline", "ttl", "refresh"]
+# default maximum number of variants in the CIViC result cache
+CIVIC_RESULT_CACHE_SIZE = 100000
 
 
 def check_vcf_input(vcf_path, logger):
@@ -58,88 +86,167 @@ def vcf_file(vcf_path):
     :type vcf_path: str
     :return: None
     """
-    if vcf_path.endswith(".vcf") or vcf_path.endswith(".vcf.gz"):
+    if vcf_path.endswith((".vcf", ".vcf.gz", ".vcf.bgz")):
         return True
     else:
         return False
 
 
-def get_coordinates_from_vcf(input, build, logger):
+def get_csq_schema(vcf_path, logger):
+    """
+    Compile the schema of VEP's CSQ annotation from the header of a vcf file
+
+    :param vcf_path: Variant Call Format (VCF) file (Version 4.2), uncompressed or gzipped
+    :type vcf_path: str
+    :return: CSQ schema
+    :rtype: CsqSchema
+    """
+    with open_vcf_reader(vcf_path) as vcf_reader:
+        csq_schema = CsqSchema.from_header(vcf_reader)
+    # Name must be VEPs default "CSQ"
+    if csq_schema is None:
+        logger.error("vcf file does not include required VEP INFO fields (key must be default 'CSQ')")
+        exit(1)
+    return csq_schema
+
+
+def get_vep_allele(ref, alt):
+    """
+    Get the allele of a vcf ALT as written by VEP to the Allele field of the CSQ annotation
+
+    :param ref: reference allele
+    :type ref: str
+    :param alt: alternate allele
+    :type alt: str
+    :return: VEP allele, "-" for deletions
+    :rtype: str
+    """
+    if len(ref) != len(alt) and ref[:1] == alt[:1]:
+        # VEP trims the padding base of indels
+        return alt[1:] or "-"
+    return alt
+
+
+def get_vep_match_keys(record, alt_base, csq_schema):
+    """
+    Create the CIViC lookup keys of an ALT from the HGVS expressions and protein changes of its VEP annotation
+
+    :param record: vcf record as returned by open_vcf_reader
+    :type record: VcfRecord or vcf.model._Record
+    :param alt_base: ALT of the record
+    :type alt_base: str or vcf.model._Substitution
+    :param csq_schema: CSQ schema as returned by get_csq_schema
+    :type csq_schema: CsqSchema
+    :return: sorted lookup keys
+    :rtype: list
+    """
+    allele = get_vep_allele(record.REF, str(alt_base))
+    keys = set()
+    fields = [name for name in VEP_MATCH_FIELDS if name in csq_schema]
+    if not fields:
+        return []
+    decode = csq_schema.decoder(*fields)
+    for csq in record.INFO.get("CSQ", []):
+        annotation = dict(zip(fields, decode(csq)))
+        # annotations of the other ALTs of multiallelic records
+        if len(record.ALT) > 1 and annotation.get("Allele", allele) != allele:
+            continue
+        for field in ["HGVSc", "HGVSp"]:
+            if annotation.get(field):
+                keys.update(hgvs_keys(annotation[field]))
+        change = protein_change(annotation.get("HGVSp"))
+        if change and annotation.get("SYMBOL"):
+            keys.add(("protein_change", annotation["SYMBOL"].upper(), change))
+    return sorted(keys)
+
+
+def get_coordinates_from_vcf(input, build, logger, csq_schema=None, locus_filter=None, regions=None):
     """
-    Read in vcf file using "pyVCF3",
+    Read in vcf file using open_vcf_reader,
     creates CoordinateQuery objects for each variant.
     This function does find (ref-alt):
     SNPs (A-T)
     DelIns (AA-TT)
     Deletions (TTTCA -  AT)
 
-    :param input: list of pyVCF3 records or vcf file to query
-    :type input: list or str
+    :param input: iterable of vcf records or vcf file to query, records are consumed once
+    :type input: iterable or str
     :param build: reference genome
     :type build: str
-    :return: CoordinateQuery objects
-    :rtype: list
+    :param csq_schema: CSQ schema, if given the lookup keys of the VEP annotation are collected as well
+    :type csq_schema: CsqSchema
+    :param locus_filter: if given, records outside the CIViC-curated loci are skipped
+    :type locus_filter: CivicLocusFilter
+    :param regions: if given, only the records of these regions are read from the tabix-indexed vcf file.
+        Ignored for records, which are expected to be restricted already
+    :type regions: list
+    :return: CoordinateQuery objects, and their VEP lookup keys if csq_schema is given
+    :rtype: dict or tuple (dict, dict)
     """
-    if type(input) == list:
+    if not isinstance(input, str):
         variant_file = input
     else:
         if vcf_file(input):
-            if gzipped(input):
-                variant_file = vcf.Reader(open(gunzip_compressed_files(input, logger)))
-            else:
-                variant_file = vcf.Reader(open(input))
+            with open_vcf_reader(input) as vcf_reader:
+                records = fetch_vcf_regions(vcf_reader, regions) if regions is not None else vcf_reader
+                return get_coordinates_from_vcf(records, build, logger, csq_schema, locus_filter)
 
     coord_dict = {}
+    match_keys = {}
+    querynator_ids = QuerynatorIds(build, logger)
+    n_records = n_skipped = 0
     for record in variant_file:
+        n_records += 1
+        if locus_filter is not None and not locus_filter.keeps(record):
+            n_skipped += 1
+            continue
         if "QID" in record.INFO.keys():
+            # values of INFO fields read from a vcf file are lists of strings
             querynator_id = record.INFO["QID"]
+            if isinstance(querynator_id, list):
+                querynator_id = int("".join(querynator_id))
         else:
-            # filter_vep not applied and no rerun with filtered vcf, generate random QID for following steps which will not be reported in results
-            querynator_id = random.randint(1000000, 9999999)
+            # filter_vep not applied and no rerun with filtered vcf, derive the QID for following steps which will not be reported in results
+            querynator_id = querynator_ids.from_record(record)
         for alt_base in record.ALT:
             # INSERTION
             if len(record.REF) < len(alt_base):
-                coord_dict.update(
-                    {
-                        civic.CoordinateQuery(
-                            chr=get_num_from_chr(record.CHROM),
-                            start=int(record.start) + 1,
-                            stop=int(record.start) + 2,
-                            alt=str(alt_base)[1:],
-                            ref="",
-                            build=build,
-                        ): querynator_id
-                    }
+                coord_obj = civic.CoordinateQuery(
+                    chr=get_num_from_chr(record.CHROM),
+                    start=int(record.start) + 1,
+                    stop=int(record.start) + 2,
+                    alt=str(alt_base)[1:],
+                    ref="",
+                    build=build,
                 )
             # DELETION
             elif len(record.REF) > len(alt_base) and len(alt_base) == 1:
-                coord_dict.update(
-                    {
-                        civic.CoordinateQuery(
-                            chr=get_num_from_chr(record.CHROM),
-                            start=int(record.start) + 1,
-                            stop=int(record.end),
-                            alt="",
-                            ref=record.REF,
-                            build=build,
-                        ): querynator_id
-                    }
+                coord_obj = civic.CoordinateQuery(
+                    chr=get_num_from_chr(record.CHROM),
+                    start=int(record.start) + 1,
+                    stop=int(record.end),
+                    alt="",
+                    ref=record.REF,
+                    build=build,
                 )
             # SNPs, DelIns
             else:
-                coord_dict.update(
-                    {
-                        civic.CoordinateQuery(
-                            chr=get_num_from_chr(record.CHROM),
-                            start=int(record.start) + 1,
-                            stop=int(record.end),
-                            alt=str(alt_base),
-                            ref=record.REF,
-                            build=build,
-                        ): querynator_id
-                    }
+                coord_obj = civic.CoordinateQuery(
+                    chr=get_num_from_chr(record.CHROM),
+                    start=int(record.start) + 1,
+                    stop=int(record.end),
+                    alt=str(alt_base),
+                    ref=record.REF,
+                    build=build,
                 )
-
+            coord_dict[coord_obj] = querynator_id
+            if csq_schema is not None:
+                match_keys[coord_obj] = get_vep_match_keys(record, alt_base, csq_schema)
+
+    if locus_filter is not None:
+        logger.info(f"Skipped {n_skipped} of {n_records} vcf records outside of CIViC-curated loci")
+    if csq_schema is not None:
+        return coord_dict, match_keys
     return coord_dict
 
 
@@ -190,7 +297,137 @@ def smoothen_dict(dict, s):
     return dict
 
 
-def access_civic_by_coordinate(coord_dict, logger, build):
+# result columns of the CIViC information groups, in the order of civic_results.tsv
+CIVIC_FIELD_GROUPS = {
+    "variant": [
+        "variant_name",
+        "variant_aliases",
+        "variant_type",
+        "variant_clinvar_entries",
+        "variant_entrez_id",
+        "variant_entrez_name",
+        "variant_hgvs_expressions",
+        "variant_groups",
+    ],
+    "gene": ["gene_name", "gene_aliases", "gene_description", "gene_entrez_id", "gene_source"],
+    "mol_profile": ["mol_profile_name", "mol_profile_definition", "mol_profile_score"],
+    "assertion": [
+        "assertion_name",
+        "assertion_acmg_codes",
+        "assertion_acmg_codes_description",
+        "assertion_amp_level",
+        "assertion_direction",
+        "assertion_type",
+        "assertion_description",
+        "assertion_disease_name",
+        "assertion_disease_doid",
+        "assertion_disease_url",
+        "assertion_disease_aliases",
+        "assertion_phenotypes",
+        "assertion_significance",
+        "assertion_status",
+        "assertion_summary",
+        "assertion_therapies_name",
+        "assertion_therapies_ncit_id",
+        "assertion_therapies_aliases",
+        "assertion_therapies_interaction_type",
+        "assertion_variant_origin",
+    ],
+    "evidence": [
+        "evidence_name",
+        "evidence_description",
+        "evidence_disease",
+        "evidence_level",
+        "evidence_support",
+        "evidence_type",
+        "evidence_phenotypes",
+        "evidence_rating",
+        "evidence_significance",
+        "evidence_source",
+        "evidence_status",
+        "evidence_therapies",
+        "evidence_therapy_interaction_type",
+    ],
+}
+# IDs identifying an evidence item in civic_evidence.tsv, in front of the evidence columns
+CIVIC_EVIDENCE_ID_COLUMNS = ["variant_id", "mol_profile_id", "evidence_id"]
+# named column selections of --fields. "report" holds the columns read by create-report
+CIVIC_FIELD_PROFILES = {
+    "minimal": ["variant_name", "gene_name", "assertion_amp_level", "evidence_name", "evidence_level"],
+    "report": [
+        "variant_name",
+        "variant_type",
+        "variant_clinvar_entries",
+        "variant_entrez_id",
+        "variant_entrez_name",
+        "gene_name",
+        "gene_description",
+        "assertion_amp_level",
+        "assertion_disease_name",
+        "assertion_phenotypes",
+        "assertion_therapies_name",
+        "evidence_name",
+        "evidence_description",
+        "evidence_disease",
+        "evidence_level",
+        "evidence_support",
+        "evidence_type",
+        "evidence_phenotypes",
+        "evidence_significance",
+        "evidence_source",
+        "evidence_therapies",
+    ],
+    "full": [column for columns in CIVIC_FIELD_GROUPS.values() for column in columns],
+}
+
+
+def resolve_civic_fields(fields):
+    """
+    Resolve the CIViC result columns selected with --fields
+
+    :param fields: comma separated profile names (see CIVIC_FIELD_PROFILES), groups (see CIVIC_FIELD_GROUPS) or columns
+    :type fields: str
+    :return: selected columns in the order of civic_results.tsv, None if all columns are selected
+    :rtype: tuple
+    :raises ValueError: if a field is neither a profile, a group nor a column
+    """
+    all_columns = CIVIC_FIELD_PROFILES["full"]
+    selected = set()
+    for field in (fields or "full").split(","):
+        field = field.strip().lower()
+        if field in CIVIC_FIELD_PROFILES:
+            selected.update(CIVIC_FIELD_PROFILES[field])
+        elif field in CIVIC_FIELD_GROUPS:
+            selected.update(CIVIC_FIELD_GROUPS[field])
+        elif field in all_columns:
+            selected.add(field)
+        elif field:
+            raise ValueError(
+                f"Invalid CIViC field '{field}'. Please provide one of the profiles {', '.join(CIVIC_FIELD_PROFILES)}, "
+                f"one of the groups {', '.join(CIVIC_FIELD_GROUPS)} or a column of civic_results.tsv"
+            )
+    if not selected or len(selected) == len(all_columns):
+        return None
+    return tuple(column for column in all_columns if column in selected)
+
+
+def field_group_selected(fields, group):
+    """
+    Check if any column of an information group is selected
+
+    :param fields: selected columns as returned by resolve_civic_fields, None for all columns
+    :type fields: tuple
+    :param group: information group, one of CIVIC_FIELD_GROUPS
+    :type group: str
+    :return: True if the group has to be extracted
+    :rtype: bool
+    """
+    return fields is None or any(column in fields for column in CIVIC_FIELD_GROUPS[group])
+
+
+def access_civic_by_coordinate(
+    coord_dict, logger, build, snapshot=None, threads=1, match_mode="coordinate", match_keys=None
+):
     """
     Query CIViC API for individual variants
 
@@ -198,33 +435,44 @@ def access_civic_by_coordinate(coord_dict, logger, build):
     :type coord_list: list
     :param build: reference genome
     :type build: str
-    :return: CIViC variant objects of successfully queried variants
+    :param snapshot: CIViC snapshot or TSV release to search instead of the CIViCpy cache
+    :type snapshot: CivicSnapshot or CivicTsvRelease
+    :param threads: number of concurrent allele registry requests
+    :type threads: int
+    :param match_mode: how variants are matched, one of CIVIC_MATCH_MODES
+    :type match_mode: str
+    :param match_keys: VEP lookup keys of the queries as returned by get_coordinates_from_vcf, required unless
+        match_mode is coordinate
+    :type match_keys: dict
+    :return: CIViC variant objects of successfully queried variants and how they were matched
     :rtype: list
     """
+    hits = {}
+    if match_mode != "hgvs":
+        if snapshot is not None:
+            coordinate_hits = snapshot.bulk_search(coord_dict.keys(), build, logger, threads)
+        elif build == "GRCh37":
+            # all lookups are resolved in a single batched pass over the local coordinate index
+            coordinate_hits = get_coordinate_index(build).bulk_search(coord_dict.keys(), search_mode="exact")
+        else:
+            # CIViC curates coordinates on GRCh37, variants of other builds are matched via their allele registry ID.
+            # the IDs of all variants are resolved in bulk, so only the hits have to be looked up
+            coordinate_hits = bulk_search_by_allele_registry(coord_dict.keys(), logger, threads=threads)
+        hits = {coord_obj: (variants, "coordinate") for coord_obj, variants in coordinate_hits.items()}
+
+    if match_mode != "coordinate":
+        # variants without coordinate hit are looked up by the HGVS expressions and protein changes of VEP
+        unmatched = {coord_obj: match_keys.get(coord_obj, []) for coord_obj in coord_dict if coord_obj not in hits}
+        if snapshot is not None:
+            hits.update(snapshot.protein_search(unmatched))
+        else:
+            hits.update(get_protein_index().bulk_search(unmatched))
 
-    # bulk search to quickly focus on variants found in the civic-db
-    # time-intensive search must then only be done for variants that will be hits
-    # only possible for GRCh37 ref genome
-    if build == "GRCh37":
-        bulk = civic.bulk_search_variants_by_coordinates(list(coord_dict.keys()), search_mode="exact")
-        # reconnect coordinates that passed bulk search and respective IDs
-        input_dict = {key: coord_dict[key] for key in bulk}
-    else:
-        input_dict = coord_dict
-
-    # actual search for each variant
     variant_list = []
-    for coord_obj, querynator_id in input_dict.items():
-        variant = civic.search_variants_by_coordinates(coord_obj, search_mode="exact")
-
-        if variant != None and len(variant) > 0:
-            for variant_obj in variant:
-                variant_list.append([{coord_obj: querynator_id}, [variant_obj]])
-
-    # break if no variants are found
-    if variant_list == None:
-        logger.error("No hits are found in CIViC for this vcf file")
-        exit(1)
+    for coord_obj, querynator_id in coord_dict.items():
+        variants, match_type = hits.get(coord_obj, ([], None))
+        for variant_obj in variants:
+            variant_list.append([{coord_obj: querynator_id}, [variant_obj], match_type])
 
     return variant_list
 
@@ -295,6 +543,24 @@ def get_gene_information_from_variant(variant_obj):
     }
 
 
+def get_assertion_diseases(assertion):
+    """
+    Get the diseases of a CIViC assertion object as list.
+    CIViCpy objects hold a single disease object, an empty dict if there is none.
+    Snapshot and TSV release records hold the disease record in the same way
+
+    :param assertion: CIViC assertion object
+    :type assertion: civicpy.Assertion
+    :return: disease objects of the assertion
+    :rtype: list
+    """
+    disease = assertion.disease
+    if isinstance(disease, (list, tuple)):
+        return list(disease)
+    # CIViCpy's disease objects are empty dictionaries, so they can not be checked for truthiness
+    return [disease] if hasattr(disease, "name") else []
+
+
 def get_assertion_information_from_variant(variant_obj):
     """
     Get all assertion information from a single CIViC variant object
@@ -328,6 +594,7 @@ def get_assertion_information_from_variant(variant_obj):
     }
     for mol_prof in variant_obj.molecular_profiles:
         for assertion in mol_prof.assertions:
+            assertion_diseases = get_assertion_diseases(assertion)
             try:
                 new_dict = {
                     "assertion_name": assertion.name,
@@ -337,10 +604,10 @@ def get_assertion_information_from_variant(variant_obj):
                     "assertion_direction": assertion.assertion_direction,
                     "assertion_type": assertion.assertion_type,
                     "assertion_description": assertion.description,
-                    "assertion_disease_name": ", ".join([i.name for i in assertion.disease]),
-                    "assertion_disease_doid": ", ".join([i.doid for i in assertion.disease]),
-                    "assertion_disease_url": ", ".join([i.disease_url for i in assertion.disease]),
-                    "assertion_disease_aliases": ", ".join([i.aliases for i in assertion.disease]),
+                    "assertion_disease_name": ", ".join([i.name for i in assertion_diseases]),
+                    "assertion_disease_doid": ", ".join([i.doid for i in assertion_diseases]),
+                    "assertion_disease_url": ", ".join([i.disease_url for i in assertion_diseases]),
+                    "assertion_disease_aliases": ", ".join([", ".join(i.aliases) for i in assertion_diseases]),
                     "assertion_phenotypes": ", ".join([i.name for i in assertion.phenotypes]),
                     "assertion_significance": assertion.significance,
                     "assertion_status": assertion.status,
@@ -378,39 +645,24 @@ def get_assertion_information_from_variant(variant_obj):
     return smoothen_dict(assertion_dict, False)
 
 
-def get_evidence_information_from_variant(variant_obj, diseases, evidence_filters):
+def get_evidence_items_from_variant(variant_obj, diseases, evidence_filters):
     """
-    Get all evidence from a single CIViC variant object
+    Get the single evidence items of a CIViC variant object that pass the evidence filters
 
     :param variant_obj: single CIViC variant object
     :type variant_ob: CIViC variant object
-    :param diseases: the patients cancer type as Disease Ontology Name or id and a list of allowed diseases that will count as matches
-    :type diseases: tuple (Ontology.Term, list)
+    :param diseases: the patients cancer type as Disease Ontology Name or id and the names and DOIDs of allowed diseases that will count as matches
+    :type diseases: tuple (Ontology.Term, frozenset)
     :param evidence_filters: evidence filters
     :type evidence_filters: dict
-    :return: Evidence information for respective CIViC variant object
-    :rtype: dict
+    :return: Evidence information and the variant, molecular profile and evidence IDs, one dictionary per evidence item
+    :rtype: list
     """
-
-    evidence_dict = {
-        "evidence_name": "",
-        "evidence_description": "",
-        "evidence_disease": "",
-        "evidence_level": "",
-        "evidence_support": "",
-        "evidence_type": "",
-        "evidence_phenotypes": "",
-        "evidence_rating": "",
-        "evidence_significance": "",
-        "evidence_source": "",
-        "evidence_status": "",
-        "evidence_therapies": "",
-        "evidence_therapy_interaction_type": "",
-    }
-
+    evidence_items = []
+    passes_filters = compile_evidence_filter(evidence_filters)
     for mol_prof in variant_obj.molecular_profiles:
         for evidence in mol_prof.evidence:
-            if filter_evidence(evidence, evidence_filters):
+            if passes_filters(evidence):
                 try:
                     # evidence = variant_obj.molecular_profiles[0].evidence[0]
                     new_dict = {
@@ -429,25 +681,16 @@ def get_evidence_information_from_variant(variant_obj, diseases, evidence_filter
                         "evidence_therapy_interaction_type": evidence.therapy_interaction_type,
                     }
                 except IndexError:
-                    new_dict = {
-                        "evidence_name": np.nan,
-                        "evidence_description": np.nan,
-                        "evidence_disease": np.nan,
-                        "evidence_level": np.nan,
-                        "evidence_support": np.nan,
-                        "evidence_type": np.nan,
-                        "evidence_phenotypes": np.nan,
-                        "evidence_rating": np.nan,
-                        "evidence_significance": np.nan,
-                        "evidence_source": np.nan,
-                        "evidence_status": np.nan,
-                        "evidence_therapies": np.nan,
-                        "evidence_therapy_interaction_type": np.nan,
-                    }
+                    new_dict = {column: np.nan for column in CIVIC_FIELD_GROUPS["evidence"]}
 
                 # check special rules for evidences and cancer types
                 disease, allowed_diseases = diseases
-                if disease and allowed_diseases and evidence.disease and evidence.disease.name not in allowed_diseases:
+                if (
+                    disease
+                    and allowed_diseases
+                    and evidence.disease
+                    and not disease_is_allowed(evidence.disease, allowed_diseases)
+                ):
                     if evidence.evidence_level == "A":
                         # AMP/ASCO/CAT: level A evidence for other tumor is level C for this tumor
                         new_dict["evidence_level"] = "C"
@@ -456,42 +699,145 @@ def get_evidence_information_from_variant(variant_obj, diseases, evidence_filter
                         # evidence item is irrelevant for this tumor
                         continue
 
-                evidence_dict = append_to_dict(evidence_dict, new_dict)
+                evidence_items.append(
+                    {
+                        "variant_id": variant_obj.id,
+                        "mol_profile_id": mol_prof.id,
+                        "evidence_id": evidence.id,
+                        **new_dict,
+                    }
+                )
+    return evidence_items
+
 
+def get_evidence_information_from_items(evidence_items):
+    """
+    Join the evidence items of a CIViC variant object to the evidence columns of civic_results.tsv
+
+    :param evidence_items: evidence items as returned by get_evidence_items_from_variant
+    :type evidence_items: list
+    :return: Evidence information for respective CIViC variant object
+    :rtype: dict
+    """
+    evidence_dict = {column: "" for column in CIVIC_FIELD_GROUPS["evidence"]}
+    for evidence_item in evidence_items:
+        evidence_dict = append_to_dict(evidence_dict, {column: evidence_item[column] for column in evidence_dict})
     return smoothen_dict(evidence_dict, True)
 
 
-def filter_evidence(evidence, filters) -> bool:
-    """Check if the evidence item is relevant and passes the filters
+def get_evidence_information_from_variant(variant_obj, diseases, evidence_filters):
+    """
+    Get all evidence from a single CIViC variant object
+
+    :param variant_obj: single CIViC variant object
+    :type variant_ob: CIViC variant object
+    :param diseases: the patients cancer type as Disease Ontology Name or id and the names and DOIDs of allowed diseases that will count as matches
+    :type diseases: tuple (Ontology.Term, frozenset)
+    :param evidence_filters: evidence filters
+    :type evidence_filters: dict
+    :return: Evidence information for respective CIViC variant object
+    :rtype: dict
+    """
+    return get_evidence_information_from_items(get_evidence_items_from_variant(variant_obj, diseases, evidence_filters))
+
+
+def get_allowed_disease_keys(terms):
+    """
+    Create the lookup set of the diseases an evidence item may be annotated with
+
+    :param terms: allowed Disease Ontology terms
+    :type terms: list
+    :return: lower case DOIDs ("doid:1909") and names of the terms
+    :rtype: frozenset
+    """
+    keys = set()
+    for term in terms:
+        keys.add(term.id.lower())
+        if term.get("name"):
+            keys.add(term.get("name").lower())
+    return frozenset(keys)
+
+
+def disease_is_allowed(evidence_disease, allowed_diseases):
+    """
+    Check if the disease of an evidence item is one of the allowed diseases
+
+    :param evidence_disease: disease of a CIViC evidence object
+    :type evidence_disease: civicpy.Disease
+    :param allowed_diseases: allowed disease keys as returned by get_allowed_disease_keys
+    :type allowed_diseases: frozenset
+    :return: True if the name or DOID of the disease is allowed
+    :rtype: bool
+    """
+    if (evidence_disease.name or "").lower() in allowed_diseases:
+        return True
+    doid = getattr(evidence_disease, "doid", None)
+    return bool(doid) and f"doid:{doid}".lower() in allowed_diseases
+
+
+# evidence attributes checked by the evidence filters, the level is compared separately
+EVIDENCE_FILTER_ATTRIBUTES = {
+    "type": "evidence_type",
+    "significance": "significance",
+    "rating": "rating",
+    "status": "status",
+    "direction": "evidence_direction",
+}
+
+
+def freeze_evidence_filters(filters):
+    """
+    Turn evidence filters into a hashable key
 
-    :param evidence: CIViC evidence object
-    :type evidence: civicpy.evidence.Evidence
     :param filters: dict of property:[accepted-values] pairs to filter the evidence items
     :type filters: dict
-    :return: True if the evidence item passes the filters, False otherwise
-    :rtype: bool
+    :return: sorted (property, accepted-values) pairs
+    :rtype: tuple
+    """
+    return tuple(sorted((prop, tuple(values)) for prop, values in filters.items()))
+
+
+@lru_cache(maxsize=None)
+def compile_frozen_evidence_filter(frozen_filters):
     """
-    for prop, values in filters.items():
-        if prop == "level".casefold():
-            if evidence.evidence_level.casefold() > min(values):
-                # lower level has higher char value A < B < C
-                return False
-        elif prop == "type".casefold():
-            if evidence.evidence_type.casefold() not in values:
-                return False
-        elif prop == "significance".casefold():
-            if evidence.significance.casefold() not in values:
-                return False
-        elif prop == "rating".casefold():
-            if evidence.rating.casefold() not in values:
-                return False
-        elif prop == "status".casefold():
-            if evidence.status.casefold() not in values:
-                return False
-        elif prop == "direction".casefold():
-            if evidence.evidence_direction.casefold() not in values:
-                return False
-    return True
+    Compile frozen evidence filters into a single predicate
+
+    :param frozen_filters: evidence filters as returned by freeze_evidence_filters
+    :type frozen_filters: tuple
+    :return: predicate returning True if an evidence item passes the filters
+    :rtype: function
+    """
+    checks = []
+    for prop, values in frozen_filters:
+        if prop == "level":
+            # lower level has higher char value A < B < C
+            max_level = min(values)
+            checks.append(lambda evidence, max_level=max_level: evidence.evidence_level.casefold() <= max_level)
+        elif prop in EVIDENCE_FILTER_ATTRIBUTES:
+            attribute, accepted = EVIDENCE_FILTER_ATTRIBUTES[prop], frozenset(values)
+            # str() as CIViCpy returns the rating as int
+            checks.append(
+                lambda evidence, attribute=attribute, accepted=accepted: str(getattr(evidence, attribute)).casefold()
+                in accepted
+            )
+
+    if not checks:
+        return lambda evidence: True
+    if len(checks) == 1:
+        return checks[0]
+    return lambda evidence: all(check(evidence) for check in checks)
+
+
+def compile_evidence_filter(filters):
+    """
+    Compile evidence filters into a single predicate, each set of filters is only compiled once
+
+    :param filters: dict of property:[accepted-values] pairs to filter the evidence items
+    :type filters: dict
+    :return: predicate returning True if an evidence item passes the filters
+    :rtype: function
+    """
+    return compile_frozen_evidence_filter(freeze_evidence_filters(filters))
 
 
 def get_positional_information_from_coord_obj(coord_obj):
@@ -518,85 +864,625 @@ def get_querynator_id(querynator_id):
     return {"querynator_id": querynator_id}
 
 
-def concat_dicts(coord_id_dict, variant_obj, diseases, filter_vep, evidence_filters):
+class ExtractionMemo:
     """
-    Create and combine different dictionaries created for single CIViC variant object
+    Per-run memo of the information extracted from CIViC objects.
+
+    Variant, molecular profile and assertion information is keyed by the CIViC variant ID,
+    gene information by the CIViC gene ID and evidence information additionally by the
+    queried disease and the evidence filters. The memoized dictionaries must not be modified.
+    The memo can be shared by worker threads.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.hits = Counter()
+        self.misses = Counter()
+        self.lock = threading.Lock()
+
+    def get(self, group, key, func, *args):
+        """
+        Get the memoized information of an object, extract it on first use
+
+        :param group: kind of information, e.g. "variant" or "gene"
+        :type group: str
+        :param key: hashable ID of the object within the group
+        :type key: any
+        :param func: function extracting the information
+        :type func: function
+        :param args: arguments passed to func
+        :return: extracted information
+        :rtype: dict
+        """
+        try:
+            value = self.entries[(group, key)]
+        except KeyError:
+            # extracted outside the lock, concurrent misses of the same object keep the first result
+            value = func(*args)
+            with self.lock:
+                value = self.entries.setdefault((group, key), value)
+                self.misses[group] += 1
+        else:
+            with self.lock:
+                self.hits[group] += 1
+        return value
+
+    def log_stats(self, logger):
+        """
+        Log the number of memo hits and misses per kind of information
+
+        :param logger: logger of the run
+        :type logger: logging.Logger
+        :return: None
+        """
+        for group in self.misses:
+            logger.info(f"CIViC {group} information memo: {self.hits[group]} hits, {self.misses[group]} misses")
+
+
+def evidence_memo_key(variant_obj, diseases, evidence_filters):
+    """
+    Create the memo key of the evidence information of a CIViC variant object
 
-    :param coord_obj: CoordinateQuery Object to respective variant object
-    :type coord_obj: CIViC CoordinateQuery Object
     :param variant_obj: single CIViC variant object
     :type variant_ob: CIViC variant object
-    :param diseases: the patients cancer type as Disease Ontology Name or id and a list of allowed diseases that will count as matches
-    :type diseases: tuple (Ontology.Term, list)
-    :param filter_vep: flag whether VEP based filtering should be performed
-    :type filter_vep: bool
+    :param diseases: the patients cancer type as Disease Ontology Name or id and the names and DOIDs of allowed diseases that will count as matches
+    :type diseases: tuple (Ontology.Term, frozenset)
     :param evidence_filters: evidence filters
     :type evidence_filters: dict
-    :return: All information for respective CIViC variant object
+    :return: hashable key
+    :rtype: tuple
+    """
+    return variant_obj.id, diseases[0], freeze_evidence_filters(evidence_filters)
+
+
+def get_memoized_evidence_items(variant, diseases, evidence_filters, memo):
+    """
+    Get the evidence items of a single CIViC variant object, extracted once per run
+
+    :param variant: single CIViC variant object
+    :type variant: CIViC variant object
+    :param diseases: the patients cancer type as Disease Ontology Name or id and the names and DOIDs of allowed diseases that will count as matches
+    :type diseases: tuple (Ontology.Term, frozenset)
+    :param evidence_filters: evidence filters
+    :type evidence_filters: dict
+    :param memo: memo of already extracted information, shared by all variants of a run
+    :type memo: ExtractionMemo
+    :return: evidence items as returned by get_evidence_items_from_variant
+    :rtype: list
+    """
+    return memo.get(
+        "evidence items",
+        evidence_memo_key(variant, diseases, evidence_filters),
+        get_evidence_items_from_variant,
+        variant,
+        diseases,
+        evidence_filters,
+    )
+
+
+def get_annotation_information_from_variant(variant, diseases, evidence_filters, memo, fields=None):
+    """
+    Get all information of a single CIViC variant object that does not depend on the queried coordinates
+
+    :param variant: single CIViC variant object
+    :type variant: CIViC variant object
+    :param diseases: the patients cancer type as Disease Ontology Name or id and the names and DOIDs of allowed diseases that will count as matches
+    :type diseases: tuple (Ontology.Term, frozenset)
+    :param evidence_filters: evidence filters
+    :type evidence_filters: dict
+    :param memo: memo of already extracted information, shared by all variants of a run
+    :type memo: ExtractionMemo
+    :param fields: columns to extract as returned by resolve_civic_fields, None for all columns
+    :type fields: tuple
+    :return: variant, gene, molecular profile, assertion and evidence information
     :rtype: dict
     """
-    coordinates_info = get_positional_information_from_coord_obj(list(coord_id_dict.keys())[0])
-    variant_info = get_variant_information_from_variant(variant_obj[0])
-    gene_info = get_gene_information_from_variant(variant_obj[0])
-    mol_profile_info = get_molecular_profile_information_from_variant(variant_obj[0])
-    assertion_info = get_assertion_information_from_variant(variant_obj[0])
-    evidence_info = get_evidence_information_from_variant(variant_obj[0], diseases, evidence_filters)
+    # groups without selected column are not extracted at all
+    annotation_info = {}
+    if field_group_selected(fields, "variant"):
+        annotation_info.update(memo.get("variant", variant.id, get_variant_information_from_variant, variant))
+    if field_group_selected(fields, "gene"):
+        annotation_info.update(memo.get("gene", variant.gene_id, get_gene_information_from_variant, variant))
+    if field_group_selected(fields, "mol_profile"):
+        annotation_info.update(
+            memo.get("molecular profile", variant.id, get_molecular_profile_information_from_variant, variant)
+        )
+    if field_group_selected(fields, "assertion"):
+        annotation_info.update(memo.get("assertion", variant.id, get_assertion_information_from_variant, variant))
+    if field_group_selected(fields, "evidence"):
+        evidence_items = get_memoized_evidence_items(variant, diseases, evidence_filters, memo)
+        evidence_key = evidence_memo_key(variant, diseases, evidence_filters)
+        annotation_info.update(memo.get("evidence", evidence_key, get_evidence_information_from_items, evidence_items))
+    if fields is None:
+        return annotation_info
+    return {column: annotation_info[column] for column in fields}
+
+
+def create_row(coord_obj, querynator_id, annotation_info, filter_vep, match_type=None):
+    """
+    Combine the queried coordinates with the information of a CIViC variant object to a result row
+
+    :param coord_obj: queried coordinates
+    :type coord_obj: CIViC CoordinateQuery Object
+    :param querynator_id: querynator ID of the queried variant
+    :type querynator_id: int
+    :param annotation_info: information of the CIViC variant object
+    :type annotation_info: dict
+    :param filter_vep: flag whether VEP based filtering should be performed
+    :type filter_vep: bool
+    :param match_type: how the CIViC variant was matched, no match_type column if None
+    :type match_type: str
+    :return: result row
+    :rtype: dict
+    """
+    row = get_positional_information_from_coord_obj(coord_obj)
     if filter_vep:
-        querynator_id_info = get_querynator_id(coord_id_dict[list(coord_id_dict.keys())[0]])
-        return {
+        row.update(get_querynator_id(querynator_id))
+    if match_type is not None:
+        row["match_type"] = match_type
+    row.update(annotation_info)
+    return row
+
+
+def create_evidence_rows(coord_obj, querynator_id, evidence_items, fields=None):
+    """
+    Create the rows of civic_evidence.tsv for the evidence items of a CIViC variant object.
+    The querynator ID is always written, unlike in civic_results.tsv where it requires filter_vep,
+    so both tables share the coordinate columns to be joined on
+
+    :param coord_obj: queried coordinates
+    :type coord_obj: CIViC CoordinateQuery Object
+    :param querynator_id: querynator ID of the queried variant
+    :type querynator_id: int
+    :param evidence_items: evidence items as returned by get_evidence_items_from_variant
+    :type evidence_items: list
+    :param fields: evidence columns to write as returned by resolve_civic_fields, None for all columns
+    :type fields: tuple
+    :return: one row per evidence item
+    :rtype: list
+    """
+    coordinates_info = {**get_querynator_id(querynator_id), **get_positional_information_from_coord_obj(coord_obj)}
+    return [
+        {
             **coordinates_info,
-            **querynator_id_info,
-            **variant_info,
-            **gene_info,
-            **mol_profile_info,
-            **assertion_info,
-            **evidence_info,
+            **{column: evidence_item[column] for column in CIVIC_EVIDENCE_ID_COLUMNS},
+            **{
+                column: evidence_item[column]
+                for column in CIVIC_FIELD_GROUPS["evidence"]
+                if fields is None or column in fields
+            },
         }
-    else:
-        return {**coordinates_info, **variant_info, **gene_info, **mol_profile_info, **assertion_info, **evidence_info}
+        for evidence_item in evidence_items
+    ]
+
+
+def get_civic_result(
+    coord_id_dict, variant_obj, diseases, filter_vep, evidence_filters, memo, fields=None, match_type=None
+):
+    """
+    Create the result row and the evidence rows of a single CIViC variant object
+
+    :param coord_id_dict: CoordinateQuery Object to respective variant object and its querynator ID
+    :type coord_id_dict: dict
+    :param variant_obj: single CIViC variant object
+    :type variant_ob: CIViC variant object
+    :param diseases: the patients cancer type as Disease Ontology Name or id and the names and DOIDs of allowed diseases that will count as matches
+    :type diseases: tuple (Ontology.Term, frozenset)
+    :param filter_vep: flag whether VEP based filtering should be performed
+    :type filter_vep: bool
+    :param evidence_filters: evidence filters
+    :type evidence_filters: dict
+    :param memo: memo of already extracted information, shared by all variants of a run
+    :type memo: ExtractionMemo
+    :param fields: columns to extract as returned by resolve_civic_fields, None for all columns
+    :type fields: tuple
+    :param match_type: how the CIViC variant was matched, no match_type column if None
+    :type match_type: str
+    :return: row of civic_results.tsv and rows of civic_evidence.tsv, no evidence rows if no evidence column is selected
+    :rtype: tuple (dict, list)
+    """
+    coord_obj = list(coord_id_dict.keys())[0]
+    querynator_id = coord_id_dict[coord_obj]
+    annotation_info = get_annotation_information_from_variant(variant_obj[0], diseases, evidence_filters, memo, fields)
+    evidence_items = []
+    if field_group_selected(fields, "evidence"):
+        evidence_items = get_memoized_evidence_items(variant_obj[0], diseases, evidence_filters, memo)
+    return (
+        create_row(coord_obj, querynator_id, annotation_info, filter_vep, match_type),
+        create_evidence_rows(coord_obj, querynator_id, evidence_items, fields),
+    )
+
+
+def cached_civic_rows(
+    coord_dict,
+    variant_list,
+    disease,
+    diseases,
+    filter_vep,
+    evidence_filters,
+    memo,
+    result_cache,
+    cached_results,
+    threads=1,
+    fields=None,
+    match_mode="coordinate",
+    match_keys=None,
+):
+    """
+    Create the result rows of all queried variants, reusing and filling the CIViC result cache
+
+    :param coord_dict: querynator IDs of all queried variants, keyed by their coordinates
+    :type coord_dict: dict
+    :param variant_list: List of CIViC variant objects of the queried variants that were not cached
+    :type variant_list: list
+    :param disease: the patients cancer type as given by the user
+    :type disease: str
+    :param diseases: the mapped cancer type and the names and DOIDs of allowed diseases that will count as matches
+    :type diseases: tuple (Ontology.Term, frozenset)
+    :param filter_vep: flag whether VEP based filtering should be performed
+    :type filter_vep: bool
+    :param evidence_filters: evidence filters
+    :type evidence_filters: dict
+    :param memo: memo of already extracted information, shared by all variants of a run
+    :type memo: ExtractionMemo
+    :param result_cache: CIViC result cache
+    :type result_cache: CivicResultCache
+    :param cached_results: cached annotations as read by read_cached_results. The cache is not read again, so entries
+        evicted in the meantime are still used instead of being reported and cached without hit
+    :type cached_results: dict
+    :param threads: number of worker threads extracting the information of variants that were not cached
+    :type threads: int
+    :param fields: columns to extract as returned by resolve_civic_fields, None for all columns
+    :type fields: tuple
+    :param match_mode: how variants were matched, one of CIVIC_MATCH_MODES
+    :type match_mode: str
+    :param match_keys: VEP lookup keys of the queries as returned by get_coordinates_from_vcf
+    :type match_keys: dict
+    :return: rows of civic_results.tsv and civic_evidence.tsv per CIViC variant object, in the order of coord_dict
+    :rtype: generator
+    """
+    hits = defaultdict(list)
+    for hit in variant_list:
+        hits[list(hit[0].keys())[0]].append((hit[1][0], hit[2] if len(hit) > 2 else "coordinate"))
+
+    frozen_filters = freeze_evidence_filters(evidence_filters)
+    keys = {
+        coord_obj: result_cache.key(
+            coord_obj, disease, frozen_filters, fields, get_cache_match(coord_obj, match_mode, match_keys)
+        )
+        for coord_obj in coord_dict
+    }
+
+    with_evidence = field_group_selected(fields, "evidence")
+
+    def annotate(coord_obj):
+        if keys[coord_obj] in cached_results:
+            return cached_results[keys[coord_obj]]
+        return [
+            [
+                get_annotation_information_from_variant(variant, diseases, evidence_filters, memo, fields),
+                get_memoized_evidence_items(variant, diseases, evidence_filters, memo) if with_evidence else [],
+                match_type,
+            ]
+            for variant, match_type in hits[coord_obj]
+        ]
+
+    new_entries = {}
+    for (coord_obj, querynator_id), annotations in zip(coord_dict.items(), ordered_map(annotate, coord_dict, threads)):
+        if keys[coord_obj] not in cached_results:
+            # variants without hit are cached as well
+            new_entries[keys[coord_obj]] = annotations
+        for annotation_info, evidence_items, match_type in annotations:
+            yield (
+                create_row(
+                    coord_obj,
+                    querynator_id,
+                    annotation_info,
+                    filter_vep,
+                    match_type if match_mode != "coordinate" else None,
+                ),
+                create_evidence_rows(coord_obj, querynator_id, evidence_items, fields),
+            )
+    result_cache.put_many(new_entries)
+
+
+def read_cached_results(
+    result_cache, coord_dict, disease, evidence_filters, fields=None, match_mode="coordinate", match_keys=None
+):
+    """
+    Read the cached annotations of all queried variants and cancer types at once
+
+    :param result_cache: CIViC result cache
+    :type result_cache: CivicResultCache
+    :param coord_dict: querynator IDs of all queried variants, keyed by their coordinates
+    :type coord_dict: dict
+    :param disease: the patients cancer type(s) as Disease Ontology Name
+    :type disease: str or list
+    :param evidence_filters: evidence filters
+    :type evidence_filters: dict
+    :param fields: columns to extract as returned by resolve_civic_fields, None for all columns
+    :type fields: tuple
+    :param match_mode: how variants are matched, one of CIVIC_MATCH_MODES
+    :type match_mode: str
+    :param match_keys: VEP lookup keys of the queries as returned by get_coordinates_from_vcf
+    :type match_keys: dict
+    :return: cached annotations keyed by cache key and the coordinates cached for every cancer type
+    :rtype: tuple (dict, set)
+    """
+    frozen_filters = freeze_evidence_filters(evidence_filters)
+    keys = {
+        coord_obj: [
+            result_cache.key(coord_obj, i, frozen_filters, fields, get_cache_match(coord_obj, match_mode, match_keys))
+            for i in get_disease_list(disease) or [None]
+        ]
+        for coord_obj in coord_dict
+    }
+    cached_results = result_cache.get_many(key for coord_keys in keys.values() for key in coord_keys)
+    fully_cached = {coord_obj for coord_obj in coord_dict if all(key in cached_results for key in keys[coord_obj])}
+    return cached_results, fully_cached
+
+
+def get_cache_match(coord_obj, match_mode, match_keys):
+    """
+    Get the part of the result cache key describing how a query is matched
+
+    :param coord_obj: queried coordinates
+    :type coord_obj: CIViC CoordinateQuery Object
+    :param match_mode: how variants are matched, one of CIVIC_MATCH_MODES
+    :type match_mode: str
+    :param match_keys: VEP lookup keys of the queries as returned by get_coordinates_from_vcf
+    :type match_keys: dict
+    :return: None for coordinate matching, otherwise the match mode and the VEP lookup keys of the query
+    :rtype: list
+    """
+    if match_mode == "coordinate":
+        return None
+    return [match_mode, match_keys.get(coord_obj, [])]
+
+
+def map_disease(doid, disease, logger):
+    """
+    Map a cancer type to the Disease Ontology and collect the diseases that count as matches
+
+    :param doid: the Disease Ontology
+    :type doid: ontology.DiseaseOntology
+    :param disease: the patients cancer type as Disease Ontology Name or id
+    :type disease: str
+    :return: the Disease Ontology term and the names and DOIDs of allowed diseases
+    :rtype: tuple (Ontology.Term, frozenset)
+    """
+    # names and DOIDs of the allowed diseases are looked up in a set for every evidence item
+    diseases = doid.get(disease), get_allowed_disease_keys(doid.get_all_ancestors(disease))
+    logger.info(f"Mapped specified disease {disease} to Disease Ontology (DO) {str(diseases[0])}")
+    return diseases
+
+
+def get_disease_label(disease, term):
+    """
+    Create the label of a cancer type used in result file names
+
+    :param disease: the patients cancer type as Disease Ontology Name or id
+    :type disease: str
+    :param term: the Disease Ontology term of the cancer type
+    :type term: Ontology.Term
+    :return: e.g. DOID_1909
+    :rtype: str
+    """
+    label = term.id if term else disease
+    return re.sub(r"[^A-Za-z0-9.-]+", "_", label)
 
 
-def create_civic_results(variant_list, out_path, disease, logger, filter_vep, evidence_filters):
+def get_disease_list(disease):
+    """
+    Get the given cancer types as list
+
+    :param disease: the patients cancer type(s) as Disease Ontology Name
+    :type disease: str or list
+    :return: cancer types, empty if none is given
+    :rtype: list
+    """
+    if isinstance(disease, (list, tuple)):
+        return [i for i in disease if i]
+    return [disease] if disease else []
+
+
+def create_civic_results(
+    variant_list,
+    out_path,
+    disease,
+    logger,
+    filter_vep,
+    evidence_filters,
+    threads=1,
+    result_cache=None,
+    coord_dict=None,
+    fields=None,
+    match_mode="coordinate",
+    match_keys=None,
+    cached_results=None,
+):
     """
     Combine result dictionaries of all CIViC variant objects
-    to a table and write it to user-specified file
+    to a table and write it to user-specified file.
+    If several cancer types are given, one table per cancer type is written,
+    sharing the extracted variant, gene, molecular profile and assertion information
 
     :param variant_list: List of CIViC variant objects of successfully queried variants
     :type  variant_list: list
     :param out_path: Name for directory in which result-table will be stored
     :type  out_path: str
-    :param disease: the patients cancer type as Disease Ontology Name
-    :type  disease: str
+    :param disease: the patients cancer type(s) as Disease Ontology Name
+    :type  disease: str or list
     :param filter_vep: flag whether VEP based filtering should be performed
     :type  filter_vep: bool
     :param evidence_filters: evidence filters
     :type  evidence_filters: dict
+    :param threads: number of worker threads creating the result rows
+    :type  threads: int
+    :param result_cache: CIViC result cache, holding the information of earlier queried variants
+    :type  result_cache: CivicResultCache
+    :param coord_dict: querynator IDs of all queried variants keyed by their coordinates, required with result_cache
+    :type  coord_dict: dict
+    :param fields: columns to write as returned by resolve_civic_fields, None for all columns
+    :type  fields: tuple
+    :param match_mode: how variants were matched, one of CIVIC_MATCH_MODES. Adds a match_type column unless coordinate
+    :type  match_mode: str
+    :param match_keys: VEP lookup keys of the queries as returned by get_coordinates_from_vcf
+    :type  match_keys: dict
+    :param cached_results: cached annotations as returned by read_cached_results, read from result_cache if None
+    :type  cached_results: dict
     :return: None
     :rtype: None
     """
-    civic_result_df = pd.DataFrame()
-
-    if disease:
+    disease_list = get_disease_list(disease)
+    if result_cache is not None and cached_results is None:
+        cached_results = read_cached_results(
+            result_cache, coord_dict, disease, evidence_filters, fields, match_mode, match_keys
+        )[0]
+    if disease_list:
         proj_root = dirname(dirname(abspath(__file__)))
         doid_file = os.path.join(proj_root, "helper_functions/doid.obo")
         doid = ontology.DiseaseOntology(doid_file)
-        diseases = doid.get(disease), doid.get_all_ancestors(disease)
-        logger.info(f"Mapped specified disease {disease} to Disease Ontology (DO) {str(diseases[0])}")
-    else:
-        diseases = None, None
-
-    for coord_id_dict, variant in variant_list:
-        civic_result_df = civic_result_df.append(
-            concat_dicts(coord_id_dict, variant, diseases, filter_vep, evidence_filters), ignore_index=True
-        )
 
     logger.info("CIViC Query finished")
     logger.info("Creating Results")
-    try:
-        civic_result_df.to_csv(f"{out_path}/{os.path.basename(out_path)}.civic_results.tsv", sep="\t", index=False)
-    except OSError:
-        os.makedirs(out_path)
-        civic_result_df.to_csv(f"{out_path}/{os.path.basename(out_path)}.civic_results.tsv", sep="\t", index=False)
+    os.makedirs(out_path, exist_ok=True)
+    basename = os.path.basename(out_path)
+    memo = ExtractionMemo()
+
+    def write_results(disease, diseases, out_file, evidence_file):
+        # rows are built lazily, in input order, and streamed to the result tables one by one
+        if result_cache is not None:
+            rows = cached_civic_rows(
+                coord_dict,
+                variant_list,
+                disease,
+                diseases,
+                filter_vep,
+                evidence_filters,
+                memo,
+                result_cache,
+                cached_results,
+                threads,
+                fields,
+                match_mode,
+                match_keys,
+            )
+        else:
+            rows = ordered_map(
+                lambda hit: get_civic_result(
+                    hit[0],
+                    hit[1],
+                    diseases,
+                    filter_vep,
+                    evidence_filters,
+                    memo,
+                    fields,
+                    hit[2] if match_mode != "coordinate" else None,
+                ),
+                variant_list,
+                threads,
+            )
+        write_civic_tables(rows, out_file, evidence_file, fields)
+
+    # the evidence table is only written if evidence information is extracted
+    evidence_table = field_group_selected(fields, "evidence")
+    if len(disease_list) <= 1:
+        disease = disease_list[0] if disease_list else None
+        diseases = map_disease(doid, disease, logger) if disease else (None, None)
+        write_results(
+            disease,
+            diseases,
+            f"{out_path}/{basename}.civic_results.tsv",
+            f"{out_path}/{basename}.civic_evidence.tsv" if evidence_table else None,
+        )
+    else:
+        # the hits are shared, only the evidence information is extracted per cancer type
+        for disease in disease_list:
+            diseases = map_disease(doid, disease, logger)
+            label = get_disease_label(disease, diseases[0])
+            write_results(
+                disease,
+                diseases,
+                f"{out_path}/{basename}.{label}.civic_results.tsv",
+                f"{out_path}/{basename}.{label}.civic_evidence.tsv" if evidence_table else None,
+            )
+    memo.log_stats(logger)
+
+
+def tsv_value(value):
+    """
+    Format a single value of the result table, missing values are written as empty fields
+
+    :param value: value of a result dictionary
+    :type value: any
+    :return: value to write
+    :rtype: any
+    """
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return ""
+    return value
+
+
+def write_civic_results(rows, out_file):
+    """
+    Stream result dictionaries to a tab-separated table.
+    The column order is fixed by the first row, all following rows must have the same keys
+
+    :param rows: result dictionaries of the CIViC variant objects
+    :type rows: iterable
+    :param out_file: path of the result table
+    :type out_file: str
+    :return: number of rows written
+    :rtype: int
+    """
+    writer = None
+    n_rows = 0
+    with open(out_file, "w", newline="") as f:
+        for row in rows:
+            if writer is None:
+                writer = csv.DictWriter(f, fieldnames=list(row.keys()), delimiter="\t", lineterminator="\n")
+                writer.writeheader()
+            writer.writerow({key: tsv_value(value) for key, value in row.items()})
+            n_rows += 1
+        if writer is None:
+            # no CIViC hits, write the same empty table as pandas, which combine_civic recognizes
+            f.write("\n")
+    return n_rows
+
+
+def write_civic_tables(results, out_file, evidence_file, fields=None):
+    """
+    Stream the results of the CIViC variant objects to civic_results.tsv and, one row per evidence item,
+    to civic_evidence.tsv
+
+    :param results: rows of civic_results.tsv and civic_evidence.tsv per CIViC variant object
+    :type results: iterable
+    :param out_file: path of the result table
+    :type out_file: str
+    :param evidence_file: path of the evidence table, no evidence table is written if None
+    :type evidence_file: str
+    :param fields: selected columns as returned by resolve_civic_fields, None for all columns
+    :type fields: tuple
+    :return: number of rows written to the result table
+    :rtype: int
+    """
+    if evidence_file is None:
+        return write_civic_results((row for row, evidence_rows in results), out_file)
+
+    # the evidence table has a fixed header, so tables without hit can be read with their column types
+    evidence_columns = ["querynator_id", "chr", "start", "stop", "ref", "alt"] + CIVIC_EVIDENCE_ID_COLUMNS
+    evidence_columns += [i for i in CIVIC_FIELD_GROUPS["evidence"] if fields is None or i in fields]
+    with open(evidence_file, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=evidence_columns, delimiter="\t", lineterminator="\n")
+        writer.writeheader()
+
+        def rows():
+            for row, evidence_rows in results:
+                writer.writerows({key: tsv_value(value) for key, value in i.items()} for i in evidence_rows)
+                yield row
+
+        return write_civic_results(rows(), out_file)
 
 
 def sort_coord_list(coord_dict):
@@ -638,7 +1524,80 @@ def sort_rules(s):
         return 10000
 
 
-def add_civic_metadata(out_path, input_file, search_mode, genome, filter_vep):
+def get_civic_cache_age(cache_path):
+    """
+    Get the age of a local CIViCpy cache file in days
+
+    :param cache_path: path of the CIViCpy cache file
+    :type cache_path: str
+    :return: days since the cache file was written, None if there is no cache file
+    :rtype: float
+    """
+    if not os.path.isfile(cache_path):
+        return None
+    return (time.time() - os.path.getmtime(cache_path)) / 86400
+
+
+def load_civic_cache(logger, cache_mode="auto", cache_path=None, cache_ttl=civic.CACHE_TIMEOUT_DAYS):
+    """
+    Load the CIViCpy cache into memory following the chosen refresh policy
+
+    auto:    CIViCpy's default behaviour, the cache is updated if its snapshot is stale
+    offline: the cache file is loaded as is, without any network access
+    ttl:     the remote cache is only downloaded if the local file is missing or older than cache_ttl days
+    refresh: the remote cache is always downloaded
+
+    :param cache_mode: one of CIVIC_CACHE_MODES
+    :type cache_mode: str
+    :param cache_path: path of the CIViCpy cache file, defaults to CIViCpy's local cache
+    :type cache_path: str
+    :param cache_ttl: maximum age of the cache file in days for cache_mode ttl
+    :type cache_ttl: float
+    :return: date the loaded CIViC snapshot was created
+    :rtype: datetime.datetime
+    """
+    cache_path = cache_path or civic.LOCAL_CACHE_PATH
+
+    if cache_mode == "auto":
+        logger.info("Updating CIViCpy Cache")
+        # same as civic.load_cache() for the default cache path, but also for a custom one
+        if not os.path.isfile(cache_path):
+            civic.download_remote_cache(local_cache_path=cache_path)
+        civic.load_cache(local_cache_path=cache_path, on_stale="update")
+    elif cache_mode == "offline":
+        if not os.path.isfile(cache_path):
+            logger.error(f"No CIViCpy cache found at {cache_path}. The offline mode requires an existing cache file")
+            exit(1)
+        logger.info(f"Loading CIViCpy Cache {cache_path} without update")
+        civic.load_cache(local_cache_path=cache_path, on_stale="ignore")
+    elif cache_mode in ["ttl", "refresh"]:
+        cache_age = get_civic_cache_age(cache_path)
+        if cache_mode == "refresh" or cache_age is None or cache_age > cache_ttl:
+            logger.info("Updating CIViCpy Cache")
+            civic.download_remote_cache(local_cache_path=cache_path)
+        else:
+            logger.info(f"CIViCpy Cache {cache_path} is {cache_age:.1f} days old, skipping update")
+        civic.load_cache(local_cache_path=cache_path, on_stale="ignore")
+    else:
+        logger.error(f"Unknown CIViCpy cache mode {cache_mode}, choose one of {', '.join(CIVIC_CACHE_MODES)}")
+        exit(1)
+
+    snapshot_date = civic.CACHE.get("full_cached")
+    logger.info(f"Using CIViC snapshot from {snapshot_date}")
+    return snapshot_date
+
+
+def add_civic_metadata(
+    out_path,
+    input_file,
+    search_mode,
+    genome,
+    filter_vep,
+    snapshot_date=None,
+    checksums=None,
+    fields=None,
+    match_mode="coordinate",
+):
     """
     Attach metadata to civic query
 
@@ -650,6 +1609,14 @@ def add_civic_metadata(out_path, input_file, search_mode, genome, filter_vep):
     :type search_mode: str
     :param filter_vep: flag whether VEP based filtering should be performed
     :type filter_vep: bool
+    :param snapshot_date: creation date of the CIViC snapshot that was queried
+    :type snapshot_date: datetime.datetime
+    :param checksums: SHA-256 checksums of the queried CIViC release files, keyed by file name
+    :type checksums: dict
+    :param fields: columns of the result table, None for all columns
+    :type fields: tuple
+    :param match_mode: how variants were matched to CIViC variants
+    :type match_mode: str
     :return: None
     :rtype: None
     """
@@ -657,48 +1624,150 @@ def add_civic_metadata(out_path, input_file, search_mode, genome, filter_vep):
     with open(out_path + "/metadata.txt", "w") as f:
         f.write("CIViC query date: " + str(date.today()))
         f.write("\nCIViCpy version: " + str(civicpy.version()))
+        if snapshot_date is not None:
+            f.write("\nCIViC snapshot date: " + str(snapshot_date))
+        for name, checksum in (checksums or {}).items():
+            f.write("\nCIViC release file: " + name + " (sha256 " + checksum + ")")
         f.write("\nSearch mode: " + str(search_mode))
+        f.write("\nMatch mode: " + str(match_mode))
         f.write("\nReference genome: " + str(genome))
         if filter_vep:
             f.write("\nFiltered out synonymous & low impact variants based on VEP annotation")
+        if fields is not None:
+            f.write("\nCIViC fields: " + ", ".join(fields))
         f.write("\nInput File: " + str(input_file))
         f.close()
 
 
-def query_civic(vcf, out_path, logger, input_file, genome, disease, filter_vep, evidence_filters):
+def query_civic(
+    vcf,
+    out_path,
+    logger,
+    input_file,
+    genome,
+    disease,
+    filter_vep,
+    evidence_filters,
+    cache_mode="auto",
+    cache_path=None,
+    cache_ttl=civic.CACHE_TIMEOUT_DAYS,
+    snapshot_path=None,
+    civic_tsv=None,
+    threads=1,
+    result_cache_dir=None,
+    result_cache_size=CIVIC_RESULT_CACHE_SIZE,
+    fields=None,
+    match_mode="coordinate",
+    regions=None,
+):
     """
     Command to query the CIViC API
 
-    :param vcf: Variant Call Format (VCF) file (Version 4.2) or list of pyVCF3 variant records
-    :type vcf: str or list
+    :param vcf: Variant Call Format (VCF) file (Version 4.2) or iterable of vcf records
+    :type vcf: str or iterable
     :param out_path: Name for directory in which result-table will be stored
     :type out_path: str
     :param input_file: path of original input file
     :type input_file: str
-    :param disease: the patients cancer type as Disease Ontology Name
-    :type disease: str
+    :param disease: the patients cancer type(s) as Disease Ontology Name
+    :type disease: str or list
     :param filter_vep: flag whether VEP based filtering should be performed
     :type filter_vep: bool
     :param evidence_filters: evidence filters
     :type evidence_filters: dict
+    :param cache_mode: how the CIViCpy cache is loaded, one of CIVIC_CACHE_MODES
+    :type cache_mode: str
+    :param cache_path: path of the CIViCpy cache file, defaults to CIViCpy's local cache
+    :type cache_path: str
+    :param cache_ttl: maximum age of the cache file in days for cache_mode ttl
+    :type cache_ttl: float
+    :param snapshot_path: directory of a CIViC snapshot to query instead of the CIViCpy cache
+    :type snapshot_path: str
+    :param civic_tsv: directory of a CIViC TSV release to query instead of the CIViCpy cache
+    :type civic_tsv: str
+    :param threads: number of worker threads
+    :type threads: int
+    :param result_cache_dir: directory of the CIViC result cache shared between runs, no cache if None
+    :type result_cache_dir: str
+    :param result_cache_size: maximum number of variants in the CIViC result cache
+    :type result_cache_size: int
+    :param fields: columns of the result table as returned by resolve_civic_fields, None for all columns
+    :type fields: tuple
+    :param match_mode: how variants are matched to CIViC variants, one of CIVIC_MATCH_MODES
+    :type match_mode: str
+    :param regions: if given, only the variants of these regions are queried, see fetch_vcf_regions
+    :type regions: list
     :return: None
     :rtype: None
     """
-    # necessary for bulk run
-    logger.info("Updating CIViCpy Cache")
-    civic.load_cache()
+    checksums = None
+    if snapshot_path and civic_tsv:
+        logger.error("Please provide either a CIViC snapshot or a CIViC TSV release, not both")
+        exit(1)
+    if snapshot_path:
+        snapshot = load_civic_snapshot(snapshot_path, logger)
+        snapshot_date = snapshot.snapshot_date
+        data_version = f"snapshot:{snapshot_date}" if snapshot_date else None
+    elif civic_tsv:
+        snapshot = load_civic_tsv_release(civic_tsv, logger)
+        snapshot_date, checksums = snapshot.snapshot_date, snapshot.checksums
+        data_version = "tsv:" + hashlib.sha256(json.dumps(sorted(checksums.values())).encode()).hexdigest()
+    else:
+        # necessary for bulk run
+        snapshot = None
+        snapshot_date = load_civic_cache(logger, cache_mode, cache_path, cache_ttl)
+        data_version = f"civicpy:{snapshot_date}" if snapshot_date else None
+
+    result_cache = None
+    if result_cache_dir:
+        result_cache = open_civic_result_cache(result_cache_dir, data_version, result_cache_size, logger)
 
     logger.info("Querying")
 
-    coord_dict = get_coordinates_from_vcf(vcf, genome, logger)
+    match_keys = None
+    if match_mode == "coordinate":
+        locus_filter = None
+        if genome == "GRCh37":
+            # only GRCh37 variants are matched by their coordinates, other builds via the allele registry
+            locus_filter = snapshot.locus_filter(genome) if snapshot is not None else get_locus_filter(genome)
+        coord_dict = get_coordinates_from_vcf(vcf, genome, logger, locus_filter=locus_filter, regions=regions)
+    else:
+        csq_schema = get_csq_schema(input_file, logger)
+        coord_dict, match_keys = get_coordinates_from_vcf(vcf, genome, logger, csq_schema, regions=regions)
 
     # coordinates needs to be sorted for bulk search
     coord_dict = sort_coord_list(coord_dict)
 
+    search_dict = coord_dict
+    cached_results = None
+    if result_cache is not None:
+        # the cache is read once, only variants that are not cached for every cancer type need to be searched
+        cached_results, fully_cached = read_cached_results(
+            result_cache, coord_dict, disease, evidence_filters, fields, match_mode, match_keys
+        )
+        search_dict = {
+            coord_obj: querynator_id for coord_obj, querynator_id in coord_dict.items() if coord_obj not in fully_cached
+        }
+        logger.info(f"{len(coord_dict) - len(search_dict)} of {len(coord_dict)} variants found in the result cache")
+
     # create result table
     create_civic_results(
-        access_civic_by_coordinate(coord_dict, logger, genome), out_path, disease, logger, filter_vep, evidence_filters
+        access_civic_by_coordinate(search_dict, logger, genome, snapshot, threads, match_mode, match_keys),
+        out_path,
+        disease,
+        logger,
+        filter_vep,
+        evidence_filters,
+        threads,
+        result_cache,
+        coord_dict,
+        fields,
+        match_mode,
+        match_keys,
+        cached_results,
     )
-    add_civic_metadata(out_path, input_file, "exact", genome, filter_vep)
+    if result_cache is not None:
+        result_cache.close()
+    add_civic_metadata(out_path, input_file, "exact", genome, filter_vep, snapshot_date, checksums, fields, match_mode)
 
     logger.info("CIViC Analysis done")
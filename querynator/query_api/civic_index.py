@@ -0,0 +1,600 @@
+""" Local lookup indexes over the CIViC variants of the loaded CIViCpy cache """
+
+import re
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+
+import requests
+from civicpy import civic
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from querynator.helper_functions import ordered_map
+
+ALLELE_REGISTRY_URL = "http://reg.genome.network/alleles"
+# number of HGVS expressions sent to the allele registry per request
+ALLELE_REGISTRY_CHUNK_SIZE = 1000
+
+# built once per process and reference build, rebuilt if the CIViCpy cache is reloaded
+_COORDINATE_INDEX = {}
+_ALLELE_INDEX = {}
+_PROTEIN_INDEX = {}
+_LOCUS_FILTER = {}
+
+# one letter codes of the amino acids in HGVS protein changes
+AMINO_ACIDS = {
+    "Ala": "A",
+    "Arg": "R",
+    "Asn": "N",
+    "Asp": "D",
+    "Cys": "C",
+    "Gln": "Q",
+    "Glu": "E",
+    "Gly": "G",
+    "His": "H",
+    "Ile": "I",
+    "Leu": "L",
+    "Lys": "K",
+    "Met": "M",
+    "Phe": "F",
+    "Pro": "P",
+    "Ser": "S",
+    "Thr": "T",
+    "Trp": "W",
+    "Tyr": "Y",
+    "Val": "V",
+    "Sec": "U",
+    "Pyl": "O",
+    "Ter": "*",
+}
+HGVS_PROTEIN_CHANGE = re.compile(r"(?:^|:)p\.\(?([^()]+)\)?$")
+
+
+class CivicCoordinateIndex:
+    """
+    Sorted-array index of the CIViC variant coordinates of one reference build.
+
+    For every chromosome the CIViC variant intervals are stored sorted by start position,
+    so an overlap lookup is a binary search instead of a scan over all CIViC variants.
+    Exact lookups are resolved via a hash table on (chr, start, stop).
+    The matching rules follow the ones of CIViCpy's coordinate search.
+    """
+
+    def __init__(self, entries, build):
+        """
+        :param entries: coordinate entries (chr, start, stop, ref, alt, variant)
+        :type entries: iterable
+        :param build: reference genome of the coordinates
+        :type build: str
+        """
+        self.build = build
+        self.starts = {}
+        self.intervals = {}
+        self.max_length = {}
+        self.exact = defaultdict(list)
+
+        by_chr = defaultdict(list)
+        for chrom, start, stop, ref, alt, variant in entries:
+            by_chr[str(chrom)].append((int(start), int(stop), ref, alt, variant))
+
+        for chrom, intervals in by_chr.items():
+            # same order as the CIViCpy coordinate table (chr, start, stop, alt, ref)
+            intervals.sort(key=lambda x: (x[0], x[1], x[3] or "", x[2] or ""))
+            self.intervals[chrom] = intervals
+            self.starts[chrom] = [i[0] for i in intervals]
+            self.max_length[chrom] = max(i[1] - i[0] for i in intervals)
+            for start, stop, ref, alt, variant in intervals:
+                self.exact[(chrom, start, stop)].append((ref, alt, variant))
+
+    @classmethod
+    def from_variants(cls, variants, build):
+        """
+        Create the index from CIViC variant objects, using all coordinates curated for the given build
+
+        :param variants: CIViC variant objects
+        :type variants: list
+        :param build: reference genome
+        :type build: str
+        :return: coordinate index
+        :rtype: CivicCoordinateIndex
+        """
+        entries = []
+        for variant in variants:
+            entries.extend(coordinate_entries(variant.coordinates, build, variant))
+        return cls(entries, build)
+
+    def __len__(self):
+        return sum(len(i) for i in self.intervals.values())
+
+    def overlapping(self, chrom, start, stop):
+        """
+        Get all indexed intervals overlapping the given region
+
+        :param chrom: chromosome without "chr" prefix
+        :type chrom: str
+        :param start: start position (1-based)
+        :type start: int
+        :param stop: stop position (1-based)
+        :type stop: int
+        :return: overlapping intervals (start, stop, ref, alt, variant)
+        :rtype: list
+        """
+        starts = self.starts.get(chrom)
+        if not starts:
+            return []
+        # intervals starting before start - max_length cannot reach the region
+        left = bisect_left(starts, start - self.max_length[chrom])
+        right = bisect_right(starts, stop)
+        return [i for i in self.intervals[chrom][left:right] if i[1] >= start]
+
+    def search(self, coord_obj, search_mode="exact"):
+        """
+        Search the index for CIViC variants matching a single CoordinateQuery
+
+        :param coord_obj: coordinates to query
+        :type coord_obj: CIViC CoordinateQuery Object
+        :param search_mode: one of any, exact, query_encompassing, record_encompassing
+        :type search_mode: str
+        :return: matching CIViC variant objects
+        :rtype: list
+        """
+        chrom, start, stop = str(coord_obj.chr), int(coord_obj.start), int(coord_obj.stop)
+
+        if search_mode == "exact":
+            check_allele(coord_obj.alt, "alt")
+            check_allele(coord_obj.ref, "ref")
+            matches = [
+                variant
+                for ref, alt, variant in self.exact.get((chrom, start, stop), [])
+                if allele_matches(coord_obj.alt, alt) and allele_matches(coord_obj.ref, ref)
+            ]
+        elif search_mode == "any":
+            matches = [i[4] for i in self.overlapping(chrom, start, stop)]
+        elif search_mode == "query_encompassing":
+            matches = [i[4] for i in self.overlapping(chrom, start, stop) if start <= i[0] and stop >= i[1]]
+        elif search_mode in ["record_encompassing", "variant_encompassing"]:
+            matches = [i[4] for i in self.overlapping(chrom, start, stop) if i[0] <= start and i[1] >= stop]
+        else:
+            raise ValueError(f"unexpected search mode {search_mode}")
+
+        # a variant can match via its primary and secondary coordinates
+        unique_matches = []
+        for variant in matches:
+            if not any(variant is i for i in unique_matches):
+                unique_matches.append(variant)
+        return unique_matches
+
+    def bulk_search(self, coord_objs, search_mode="exact"):
+        """
+        Search the index for all given CoordinateQuery objects in one pass
+
+        :param coord_objs: coordinates to query, need not be sorted
+        :type coord_objs: iterable
+        :param search_mode: one of any, exact, query_encompassing, record_encompassing
+        :type search_mode: str
+        :return: matching CIViC variant objects, keyed by query. Queries without hit are omitted
+        :rtype: dict
+        """
+        hits = {}
+        for coord_obj in coord_objs:
+            matches = self.search(coord_obj, search_mode)
+            if matches:
+                hits[coord_obj] = matches
+        return hits
+
+
+class CivicLocusFilter:
+    """
+    Merged, padded intervals of all CIViC-curated loci of one reference build.
+
+    Used to drop vcf records that can not match any CIViC variant before CoordinateQuery objects are created.
+    A record is kept if the span of its REF and ALT alleles overlaps a padded locus.
+    """
+
+    def __init__(self, index, padding=1):
+        """
+        :param index: coordinate index of the build
+        :type index: CivicCoordinateIndex
+        :param padding: number of bases added on both sides of every CIViC interval
+        :type padding: int
+        """
+        self.build = index.build
+        self.starts = {}
+        self.stops = {}
+        for chrom, intervals in index.intervals.items():
+            merged = []
+            # intervals of the index are sorted by start
+            for start, stop, *_ in intervals:
+                start, stop = start - padding, stop + padding
+                if merged and start <= merged[-1][1] + 1:
+                    merged[-1][1] = max(merged[-1][1], stop)
+                else:
+                    merged.append([start, stop])
+            self.starts[chrom] = [i[0] for i in merged]
+            self.stops[chrom] = [i[1] for i in merged]
+
+    def __len__(self):
+        return sum(len(i) for i in self.starts.values())
+
+    def overlaps(self, chrom, start, stop):
+        """
+        Check if a region overlaps a CIViC-curated locus
+
+        :param chrom: chromosome without "chr" prefix
+        :type chrom: str
+        :param start: start position (1-based)
+        :type start: int
+        :param stop: stop position (1-based)
+        :type stop: int
+        :return: True if the region overlaps a padded locus
+        :rtype: bool
+        """
+        starts = self.starts.get(chrom)
+        if not starts:
+            return False
+        # merged loci do not overlap, only the last one starting before stop can reach the region
+        i = bisect_right(starts, stop) - 1
+        return i >= 0 and self.stops[chrom][i] >= start
+
+    def keeps(self, record):
+        """
+        Check if a vcf record can match a CIViC variant
+
+        :param record: vcf record as returned by open_vcf_reader
+        :type record: VcfRecord or vcf.model._Record
+        :return: True if the span of the record's alleles overlaps a padded locus
+        :rtype: bool
+        """
+        chrom = str(record.CHROM)
+        chrom = chrom[3:] if chrom.startswith("chr") else chrom
+        # insertions are queried behind POS, so the span covers the longest allele
+        width = max([len(record.REF)] + [len(str(alt)) for alt in record.ALT])
+        return self.overlaps(chrom, int(record.POS), int(record.POS) + width)
+
+
+def coordinate_entries(coordinates, build, variant):
+    """
+    Create the index entries of the coordinates of a single CIViC variant
+
+    :param coordinates: coordinates of the CIViC variant
+    :type coordinates: CIViC coordinates object
+    :param build: reference genome of the index
+    :type build: str
+    :param variant: object the entries point to, e.g. the CIViC variant object
+    :type variant: any
+    :return: coordinate entries (chr, start, stop, ref, alt, variant), empty if curated for another build
+    :rtype: list
+    """
+    c = coordinates
+    # CIViCpy's coordinate objects are empty dictionaries holding their values as attributes, so no truth test
+    # coordinates without reference build are GRCh37, the build CIViC curated first
+    if c is None or (getattr(c, "reference_build", None) or "GRCh37") != build:
+        return []
+    chrom, start, stop = getattr(c, "chromosome", None), getattr(c, "start", None), getattr(c, "stop", None)
+    if not all([chrom, start, stop]):
+        return []
+    entries = [(chrom, start, stop, getattr(c, "reference_bases", None), getattr(c, "variant_bases", None), variant)]
+    # secondary coordinates (e.g. fusions) never carry alleles
+    chrom, start, stop = getattr(c, "chromosome2", None), getattr(c, "start2", None), getattr(c, "stop2", None)
+    if all([chrom, start, stop]):
+        entries.append((chrom, start, stop, None, None, variant))
+    return entries
+
+
+def protein_change(hgvs):
+    """
+    Get the protein change of an HGVS protein expression in one letter code, e.g. V600E for NP_004324.2:p.Val600Glu
+
+    :param hgvs: HGVS protein expression, with or without reference sequence
+    :type hgvs: str
+    :return: upper case protein change, None if hgvs is no protein expression
+    :rtype: str
+    """
+    match = HGVS_PROTEIN_CHANGE.search((hgvs or "").replace("%3D", "="))
+    if not match:
+        return None
+    change = match.group(1)
+    for three_letter, one_letter in AMINO_ACIDS.items():
+        change = change.replace(three_letter, one_letter)
+    return change.upper()
+
+
+def hgvs_keys(hgvs):
+    """
+    Create the lookup keys of an HGVS expression, the expression itself and, if the
+    reference sequence is versioned, the expression without version (NM_004333:c.1799T>A)
+
+    :param hgvs: HGVS expression
+    :type hgvs: str
+    :return: lookup keys
+    :rtype: list
+    """
+    keys = [("hgvs", hgvs)]
+    accession, sep, change = hgvs.partition(":")
+    if sep and "." in accession:
+        keys.append(("hgvs", f"{accession.rsplit('.', 1)[0]}:{change}"))
+    return keys
+
+
+class CivicProteinIndex:
+    """
+    Hash index of CIViC variants by HGVS expression and by (gene, protein change).
+
+    The protein changes are taken from the variant names (e.g. V600E) and from the HGVS
+    protein expressions of the variants, so variants without curated coordinates can be matched as well.
+    """
+
+    def __init__(self, entries):
+        """
+        :param entries: protein entries (gene, name, hgvs_expressions, variant)
+        :type entries: iterable
+        """
+        self.keys = defaultdict(list)
+        for gene, name, hgvs_expressions, variant in entries:
+            variant_keys = []
+            for hgvs in hgvs_expressions or []:
+                variant_keys.extend(hgvs_keys(hgvs))
+                if protein_change(hgvs) and gene:
+                    variant_keys.append(("protein_change", gene.upper(), protein_change(hgvs)))
+            if name and gene:
+                variant_keys.append(("protein_change", gene.upper(), name.upper()))
+            for key in dict.fromkeys(variant_keys):
+                self.keys[key].append(variant)
+
+    @classmethod
+    def from_variants(cls, variants):
+        """
+        Create the index from CIViC variant objects
+
+        :param variants: CIViC variant objects
+        :type variants: list
+        :return: protein index
+        :rtype: CivicProteinIndex
+        """
+        return cls((variant.entrez_name, variant.name, variant.hgvs_expressions, variant) for variant in variants)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def search(self, match_keys):
+        """
+        Search the index for CIViC variants matching the keys of a single query.
+        HGVS expressions are preferred over protein changes
+
+        :param match_keys: lookup keys as returned by hgvs_keys or ("protein_change", gene, change) tuples
+        :type match_keys: iterable
+        :return: matching CIViC variant objects and the kind of key they matched ("hgvs" or "protein_change")
+        :rtype: tuple (list, str)
+        """
+        match_keys = [tuple(key) for key in match_keys]
+        for match_type in ["hgvs", "protein_change"]:
+            matches = []
+            for key in match_keys:
+                if key[0] != match_type:
+                    continue
+                for variant in self.keys.get(key, []):
+                    if variant not in matches:
+                        matches.append(variant)
+            if matches:
+                return matches, match_type
+        return [], None
+
+    def bulk_search(self, match_keys):
+        """
+        Search the index for all given queries
+
+        :param match_keys: lookup keys, keyed by query
+        :type match_keys: dict
+        :return: matching CIViC variant objects and the kind of key they matched, keyed by query.
+            Queries without hit are omitted
+        :rtype: dict
+        """
+        hits = {}
+        for coord_obj, keys in match_keys.items():
+            matches, match_type = self.search(keys)
+            if matches:
+                hits[coord_obj] = (matches, match_type)
+        return hits
+
+
+def check_allele(allele, name):
+    """
+    Reject alleles CIViCpy does not accept in coordinate queries
+
+    :param allele: queried allele
+    :type allele: str
+    :param name: "ref" or "alt"
+    :type name: str
+    :return: None
+    :raises ValueError: if allele is "-"
+    """
+    if allele == "-":
+        raise ValueError(f"Unexpected {name} `-` in coordinate query. Did you mean `None`?")
+
+
+def allele_matches(query_allele, civic_allele):
+    """
+    Compare a queried allele to a CIViC allele. "*" matches everything, None only matches missing alleles
+
+    :param query_allele: allele of the CoordinateQuery
+    :type query_allele: str
+    :param civic_allele: allele of the CIViC variant
+    :type civic_allele: str
+    :return: True if the alleles match
+    :rtype: bool
+    """
+    if query_allele == "*":
+        return True
+    return query_allele == civic_allele
+
+
+def get_civic_variants():
+    """
+    Get the CIViC variants of the loaded CIViCpy cache the lookup indexes are built from.
+    Same selection as CIViCpy's searches: all variants, reporting evidence and assertions of every status
+
+    :return: CIViC variant objects
+    :rtype: list
+    """
+    # resets the status selection of every variant to CIViCpy's default, as its searches do
+    civic.get_all_variants()
+    return civic.get_all_variants(include_status=None)
+
+
+def get_coordinate_index(build):
+    """
+    Get the coordinate index of the loaded CIViCpy cache for a reference build, build it on first use
+
+    :param build: reference genome
+    :type build: str
+    :return: coordinate index
+    :rtype: CivicCoordinateIndex
+    """
+    index, cache = _COORDINATE_INDEX.get(build, (None, None))
+    if index is None or cache is not civic.CACHE:
+        index = CivicCoordinateIndex.from_variants(get_civic_variants(), build)
+        _COORDINATE_INDEX[build] = (index, civic.CACHE)
+    return index
+
+
+def get_locus_filter(build):
+    """
+    Get the locus filter of the loaded CIViCpy cache for a reference build, build it on first use
+
+    :param build: reference genome
+    :type build: str
+    :return: locus filter
+    :rtype: CivicLocusFilter
+    """
+    locus_filter, cache = _LOCUS_FILTER.get(build, (None, None))
+    if locus_filter is None or cache is not civic.CACHE:
+        locus_filter = CivicLocusFilter(get_coordinate_index(build))
+        _LOCUS_FILTER[build] = (locus_filter, civic.CACHE)
+    return locus_filter
+
+
+def get_allele_index():
+    """
+    Get the CIViC variants of the loaded CIViCpy cache keyed by their ClinGen allele registry ID (CAID),
+    build it on first use
+
+    :return: CIViC variant objects keyed by CAID
+    :rtype: dict
+    """
+    index, cache = _ALLELE_INDEX.get("caid", (None, None))
+    if index is None or cache is not civic.CACHE:
+        index = defaultdict(list)
+        # same variant selection as CIViCpy's search_variants_by_allele_registry_id
+        for variant in get_civic_variants():
+            if variant.allele_registry_id and variant.molecular_profiles:
+                index[variant.allele_registry_id].append(variant)
+        _ALLELE_INDEX["caid"] = (index, civic.CACHE)
+    return index
+
+
+def get_protein_index():
+    """
+    Get the HGVS and protein change index of the loaded CIViCpy cache, build it on first use
+
+    :return: protein index
+    :rtype: CivicProteinIndex
+    """
+    index, cache = _PROTEIN_INDEX.get("protein", (None, None))
+    if index is None or cache is not civic.CACHE:
+        index = CivicProteinIndex.from_variants(get_civic_variants())
+        _PROTEIN_INDEX["protein"] = (index, civic.CACHE)
+    return index
+
+
+def post_allele_registry_chunk(chunk):
+    """
+    Resolve a chunk of HGVS expressions with a single allele registry request
+
+    :param chunk: (CoordinateQuery, HGVS expression) pairs
+    :type chunk: list
+    :return: CAIDs keyed by query. Queries without registered allele are omitted
+    :rtype: dict
+    """
+    # one session per request, sessions are not shared between threads
+    session = requests.Session()
+    retry = Retry(total=5, read=5, connect=5, backoff_factor=0.3, status_forcelist=(500, 502, 504))
+    session.mount("http://", HTTPAdapter(max_retries=retry))
+    session.mount("https://", HTTPAdapter(max_retries=retry))
+
+    r = session.post(ALLELE_REGISTRY_URL, params={"file": "hgvs"}, data="\n".join(hgvs for _, hgvs in chunk))
+    r.raise_for_status()
+    caids = {}
+    # the registry answers with one allele (or error) per HGVS expression, in input order
+    for (coord_obj, _), allele in zip(chunk, r.json()):
+        caid = allele.get("@id", "").split("/")[-1]
+        if caid and caid != "_:CA":
+            caids[coord_obj] = caid
+    return caids
+
+
+def resolve_allele_registry_ids(coord_objs, chunk_size=ALLELE_REGISTRY_CHUNK_SIZE, threads=1):
+    """
+    Resolve the ClinGen allele registry IDs of non-GRCh37 CoordinateQuery objects with bulk requests
+
+    :param coord_objs: GRCh38 or NCBI36 coordinates to resolve
+    :type coord_objs: iterable
+    :param chunk_size: number of queries per request
+    :type chunk_size: int
+    :param threads: number of concurrent requests
+    :type threads: int
+    :return: CAIDs keyed by query. Queries without registered allele are omitted
+    :rtype: dict
+    :raises requests.exceptions.RequestException: if the allele registry can not be reached
+    """
+    hgvs_dict = {}
+    for coord_obj in coord_objs:
+        if not coord_obj.alt and not coord_obj.ref:
+            raise ValueError("alt or ref required for non-GRCh37 coordinate queries")
+        if coord_obj.alt == "*" or coord_obj.ref == "*":
+            raise ValueError("Can't use wildcard when searching for non-GRCh37 coordinates")
+        check_allele(coord_obj.alt, "alt")
+        check_allele(coord_obj.ref, "ref")
+        # same genomic HGVS expression CIViCpy sends for a single query
+        hgvs = civic._construct_hgvs_for_coordinate_query(coord_obj)
+        if hgvs is not None:
+            hgvs_dict[coord_obj] = hgvs
+
+    caids = {}
+    queries = list(hgvs_dict.items())
+    chunks = (queries[i : i + chunk_size] for i in range(0, len(queries), chunk_size))
+    for chunk_caids in ordered_map(post_allele_registry_chunk, chunks, threads):
+        caids.update(chunk_caids)
+    return caids
+
+
+def bulk_search_by_allele_registry(coord_objs, logger, allele_index=None, threads=1):
+    """
+    Search CIViC variants for GRCh38 or NCBI36 coordinates.
+    All queries are resolved to CAIDs in bulk first, so only hits need to be looked up in the local CAID index
+
+    :param coord_objs: coordinates to query
+    :type coord_objs: iterable
+    :param allele_index: CIViC variants keyed by CAID, defaults to the index of the loaded CIViCpy cache
+    :type allele_index: dict
+    :param threads: number of concurrent allele registry requests
+    :type threads: int
+    :return: matching CIViC variants, keyed by query. Queries without hit are omitted
+    :rtype: dict
+    """
+    coord_objs = list(coord_objs)
+    try:
+        caids = resolve_allele_registry_ids(coord_objs, threads=threads)
+    except requests.exceptions.RequestException as err:
+        if allele_index is not None:
+            logger.error(f"Could not reach the ClinGen allele registry ({err})")
+            exit(1)
+        logger.warning(f"Bulk allele registry request failed ({err}), searching variants one by one")
+        variants = ordered_map(
+            lambda coord_obj: civic.search_variants_by_coordinates(coord_obj, search_mode="exact"), coord_objs, threads
+        )
+        return {coord_obj: variant for coord_obj, variant in zip(coord_objs, variants) if variant}
+
+    if allele_index is None:
+        allele_index = get_allele_index()
+    logger.info(f"{len(caids)} of {len(coord_objs)} variants are registered in the ClinGen allele registry")
+    return {coord_obj: allele_index[caid] for coord_obj, caid in caids.items() if caid in allele_index}
@@ -0,0 +1,155 @@
+""" Persistent cache of CIViC annotations shared by querynator runs """
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+# bump if the cached annotation columns change
+CIVIC_RESULT_CACHE_FORMAT = 1
+CIVIC_RESULT_CACHE_FILE = "civic_results.sqlite"
+
+
+class CivicResultCache:
+    """
+    SQLite cache of the CIViC annotations of queried variants.
+
+    An entry holds the annotation columns, evidence items and match types of all CIViC variants found for one
+    normalized input variant (build, chr, start, stop, ref, alt), evidence filters, cancer type, selection of columns
+    and match mode. Entries are kept per CIViC data version, which is part of every lookup, so runs on different
+    CIViC versions can share the cache. Variants without hit are cached as well. Entries are only removed by evicting
+    the least recently used ones of all versions once the cache grows beyond max_entries.
+    """
+
+    def __init__(self, cache_dir, data_version, max_entries=100000):
+        """
+        :param cache_dir: directory of the cache database
+        :type cache_dir: str
+        :param data_version: version of the queried CIViC data, e.g. the snapshot date
+        :type data_version: str
+        :param max_entries: maximum number of cached variants
+        :type max_entries: int
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, CIVIC_RESULT_CACHE_FILE)
+        self.data_version = f"{CIVIC_RESULT_CACHE_FORMAT}:{data_version}"
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(self.path, timeout=60)
+        with self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries (data_version TEXT NOT NULL, key TEXT NOT NULL, "
+                "annotations TEXT NOT NULL, last_access REAL NOT NULL, PRIMARY KEY (data_version, key))"
+            )
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    @staticmethod
+    def key(coord_obj, disease, frozen_filters, fields=None, match=None):
+        """
+        Create the cache key of a queried variant
+
+        :param coord_obj: queried coordinates
+        :type coord_obj: CIViC CoordinateQuery Object
+        :param disease: the patients cancer type as Disease Ontology Name or id
+        :type disease: str
+        :param frozen_filters: evidence filters as returned by freeze_evidence_filters
+        :type frozen_filters: tuple
+        :param fields: selected columns as returned by resolve_civic_fields, None for all columns
+        :type fields: tuple
+        :param match: match mode and VEP lookup keys of the query, None for coordinate matching
+        :type match: list
+        :return: cache key
+        :rtype: str
+        """
+        filter_hash = hashlib.sha1(json.dumps(frozen_filters).encode()).hexdigest()
+        normalized_disease = (disease or "").strip().lower()
+        return json.dumps(
+            [
+                coord_obj.build,
+                str(coord_obj.chr),
+                int(coord_obj.start),
+                int(coord_obj.stop),
+                coord_obj.ref,
+                coord_obj.alt,
+                filter_hash,
+                normalized_disease,
+                list(fields) if fields is not None else None,
+                match,
+            ]
+        )
+
+    def get_many(self, keys):
+        """
+        Get the cached annotations of several variants of the cache's CIViC data version and mark them as recently used
+
+        :param keys: cache keys
+        :type keys: iterable
+        :return: annotations (pairs of result columns and evidence items) keyed by cache key. Keys that are not cached are omitted
+        :rtype: dict
+        """
+        keys = list(set(keys))
+        cached = {}
+        # stay below SQLite's limit of host parameters
+        for i in range(0, len(keys), 500):
+            chunk = keys[i : i + 500]
+            rows = self.connection.execute(
+                f"SELECT key, annotations FROM entries WHERE data_version = ? AND key IN ({','.join('?' * len(chunk))})",
+                [self.data_version] + chunk,
+            )
+            cached.update((key, json.loads(annotations)) for key, annotations in rows)
+        with self.connection:
+            self.connection.executemany(
+                "UPDATE entries SET last_access = ? WHERE data_version = ? AND key = ?",
+                [(time.time(), self.data_version, key) for key in cached],
+            )
+        return cached
+
+    def put_many(self, entries):
+        """
+        Cache the annotations of several variants, then evict the least recently used entries
+
+        :param entries: annotations (pairs of result columns and evidence items) keyed by cache key
+        :type entries: dict
+        :return: None
+        """
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO entries (data_version, key, annotations, last_access) VALUES (?, ?, ?, ?)",
+                [
+                    (self.data_version, key, json.dumps(annotations, default=str), now)
+                    for key, annotations in entries.items()
+                ],
+            )
+            self.connection.execute(
+                "DELETE FROM entries WHERE rowid IN "
+                "(SELECT rowid FROM entries ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def close(self):
+        self.connection.close()
+
+
+def open_civic_result_cache(cache_dir, data_version, max_entries, logger):
+    """
+    Open the CIViC result cache
+
+    :param cache_dir: directory of the cache database
+    :type cache_dir: str
+    :param data_version: version of the queried CIViC data, None if unknown
+    :type data_version: str
+    :param max_entries: maximum number of cached variants
+    :type max_entries: int
+    :return: result cache, None if the CIViC data version is unknown
+    :rtype: CivicResultCache
+    """
+    if not data_version:
+        logger.warning("The version of the CIViC data is unknown, the CIViC result cache is not used")
+        return None
+    result_cache = CivicResultCache(cache_dir, data_version, max_entries)
+    logger.info(f"Using CIViC result cache {result_cache.path} with {len(result_cache)} entries")
+    return result_cache
@@ -0,0 +1,416 @@
+""" Compact, memory-mapped snapshot of the CIViC variants, projected to the fields the querynator reports """
+
+import json
+import mmap
+import os
+from collections import defaultdict
+from datetime import datetime
+
+import civicpy
+import numpy as np
+from civicpy import civic
+
+from querynator.query_api.civic_index import (
+    CivicCoordinateIndex,
+    CivicLocusFilter,
+    CivicProteinIndex,
+    bulk_search_by_allele_registry,
+    coordinate_entries,
+    get_civic_variants,
+)
+
+CIVIC_SNAPSHOT_FORMAT = 1
+
+# attributes of the CIViCpy objects read by the get_*_information_from_variant functions in civic_api.
+# nested dictionaries describe the attributes of related objects, None marks a plain value
+COORDINATE_FIELDS = {
+    "reference_build": None,
+    "chromosome": None,
+    "start": None,
+    "stop": None,
+    "reference_bases": None,
+    "variant_bases": None,
+    "chromosome2": None,
+    "start2": None,
+    "stop2": None,
+}
+GENE_FIELDS = {
+    "id": None,
+    "name": None,
+    "aliases": None,
+    "description": None,
+    "entrez_id": None,
+    "sources": {"name": None},
+}
+EVIDENCE_FIELDS = {
+    "id": None,
+    "name": None,
+    "description": None,
+    "disease": {"name": None, "doid": None},
+    "evidence_level": None,
+    "evidence_direction": None,
+    "evidence_type": None,
+    "phenotypes": {"name": None},
+    "rating": None,
+    "significance": None,
+    "source": {"name": None},
+    "status": None,
+    "therapies": {"name": None},
+    "therapy_interaction_type": None,
+}
+ASSERTION_FIELDS = {
+    "id": None,
+    "name": None,
+    "acmg_codes": {"code": None, "description": None},
+    "amp_level": None,
+    "assertion_direction": None,
+    "assertion_type": None,
+    "description": None,
+    "disease": {"name": None, "doid": None, "disease_url": None, "aliases": None},
+    "phenotypes": {"name": None},
+    "significance": None,
+    "status": None,
+    "summary": None,
+    "therapies": {"name": None, "ncit_id": None, "aliases": None},
+    "therapy_interaction_type": None,
+    "variant_origin": None,
+}
+MOLECULAR_PROFILE_FIELDS = {
+    "id": None,
+    "name": None,
+    "description": None,
+    "molecular_profile_score": None,
+    "evidence": EVIDENCE_FIELDS,
+    "assertions": ASSERTION_FIELDS,
+}
+VARIANT_FIELDS = {
+    "id": None,
+    "gene_id": None,
+    "name": None,
+    "aliases": None,
+    "types": {"name": None},
+    "clinvar_entries": None,
+    "entrez_id": None,
+    "entrez_name": None,
+    "hgvs_expressions": None,
+    "variant_groups": {"name": None},
+    "allele_registry_id": None,
+    "coordinates": COORDINATE_FIELDS,
+    "gene": GENE_FIELDS,
+    "molecular_profiles": MOLECULAR_PROFILE_FIELDS,
+}
+
+
+class SnapshotRecord(dict):
+    """
+    Record of a CIViC snapshot. The fields can be read as attributes,
+    like the ones of the CIViCpy object the record was projected from.
+    """
+
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+
+def snapshot_object_hook(obj):
+    """
+    Turn decoded JSON objects into SnapshotRecords.
+    Empty objects stay plain dictionaries, CIViCpy's representation of missing related objects
+
+    :param obj: decoded JSON object
+    :type obj: dict
+    :return: record
+    :rtype: SnapshotRecord or dict
+    """
+    return SnapshotRecord(obj) if obj else obj
+
+
+def project_civic_record(obj, fields):
+    """
+    Project a CIViCpy object to a JSON serializable dictionary of the given fields
+
+    :param obj: CIViCpy object, list of objects or plain value
+    :type obj: any
+    :param fields: fields to keep, nested dictionaries for related objects
+    :type fields: dict
+    :return: projected object
+    :rtype: dict or list
+    """
+    if obj is None:
+        return None
+    if isinstance(obj, (list, tuple, set)):
+        return [project_civic_record(i, fields) for i in obj]
+    # CIViCpy's related objects are empty dict subclasses as well, only plain dictionaries mark missing objects
+    if type(obj) is dict and not obj:
+        return {}
+    projected = {}
+    for field, subfields in fields.items():
+        value = getattr(obj, field, None)
+        if subfields is None:
+            projected[field] = list(value) if isinstance(value, (list, tuple, set)) else value
+        else:
+            projected[field] = project_civic_record(value, subfields)
+    return projected
+
+
+def write_civic_snapshot(variants, out_dir, snapshot_date, logger):
+    """
+    Write a CIViC snapshot of the given CIViC variant objects.
+
+    The snapshot directory contains
+    records.jsonl:  one projected variant record per line
+    offsets.npy:    byte offsets of the records, so a single record can be read from the memory-mapped file
+    index.json:     columns needed to build the coordinate, allele registry and protein indexes
+    manifest.json:  format version and snapshot date, written last
+
+    :param variants: CIViC variant objects
+    :type variants: list
+    :param out_dir: directory the snapshot is written to
+    :type out_dir: str
+    :param snapshot_date: creation date of the CIViC data
+    :type snapshot_date: datetime.datetime
+    :return: number of records written
+    :rtype: int
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    # an existing snapshot is only valid again once the new manifest is written
+    manifest_path = os.path.join(out_dir, "manifest.json")
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    index = {
+        "id": [],
+        "allele_registry_id": [],
+        "has_molecular_profiles": [],
+        "coordinates": [],
+        "entrez_name": [],
+        "name": [],
+        "hgvs_expressions": [],
+    }
+    offsets = [0]
+    with open(os.path.join(out_dir, "records.jsonl"), "wb") as f:
+        for variant in variants:
+            record = project_civic_record(variant, VARIANT_FIELDS)
+            line = (json.dumps(record, separators=(",", ":"), default=str) + "\n").encode("utf-8")
+            f.write(line)
+            offsets.append(offsets[-1] + len(line))
+            index["id"].append(record["id"])
+            index["allele_registry_id"].append(record["allele_registry_id"])
+            index["has_molecular_profiles"].append(bool(record["molecular_profiles"]))
+            index["coordinates"].append(record["coordinates"])
+            index["entrez_name"].append(record["entrez_name"])
+            index["name"].append(record["name"])
+            index["hgvs_expressions"].append(record["hgvs_expressions"])
+    np.save(os.path.join(out_dir, "offsets.npy"), np.array(offsets, dtype=np.int64))
+    with open(os.path.join(out_dir, "index.json"), "w") as f:
+        json.dump(index, f, separators=(",", ":"), default=str)
+
+    manifest = {
+        "format": CIVIC_SNAPSHOT_FORMAT,
+        "snapshot_date": str(snapshot_date) if snapshot_date else None,
+        "civicpy_version": civicpy.version(),
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "records": len(offsets) - 1,
+    }
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    logger.info(f"Wrote CIViC snapshot of {manifest['records']} variants to {out_dir}")
+    return manifest["records"]
+
+
+def compile_civic_snapshot(out_dir, logger):
+    """
+    Compile the loaded CIViCpy cache into a CIViC snapshot
+
+    :param out_dir: directory the snapshot is written to
+    :type out_dir: str
+    :return: number of records written
+    :rtype: int
+    """
+    variants = get_civic_variants()
+    return write_civic_snapshot(variants, out_dir, civic.CACHE.get("full_cached"), logger)
+
+
+class CivicSnapshot:
+    """
+    Read access to a CIViC snapshot written by write_civic_snapshot.
+
+    Only the manifest and the index are read on load. The records are memory-mapped
+    and only decoded when a variant is hit.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: snapshot directory
+        :type path: str
+        :raises FileNotFoundError: if the directory is not a complete snapshot
+        :raises ValueError: if the snapshot was written in another format
+        """
+        self.path = path
+        with open(os.path.join(path, "manifest.json")) as f:
+            self.manifest = json.load(f)
+        if self.manifest.get("format") != CIVIC_SNAPSHOT_FORMAT:
+            raise ValueError(f"unsupported CIViC snapshot format {self.manifest.get('format')}")
+        with open(os.path.join(path, "index.json")) as f:
+            self.index = json.load(f, object_hook=snapshot_object_hook)
+
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        self._file = open(os.path.join(path, "records.jsonl"), "rb")
+        if os.path.getsize(self._file.name):
+            self._records = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._records = b""
+        self._loaded = {}
+        self._coordinate_index = {}
+        self._allele_index = None
+        self._protein_index = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def snapshot_date(self):
+        return self.manifest.get("snapshot_date")
+
+    def get(self, n):
+        """
+        Get a single record, decode it on first access
+
+        :param n: record number
+        :type n: int
+        :return: projected CIViC variant
+        :rtype: SnapshotRecord
+        """
+        if n not in self._loaded:
+            self._loaded[n] = self.decode(n)
+        return self._loaded[n]
+
+    def decode(self, n):
+        """
+        Decode a single record without keeping it
+
+        :param n: record number
+        :type n: int
+        :return: projected CIViC variant
+        :rtype: SnapshotRecord
+        """
+        start, stop = int(self.offsets[n]), int(self.offsets[n + 1])
+        return json.loads(self._records[start:stop], object_hook=snapshot_object_hook)
+
+    def coordinate_index(self, build):
+        """
+        Get the coordinate index of a reference build, pointing to record numbers
+
+        :param build: reference genome
+        :type build: str
+        :return: coordinate index
+        :rtype: CivicCoordinateIndex
+        """
+        if build not in self._coordinate_index:
+            entries = []
+            for n, coordinates in enumerate(self.index["coordinates"]):
+                entries.extend(coordinate_entries(coordinates, build, n))
+            self._coordinate_index[build] = CivicCoordinateIndex(entries, build)
+        return self._coordinate_index[build]
+
+    def locus_filter(self, build):
+        """
+        Get the CIViC-curated loci of a reference build
+
+        :param build: reference genome
+        :type build: str
+        :return: locus filter
+        :rtype: CivicLocusFilter
+        """
+        return CivicLocusFilter(self.coordinate_index(build))
+
+    def allele_index(self):
+        """
+        Get the record numbers keyed by ClinGen allele registry ID (CAID)
+
+        :return: record numbers keyed by CAID
+        :rtype: dict
+        """
+        if self._allele_index is None:
+            self._allele_index = defaultdict(list)
+            # same variant selection as CIViCpy's search_variants_by_allele_registry_id
+            for n, (caid, has_molecular_profiles) in enumerate(
+                zip(self.index["allele_registry_id"], self.index["has_molecular_profiles"])
+            ):
+                if caid and has_molecular_profiles:
+                    self._allele_index[caid].append(n)
+        return self._allele_index
+
+    def protein_index(self):
+        """
+        Get the HGVS and protein change index, pointing to record numbers
+
+        :return: protein index
+        :rtype: CivicProteinIndex
+        """
+        if self._protein_index is None:
+            self._protein_index = CivicProteinIndex(
+                zip(self.index["entrez_name"], self.index["name"], self.index["hgvs_expressions"], range(len(self)))
+            )
+        return self._protein_index
+
+    def protein_search(self, match_keys):
+        """
+        Search the snapshot for all given queries by HGVS expression and protein change
+
+        :param match_keys: lookup keys, keyed by query
+        :type match_keys: dict
+        :return: matching CIViC variant records and the kind of key they matched, keyed by query.
+            Queries without hit are omitted
+        :rtype: dict
+        """
+        hits = self.protein_index().bulk_search(match_keys)
+        return {
+            coord_obj: ([self.get(n) for n in numbers], match_type) for coord_obj, (numbers, match_type) in hits.items()
+        }
+
+    def bulk_search(self, coord_objs, build, logger, threads=1):
+        """
+        Search the snapshot for all given CoordinateQuery objects with an exact search
+
+        :param coord_objs: coordinates to query
+        :type coord_objs: iterable
+        :param build: reference genome of the queries
+        :type build: str
+        :param threads: number of concurrent allele registry requests
+        :type threads: int
+        :return: matching CIViC variant records, keyed by query. Queries without hit are omitted
+        :rtype: dict
+        """
+        if build == "GRCh37":
+            hits = self.coordinate_index(build).bulk_search(coord_objs, search_mode="exact")
+        else:
+            hits = bulk_search_by_allele_registry(coord_objs, logger, self.allele_index(), threads)
+        return {coord_obj: [self.get(n) for n in numbers] for coord_obj, numbers in hits.items()}
+
+    def close(self):
+        if isinstance(self._records, mmap.mmap):
+            self._records.close()
+        self._file.close()
+
+
+def load_civic_snapshot(path, logger):
+    """
+    Open a CIViC snapshot, exit if it can not be read
+
+    :param path: snapshot directory
+    :type path: str
+    :return: snapshot
+    :rtype: CivicSnapshot
+    """
+    try:
+        snapshot = CivicSnapshot(path)
+    except (FileNotFoundError, ValueError) as err:
+        logger.error(f"Could not load CIViC snapshot {path}: {err}")
+        exit(1)
+    logger.info(f"Loaded CIViC snapshot {path} of {len(snapshot)} variants from {snapshot.snapshot_date}")
+    return snapshot
@@ -0,0 +1,426 @@
+""" Query CIViC directly from the TSV files of a CIViC (nightly or monthly) release, without CIViCpy """
+
+import csv
+import glob
+import hashlib
+import os
+from collections import defaultdict
+
+from querynator.query_api.civic_index import (
+    CivicCoordinateIndex,
+    CivicLocusFilter,
+    CivicProteinIndex,
+    bulk_search_by_allele_registry,
+)
+from querynator.query_api.civic_snapshot import SnapshotRecord
+
+# file name suffixes of the release files, e.g. nightly-VariantSummaries.tsv
+CIVIC_TSV_FILES = {
+    "variants": ["VariantSummaries.tsv"],
+    "molecular_profiles": ["MolecularProfileSummaries.tsv"],
+    "evidence": ["ClinicalEvidenceSummaries.tsv"],
+    "assertions": ["AssertionSummaries.tsv"],
+    "genes": ["GeneSummaries.tsv", "FeatureSummaries.tsv"],
+}
+CIVIC_TSV_REQUIRED = ["variants", "molecular_profiles", "evidence"]
+
+
+def find_civic_tsv_files(tsv_dir):
+    """
+    Find the release files of a CIViC TSV release directory
+
+    :param tsv_dir: directory of the CIViC release
+    :type tsv_dir: str
+    :return: path of each release file, keyed by its kind. Missing optional files are omitted
+    :rtype: dict
+    :raises FileNotFoundError: if a required file is missing or a file is ambiguous
+    """
+    files = {}
+    for kind, suffixes in CIVIC_TSV_FILES.items():
+        paths = sorted(path for suffix in suffixes for path in glob.glob(os.path.join(tsv_dir, f"*{suffix}")))
+        if len(paths) > 1:
+            raise FileNotFoundError(f"found more than one {kind} file in {tsv_dir}: {', '.join(paths)}")
+        if paths:
+            files[kind] = paths[0]
+        elif kind in CIVIC_TSV_REQUIRED:
+            raise FileNotFoundError(f"no *{suffixes[0]} file found in {tsv_dir}")
+    return files
+
+
+def sha256sum(path):
+    """
+    Compute the SHA-256 checksum of a file
+
+    :param path: file path
+    :type path: str
+    :return: hex digest
+    :rtype: str
+    """
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def read_civic_tsv(path):
+    """
+    Read a CIViC release file
+
+    :param path: path of the TSV file
+    :type path: str
+    :return: rows as dictionaries
+    :rtype: list
+    """
+    with open(path, newline="", encoding="utf-8") as f:
+        # the release files are not quoted, descriptions may contain quote characters
+        return list(csv.DictReader(f, delimiter="\t", quoting=csv.QUOTE_NONE))
+
+
+def tsv_list(value):
+    """
+    Split a comma separated field of a CIViC release file
+
+    :param value: field value
+    :type value: str
+    :return: values, empty for an empty field
+    :rtype: list
+    """
+    return [i.strip() for i in (value or "").split(",") if i.strip()]
+
+
+def tsv_int(value):
+    """
+    Convert an ID or position of a CIViC release file
+
+    :param value: field value
+    :type value: str
+    :return: integer, None for an empty field
+    :rtype: int
+    """
+    value = (value or "").strip()
+    return int(float(value)) if value else None
+
+
+def tsv_allele(value):
+    """
+    Convert an allele of a CIViC release file, like CIViCpy missing alleles are None
+
+    :param value: field value
+    :type value: str
+    :return: allele
+    :rtype: str
+    """
+    return None if value in [None, "", "-"] else value
+
+
+def first_field(row, *columns):
+    """
+    Get the first field of a row that is present, the column names differ between CIViC releases
+
+    :param row: row of a release file
+    :type row: dict
+    :param columns: candidate column names
+    :type columns: str
+    :return: field value, None if no column is present
+    :rtype: str
+    """
+    for column in columns:
+        if column in row:
+            return row[column]
+    return None
+
+
+def name_records(value):
+    """
+    Create the records of a comma separated list of names, e.g. therapies or phenotypes
+
+    :param value: field value
+    :type value: str
+    :return: records with a name attribute
+    :rtype: list
+    """
+    return [SnapshotRecord(name=name) for name in tsv_list(value)]
+
+
+def evidence_record(row):
+    """
+    Create the record of a row of the ClinicalEvidenceSummaries file
+
+    :param row: row of the release file
+    :type row: dict
+    :return: record with the attributes of a CIViCpy evidence object
+    :rtype: SnapshotRecord
+    """
+    evidence_id = tsv_int(row["evidence_id"])
+    disease = row.get("disease")
+    return SnapshotRecord(
+        id=evidence_id,
+        name=f"EID{evidence_id}",
+        description=row.get("evidence_statement"),
+        # CIViCpy represents a missing disease as empty dict
+        disease=SnapshotRecord(name=disease, doid=row.get("doid")) if disease else {},
+        evidence_level=row.get("evidence_level"),
+        evidence_direction=row.get("evidence_direction"),
+        evidence_type=row.get("evidence_type"),
+        phenotypes=name_records(row.get("phenotypes")),
+        rating=row.get("rating"),
+        significance=first_field(row, "significance", "clinical_significance"),
+        source=SnapshotRecord(name=row.get("citation")),
+        status=first_field(row, "evidence_status", "status"),
+        therapies=name_records(first_field(row, "therapies", "drugs")),
+        therapy_interaction_type=first_field(row, "therapy_interaction_type", "drug_interaction_type"),
+    )
+
+
+def assertion_record(row):
+    """
+    Create the record of a row of the AssertionSummaries file
+
+    :param row: row of the release file
+    :type row: dict
+    :return: record with the attributes of a CIViCpy assertion object
+    :rtype: SnapshotRecord
+    """
+    assertion_id = tsv_int(row["assertion_id"])
+    # CIViCpy represents a missing disease as empty dict
+    disease = {}
+    if row.get("disease"):
+        doid = row.get("doid") or ""
+        disease_url = f"https://www.disease-ontology.org/?id=DOID:{doid}" if doid else ""
+        disease = SnapshotRecord(name=row["disease"], doid=doid, disease_url=disease_url, aliases=[])
+    return SnapshotRecord(
+        id=assertion_id,
+        name=f"AID{assertion_id}",
+        acmg_codes=[SnapshotRecord(code=code, description="") for code in tsv_list(row.get("acmg_codes"))],
+        amp_level=first_field(row, "amp_category", "amp_level"),
+        assertion_direction=row.get("assertion_direction"),
+        assertion_type=row.get("assertion_type"),
+        description=row.get("assertion_description"),
+        disease=disease,
+        phenotypes=name_records(row.get("phenotypes")),
+        significance=first_field(row, "significance", "clinical_significance"),
+        status=first_field(row, "assertion_status", "status") or "accepted",
+        summary=row.get("assertion_summary"),
+        therapies=[
+            SnapshotRecord(name=name, ncit_id="", aliases=[])
+            for name in tsv_list(first_field(row, "therapies", "drugs"))
+        ],
+        therapy_interaction_type=first_field(row, "therapy_interaction_type", "drug_interaction_type"),
+        variant_origin=row.get("variant_origin"),
+    )
+
+
+class CivicTsvRelease:
+    """
+    CIViC variants joined from the TSV files of a CIViC release.
+
+    Evidence items and assertions are joined to their molecular profiles, molecular profiles
+    and genes to their variants. The resulting records have the attributes of the CIViCpy objects,
+    so the results are extracted the same way as from the CIViCpy cache.
+    """
+
+    def __init__(self, tsv_dir):
+        """
+        :param tsv_dir: directory of the CIViC release
+        :type tsv_dir: str
+        :raises FileNotFoundError: if a required release file is missing
+        """
+        self.path = tsv_dir
+        self.files = find_civic_tsv_files(tsv_dir)
+        self.checksums = {os.path.basename(path): sha256sum(path) for path in self.files.values()}
+        self.variants = self.join(**{kind: read_civic_tsv(path) for kind, path in self.files.items()})
+        self._coordinate_index = {}
+        self._allele_index = None
+        self._protein_index = None
+
+    @staticmethod
+    def join(variants, molecular_profiles, evidence, assertions=(), genes=()):
+        """
+        Join the rows of the release files to variant records
+
+        :return: variant records
+        :rtype: list
+        """
+        evidence_by_mp = defaultdict(list)
+        for row in evidence:
+            evidence_by_mp[tsv_int(row["molecular_profile_id"])].append(evidence_record(row))
+        assertions_by_mp = defaultdict(list)
+        for row in assertions:
+            assertions_by_mp[tsv_int(row["molecular_profile_id"])].append(assertion_record(row))
+
+        mps_by_variant = defaultdict(list)
+        for row in molecular_profiles:
+            mp_id = tsv_int(row["molecular_profile_id"])
+            mp = SnapshotRecord(
+                id=mp_id,
+                name=row.get("name"),
+                description=row.get("summary"),
+                molecular_profile_score=row.get("evidence_score"),
+                evidence=evidence_by_mp[mp_id],
+                assertions=assertions_by_mp[mp_id],
+            )
+            # like CIViCpy, only molecular profiles with evidence are reported
+            if mp.evidence:
+                for variant_id in tsv_list(row.get("variant_ids")):
+                    mps_by_variant[int(variant_id)].append(mp)
+
+        genes_by_id = {}
+        for row in genes:
+            gene_id = tsv_int(first_field(row, "gene_id", "feature_id"))
+            genes_by_id[gene_id] = SnapshotRecord(
+                id=gene_id,
+                name=row.get("name"),
+                aliases=tsv_list(row.get("aliases")),
+                description=row.get("description"),
+                entrez_id=tsv_int(row.get("entrez_id")),
+                sources=[],
+            )
+
+        records = []
+        for row in variants:
+            variant_id = tsv_int(row["variant_id"])
+            gene_id = tsv_int(first_field(row, "gene_id", "feature_id"))
+            gene_name = first_field(row, "gene", "feature_name")
+            gene = genes_by_id.get(gene_id) or SnapshotRecord(
+                id=gene_id,
+                name=gene_name,
+                aliases=[],
+                description=None,
+                entrez_id=tsv_int(row.get("entrez_id")),
+                sources=[],
+            )
+            records.append(
+                SnapshotRecord(
+                    id=variant_id,
+                    gene_id=gene_id if gene_id is not None else gene_name,
+                    name=row.get("variant"),
+                    aliases=tsv_list(row.get("variant_aliases")),
+                    types=name_records(row.get("variant_types")),
+                    clinvar_entries=tsv_list(row.get("clinvar_ids")),
+                    entrez_id=tsv_int(row.get("entrez_id")),
+                    entrez_name=gene_name,
+                    hgvs_expressions=tsv_list(row.get("hgvs_descriptions")),
+                    variant_groups=name_records(row.get("variant_groups")),
+                    allele_registry_id=row.get("allele_registry_id") or None,
+                    coordinates=SnapshotRecord(
+                        reference_build=row.get("reference_build") or None,
+                        chromosome=row.get("chromosome") or None,
+                        start=tsv_int(row.get("start")),
+                        stop=tsv_int(row.get("stop")),
+                        reference_bases=tsv_allele(row.get("reference_bases")),
+                        variant_bases=tsv_allele(row.get("variant_bases")),
+                        chromosome2=row.get("chromosome2") or None,
+                        start2=tsv_int(row.get("start2")),
+                        stop2=tsv_int(row.get("stop2")),
+                    ),
+                    gene=gene,
+                    molecular_profiles=mps_by_variant[variant_id],
+                )
+            )
+        return records
+
+    def __len__(self):
+        return len(self.variants)
+
+    @property
+    def snapshot_date(self):
+        return None
+
+    def coordinate_index(self, build):
+        """
+        Get the coordinate index of a reference build
+
+        :param build: reference genome
+        :type build: str
+        :return: coordinate index
+        :rtype: CivicCoordinateIndex
+        """
+        if build not in self._coordinate_index:
+            self._coordinate_index[build] = CivicCoordinateIndex.from_variants(self.variants, build)
+        return self._coordinate_index[build]
+
+    def locus_filter(self, build):
+        """
+        Get the CIViC-curated loci of a reference build
+
+        :param build: reference genome
+        :type build: str
+        :return: locus filter
+        :rtype: CivicLocusFilter
+        """
+        return CivicLocusFilter(self.coordinate_index(build))
+
+    def allele_index(self):
+        """
+        Get the variant records keyed by ClinGen allele registry ID (CAID)
+
+        :return: variant records keyed by CAID
+        :rtype: dict
+        """
+        if self._allele_index is None:
+            self._allele_index = defaultdict(list)
+            for variant in self.variants:
+                if variant.allele_registry_id and variant.molecular_profiles:
+                    self._allele_index[variant.allele_registry_id].append(variant)
+        return self._allele_index
+
+    def protein_index(self):
+        """
+        Get the HGVS and protein change index of the variant records
+
+        :return: protein index
+        :rtype: CivicProteinIndex
+        """
+        if self._protein_index is None:
+            self._protein_index = CivicProteinIndex.from_variants(self.variants)
+        return self._protein_index
+
+    def protein_search(self, match_keys):
+        """
+        Search the release for all given queries by HGVS expression and protein change
+
+        :param match_keys: lookup keys, keyed by query
+        :type match_keys: dict
+        :return: matching CIViC variant records and the kind of key they matched, keyed by query.
+            Queries without hit are omitted
+        :rtype: dict
+        """
+        return self.protein_index().bulk_search(match_keys)
+
+    def bulk_search(self, coord_objs, build, logger, threads=1):
+        """
+        Search the release for all given CoordinateQuery objects with an exact search
+
+        :param coord_objs: coordinates to query
+        :type coord_objs: iterable
+        :param build: reference genome of the queries
+        :type build: str
+        :param threads: number of concurrent allele registry requests
+        :type threads: int
+        :return: matching CIViC variant records, keyed by query. Queries without hit are omitted
+        :rtype: dict
+        """
+        if build == "GRCh37":
+            return self.coordinate_index(build).bulk_search(coord_objs, search_mode="exact")
+        return bulk_search_by_allele_registry(coord_objs, logger, self.allele_index(), threads)
+
+
+def load_civic_tsv_release(tsv_dir, logger):
+    """
+    Read a CIViC TSV release, exit if it is incomplete
+
+    :param tsv_dir: directory of the CIViC release
+    :type tsv_dir: str
+    :return: CIViC release
+    :rtype: CivicTsvRelease
+    """
+    try:
+        release = CivicTsvRelease(tsv_dir)
+    except (FileNotFoundError, KeyError) as err:
+        logger.error(f"Could not read CIViC TSV release {tsv_dir}: {err}")
+        exit(1)
+    for name, checksum in release.checksums.items():
+        logger.info(f"Using CIViC release file {name} (sha256 {checksum})")
+    logger.info(f"Loaded {len(release)} CIViC variants from {tsv_dir}")
+    return release
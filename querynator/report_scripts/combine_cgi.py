@@ -4,11 +4,10 @@ import os
 
 import numpy as np
 import pandas as pd
-import vcf
 
 pd.options.mode.chained_assignment = None
 
-from querynator.helper_functions import flatten, get_num_from_chr
+from querynator.report_scripts.combine_civic import read_filtered_vcf
 
 
 def remove_prefix(s, prefix):
@@ -25,102 +24,41 @@ def remove_prefix(s, prefix):
     return s[len(prefix) :] if s.startswith(prefix) else s
 
 
-def read_filtered_vcf(filtered_vcf):
+def add_merge_coords(vep_df):
     """
-    Create a table containing the VEP annotation of each variant and positional information to connect to the alterations.tsv
+    Add the positional information of each variant in CGI notation to connect the VEP table to the alterations.tsv.
+    CGI reports the first ALT allele of multiallelic records, so the merge keys are built from first_alt_VEP
 
-    :param filtered_vcf: Path to the project's VEP filtered vcf
-    :type filtered_vcf: str
-    :return: vep table
+    :param vep_df: DataFrame of variants and their VEP annotation, as created by read_filtered_vcf
+    :type vep_df: pandas DataFrame
+    :return: vep table with the additional columns chr_merge_VEP, pos_merge_VEP, ref_merge_VEP & alt_merge_VEP
+        instead of first_alt_VEP
     :rtype: pandas DataFrame
     """
-    reader = vcf.Reader(open(filtered_vcf))
-    # variant information from vcf
-    vep_headers = reader.infos["CSQ"].desc.split(":")[1].strip().split("|")
-    vep_headers.insert(0, "chr")
-    vep_headers.insert(1, "pos")
-    vep_headers.insert(2, "ref")
-    vep_headers.insert(3, "alt")
-
-    # adapted variant information to resemble cgi notation
-    vep_headers.insert(4, "chr_merge")
-    vep_headers.insert(5, "pos_merge")
-    vep_headers.insert(6, "ref_merge")
-    vep_headers.insert(7, "alt_merge")
-    record_info = []
-    count = 0
-    for record in reader:
-        vep_list = []
-        counter = 0
-        # mulitple entries
-        if len(record.INFO["CSQ"]) > 1:
-            for vep_anno in record.INFO["CSQ"]:
-                # first entry
-                if len(vep_list) == 0:
-                    vep_list = vep_anno.split("|")
-                # all later entries
-                else:
-                    for i, anno in enumerate(vep_anno.split("|")):
-                        if anno not in vep_list[i]:
-                            vep_list[i] = ",".join([i for i in sorted(flatten([vep_list[i], anno]))])
-            # remove "empty" strings (",")
-            vep_list = [i if any(i.split(",")) else "" for i in vep_list]
-
-        else:  # just one entry
-            vep_list = record.INFO["CSQ"][0].split("|")
-
-        # add variant information
-        vep_list.insert(0, get_num_from_chr(record.CHROM))
-        vep_list.insert(1, record.POS)
-        vep_list.insert(2, record.REF)
-        vep_list.insert(3, "".join(str(i) for i in record.ALT))
-
-        # add variant information for cgi merge
-        chr_merge = ""
-        pos_merge = ""
-        ref_merge = ""
-        alt_merge = ""
-
+    merge_coords = []
+    for chrom, pos, ref, alt in zip(vep_df["chr_VEP"], vep_df["pos_VEP"], vep_df["ref_VEP"], vep_df["first_alt_VEP"]):
         # if DEL or INS, variant positional information is adapted to fit to CGI notation
         # DEL
-        # if len(record.REF) > 1 & len(record.ALT[0]) == 1:
         # pos = pos+1, ref=ACGT -> CGT alt=A -> -
-        if len(record.REF) > len(record.ALT[0]):
-            chr_merge = get_num_from_chr(record.CHROM)
-            pos_merge = record.POS + 1
-            ref_merge = remove_prefix(str(record.REF), str(record.ALT[0]))
-            alt_merge = "-"
+        if len(ref) > len(alt):
+            merge_coords.append([chrom, pos + 1, remove_prefix(ref, alt), "-"])
 
         # INS
-        # elif len(record.REF) == 1 & len(record.ALT[0]) > 1
         # pos = pos, ref=A -> -, alt=ACGT -> CGT
-        elif len(record.REF) < len(record.ALT[0]):
-            chr_merge = get_num_from_chr(record.CHROM)
-            pos_merge = record.POS
-            ref_merge = "-"
-            alt_merge = remove_prefix(str(record.ALT[0]), str(record.REF))
+        elif len(ref) < len(alt):
+            merge_coords.append([chrom, pos, "-", remove_prefix(alt, ref)])
 
         # larger "symmetric" InDels (AA -> GG) & SNPs
         else:
-            chr_merge = get_num_from_chr(record.CHROM)
-            pos_merge = record.POS
-            ref_merge = record.REF
-            alt_merge = str(record.ALT[0])
-
-        vep_list.insert(4, chr_merge)
-        vep_list.insert(5, pos_merge)
-        vep_list.insert(6, ref_merge)
-        vep_list.insert(7, alt_merge)
+            merge_coords.append([chrom, pos, ref, alt])
 
-        # add vep_list to final dataframe list
-        record_info.append(vep_list)
+    merge_cols = ["chr_merge_VEP", "pos_merge_VEP", "ref_merge_VEP", "alt_merge_VEP"]
+    merge_df = pd.DataFrame(merge_coords, columns=merge_cols, index=vep_df.index)
 
-    vep_df = pd.DataFrame(record_info, columns=vep_headers)
-
-    # add VEP suffix to vep columns
-    vep_df = vep_df.add_suffix("_VEP")
-
-    return vep_df
+    # place the merge columns after the variant information
+    vep_df = vep_df.drop(columns="first_alt_VEP")
+    alt_idx = vep_df.columns.get_loc("alt_VEP") + 1
+    return pd.concat([vep_df.iloc[:, :alt_idx], merge_df, vep_df.iloc[:, alt_idx:]], axis=1)
 
 
 def extract_coords(row):
@@ -366,7 +304,7 @@ def filter_biomarkers(biomarkers_df: pd.DataFrame, logger) -> pd.DataFrame:
     return biomarkers_df.loc[filter]
 
 
-def combine_cgi(cgi_path, outdir, logger):
+def combine_cgi(cgi_path, outdir, logger, transcript_mode="all", vep_df=None):
     """
     Command to combine the cgi results with the vcf's VEP annotation
 
@@ -374,6 +312,10 @@ def combine_cgi(cgi_path, outdir, logger):
     :type cgi_path: str
     :param outdir: Path to report directory
     :type outdir: str
+    :param transcript_mode: CSQ entries reported per variant, one of TRANSCRIPT_MODES
+    :type transcript_mode: str
+    :param vep_df: VEP table of the CGI run's filtered vcf, read from the result folder if None
+    :type vep_df: pandas DataFrame
     :return: None
     :rtype: None
     """
@@ -389,7 +331,10 @@ def combine_cgi(cgi_path, outdir, logger):
     biomarkers_df = pd.read_csv(biomarkers_path, sep="\t")
 
     # combine cgi & vep
-    vep_df = read_filtered_vcf(filtered_vcf)
+    if vep_df is None:
+        vep_df = read_filtered_vcf(filtered_vcf, transcript_mode)
+    # the querynator ID is taken from the CIViC results when both are combined
+    vep_df = add_merge_coords(vep_df.drop(columns="querynator_id"))
     alterations_df = read_modify_alterations(alterations_path)
     merged_df = merge_alterations_vep(vep_df, alterations_df)
 
@@ -1,7 +1,78 @@
 """ Combine CIViC-VEP with CGI-VEP """
 
+import hashlib
+import os
+import re
+
 import pandas as pd
 
+from querynator.report_scripts.combine_civic import read_filtered_vcf
+
+# querynator IDs of a record, ignored to compare results written by older versions, which assigned random IDs
+QID_PATTERN = re.compile(rb"(?<=[\t;])QID=[^;\t\r\n]*")
+
+
+def vcf_digest(vcf_path):
+    """
+    Hash a vcf file without its querynator IDs. The file is read as bytes, its records are not parsed
+
+    :param vcf_path: Path to an uncompressed vcf file
+    :type vcf_path: str
+    :return: hex digest
+    :rtype: str
+    """
+    digest = hashlib.sha1()
+    with open(vcf_path, "rb") as f:
+        for line in f:
+            digest.update(QID_PATTERN.sub(b"QID=", line))
+    return digest.hexdigest()
+
+
+def read_shared_vep_table(cgi_path, civic_path, logger, transcript_mode="all"):
+    """
+    Read the VEP table once for both combine steps
+
+    The CIViC run's filtered vcf is parsed. The table is only shared if the CGI run filtered the same variants,
+    as the CGI results are connected to it via the variant positions. Both filtered vcfs are written by
+    querynator from the same input, so they are compared by a hash of their content apart from the querynator IDs.
+    The comparison reads both files once more as bytes, which also catches differences in the VEP annotation
+
+    :param cgi_path: Path to a CGI result folder generated using the querynator
+    :type cgi_path: str
+    :param civic_path: Path to a CIViC result folder generated using the querynator
+    :type civic_path: str
+    :param logger: the logger
+    :type logger: logger object
+    :param transcript_mode: CSQ entries reported per variant, one of TRANSCRIPT_MODES
+    :type transcript_mode: str
+    :return: vep table of the CIViC run & vep table for the CGI run, None if it has to be read separately
+    :rtype: tuple
+    """
+    civic_vcf = f"{civic_path}/vcf_files/{os.path.basename(civic_path)}.filtered_variants.vcf"
+    cgi_vcf = f"{cgi_path}/vcf_files/{os.path.basename(cgi_path)}.filtered_variants.vcf"
+
+    vep_df = read_filtered_vcf(civic_vcf, transcript_mode)
+
+    if vcf_digest(civic_vcf) == vcf_digest(cgi_vcf):
+        return vep_df, vep_df
+
+    logger.warning("The CGI and CIViC results are based on different variants, reading their VEP annotation separately")
+    return vep_df, None
+
+
+def read_vep_table(vep_path):
+    """
+    read a combined VEP table, keeping the VEP annotation as written.
+    Without it, integer VEP columns containing empty fields would be written back as floats
+
+    :param vep_path: Path to the combined VEP table
+    :type vep_path: str
+    :return: DataFrame of variants and their VEP & knowledgebase annotations
+    :rtype: pandas DataFrame
+    """
+    columns = pd.read_csv(vep_path, sep="\t", nrows=0).columns
+    return pd.read_csv(vep_path, sep="\t", dtype={col: str for col in columns if col.endswith("_VEP")})
+
 
 def merge_civic_cgi(alterations_vep, civic_vep):
     """
@@ -23,20 +94,12 @@ def merge_civic_cgi(alterations_vep, civic_vep):
         civic_vep[i] = civic_vep[i].astype(str)
         alterations_vep[i] = alterations_vep[i].astype(str)
 
-    # merge
-    vep_civic_cgi_merge = alterations_vep.merge(
-        civic_vep, on=["chr_VEP", "pos_VEP", "ref_VEP", "alt_VEP"], suffixes=("_cgi", "_civic"), how="left"
-    )
-
-    # remove all unnecessary VEP cols
-    vep_civic_cgi_merge = vep_civic_cgi_merge[
-        [col for col in vep_civic_cgi_merge.columns if not col.endswith("_VEP_civic")]
-    ]
+    # both share the same VEP annotation, only take the positional VEP cols from CIViC
+    merge_cols = ["chr_VEP", "pos_VEP", "ref_VEP", "alt_VEP"]
+    civic_vep = civic_vep[[col for col in civic_vep.columns if col in merge_cols or not col.endswith("_VEP")]]
 
-    # rename VEP columns
-    vep_civic_cgi_merge.columns = [
-        col.replace("_VEP_cgi", "_VEP") if col.endswith("_VEP_cgi") else col for col in vep_civic_cgi_merge.columns
-    ]
+    # merge
+    vep_civic_cgi_merge = alterations_vep.merge(civic_vep, on=merge_cols, suffixes=("_cgi", "_civic"), how="left")
 
     return vep_civic_cgi_merge
 
@@ -53,8 +116,8 @@ def combine_cgi_civic(outdir, logger):
     logger.info("Combining CIViC-VEP & CGI-VEP")
 
     # read in the files
-    alterations_vep = pd.read_csv(f"{outdir}/combined_files/alterations_vep.tsv", sep="\t")
-    civic_vep = pd.read_csv(f"{outdir}/combined_files/civic_vep.tsv", sep="\t")
+    alterations_vep = read_vep_table(f"{outdir}/combined_files/alterations_vep.tsv")
+    civic_vep = read_vep_table(f"{outdir}/combined_files/civic_vep.tsv")
 
     vep_civic_cgi_merge = merge_civic_cgi(alterations_vep, civic_vep)
 
@@ -1,62 +1,62 @@
 """ Combine the results of the CIViC query with the initial VEP annotation """
 
+import glob
 import os
 
 import numpy as np
 import pandas as pd
-import vcf
 
-from querynator.helper_functions import flatten, get_num_from_chr
+from querynator.helper_functions import (
+    CsqSchema,
+    collapse_csq,
+    get_num_from_chr,
+    open_vcf_reader,
+    select_csq,
+)
+from querynator.query_api.civic_api import get_disease_label
 
 
-def read_filtered_vcf(filtered_vcf):
+def read_filtered_vcf(filtered_vcf, transcript_mode="all"):
     """
     Create a table containing the VEP annotation of each variant
 
     :param filtered_vcf: Path to the project's VEP filtered vcf
     :type filtered_vcf: str
-    :return: vep table
+    :param transcript_mode: CSQ entries reported per variant, one of TRANSCRIPT_MODES
+    :type transcript_mode: str
+    :return: vep table, first_alt_VEP holds the first ALT allele of multiallelic records
     :rtype: pandas DataFrame
     """
     # read in filtered and normalized vcf file
-    reader = vcf.Reader(open(filtered_vcf))
-
-    vep_headers = reader.infos["CSQ"].desc.split(":")[1].strip().split("|")
-    vep_headers.insert(0, "querynator_id")
-    vep_headers.insert(1, "chr")
-    vep_headers.insert(2, "pos")
-    vep_headers.insert(3, "ref")
-    vep_headers.insert(4, "alt")
-
-    record_info = []
-    for record in reader:
-        vep_list = []
-        # mulitple entries
-        if len(record.INFO["CSQ"]) > 1:
-            for vep_anno in record.INFO["CSQ"]:
-                # first entry
-                if len(vep_list) == 0:
-                    vep_list = vep_anno.split("|")
-                # all later entries
-                else:
-                    for i, anno in enumerate(vep_anno.split("|")):
-                        if anno not in vep_list[i]:
-                            vep_list[i] = ",".join([i for i in sorted(flatten([vep_list[i], anno]))])
-            # remove "empty" strings (",")
-            vep_list = [i if any(i.split(",")) else "" for i in vep_list]
-
-        else:  # just one entry
-            vep_list = record.INFO["CSQ"][0].split("|")
-
-        # add coords & querynator ID
-        vep_list.insert(0, int("".join(record.INFO["QID"])))
-        vep_list.insert(1, get_num_from_chr(record.CHROM))
-        vep_list.insert(2, record.POS)
-        vep_list.insert(3, record.REF)
-        vep_list.insert(4, "".join(str(i) for i in record.ALT))
-
-        # add vep_list to final dataframe list
-        record_info.append(vep_list)
+    with open_vcf_reader(filtered_vcf) as reader:
+
+        # compile the CSQ field offsets once, each annotation is split once
+        csq_schema = CsqSchema.from_header(reader)
+        decode = csq_schema.decoder()
+        vep_headers = list(csq_schema.fields)
+        vep_headers.insert(0, "querynator_id")
+        vep_headers.insert(1, "chr")
+        vep_headers.insert(2, "pos")
+        vep_headers.insert(3, "ref")
+        vep_headers.insert(4, "alt")
+        # the CGI merge keys are built from the first ALT allele, see combine_cgi.add_merge_coords
+        vep_headers.insert(5, "first_alt")
+
+        record_info = []
+        for record in reader:
+            # collapse multiple entries (e.g. one per transcript) into one value per field
+            vep_list = collapse_csq(select_csq(record.INFO["CSQ"], csq_schema, transcript_mode), decode)
+
+            # add coords & querynator ID
+            vep_list.insert(0, int("".join(record.INFO["QID"])))
+            vep_list.insert(1, get_num_from_chr(record.CHROM))
+            vep_list.insert(2, record.POS)
+            vep_list.insert(3, record.REF)
+            vep_list.insert(4, "".join(str(i) for i in record.ALT))
+            vep_list.insert(5, str(record.ALT[0]))
+
+            # add vep_list to final dataframe list
+            record_info.append(vep_list)
 
     vep_df = pd.DataFrame(record_info, columns=vep_headers)
 
@@ -105,7 +105,43 @@ def merge_civic_vep(vep_df, civic_df):
     return civic_df.merge(vep_df, on="querynator_id", suffixes=("_vep", "_civic"), how="left")
 
 
-def combine_civic(civic_path, outdir, logger):
+def get_civic_results_path(civic_path, logger, cancer=None):
+    """
+    Get the path of the CIViC result table to report.
+    Results of several cancer types are written to one table per cancer type, of which one has to be chosen
+
+    :param civic_path: Path to a CIViC result folder generated using the querynator
+    :type civic_path: str
+    :param logger: the logger
+    :type logger: logger object
+    :param cancer: DOID of the cancer type (e.g. DOID:1909) of which the result table is reported
+    :type cancer: str
+    :return: path of the CIViC result table
+    :rtype: str
+    """
+    dirname, basename = os.path.split(civic_path)
+    if cancer:
+        civic_results = f"{civic_path}/{basename}.{get_disease_label(cancer, None)}.civic_results.tsv"
+    else:
+        civic_results = f"{civic_path}/{basename}.civic_results.tsv"
+
+    if not os.path.isfile(civic_results):
+        labels = [
+            os.path.basename(i)[len(basename) + 1 : -len(".civic_results.tsv")]
+            for i in sorted(glob.glob(f"{glob.escape(civic_path)}/{glob.escape(basename)}.*.civic_results.tsv"))
+        ]
+        if labels:
+            logger.error(
+                f"No CIViC result table {os.path.basename(civic_results)} found. The CIViC results were created for "
+                f"several cancer types, choose one of {', '.join(labels)} with --civic_cancer"
+            )
+        else:
+            logger.error(f"No CIViC result table found in {civic_path}")
+        exit(1)
+    return civic_results
+
+
+def combine_civic(civic_path, outdir, logger, transcript_mode="all", vep_df=None, civic_results=None):
     """
     Command to combine the civic results with the vcf's VEP annotation
 
@@ -113,6 +149,12 @@ def combine_civic(civic_path, outdir, logger):
     :type civic_path: str
     :param outdir: Path to report directory
     :type outdir: str
+    :param transcript_mode: CSQ entries reported per variant, one of TRANSCRIPT_MODES
+    :type transcript_mode: str
+    :param vep_df: VEP table of the CIViC run's filtered vcf, read from the result folder if None
+    :type vep_df: pandas DataFrame
+    :param civic_results: CIViC result table as returned by get_civic_results_path, the single table if None
+    :type civic_results: str
     :return: None
     :rtype: None
     """
@@ -122,12 +164,14 @@ def combine_civic(civic_path, outdir, logger):
         # get necessary files from result path
         dirname, basename = os.path.split(civic_path)
         filtered_vcf = f"{civic_path}/vcf_files/{basename}.filtered_variants.vcf"
-        civic_results = f"{civic_path}/{basename}.civic_results.tsv"
+        if civic_results is None:
+            civic_results = f"{civic_path}/{basename}.civic_results.tsv"
 
-        vep_df = read_filtered_vcf(filtered_vcf)
+        if vep_df is None:
+            vep_df = read_filtered_vcf(filtered_vcf, transcript_mode)
         civic_df = read_civic_results(civic_results)
-        # combine results
-        merged_df = merge_civic_vep(vep_df, civic_df)
+        # combine results, the first ALT allele is only needed to connect the CGI results
+        merged_df = merge_civic_vep(vep_df.drop(columns="first_alt_VEP"), civic_df)
 
         # add merged df to outdir
         merged_df.to_csv(f"{outdir}/combined_files/civic_vep.tsv", sep="\t", index=False)
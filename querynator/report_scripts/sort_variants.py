@@ -7,6 +7,8 @@
 import numpy as np
 import pandas as pd
 
+from querynator.report_scripts.combine_cgi_civic import read_vep_table
+
 # ============================================================================ #
 #                      ASSIGN VARIANTS TO TIERS
 # ============================================================================ #
@@ -491,13 +493,15 @@ def add_tiers_and_scores_to_df(outdir, logger):
     :rtype: None
     """
     logger.info("Assigning variants to tiers")
-    vep_civic_cgi_merge = pd.read_csv(f"{outdir}/combined_files/civic_cgi_vep.tsv", sep="\t")
+    # tiers & scores need the allele frequencies as numbers, the written table keeps the VEP annotation as is
+    variants = pd.read_csv(f"{outdir}/combined_files/civic_cgi_vep.tsv", sep="\t")
+    vep_civic_cgi_merge = read_vep_table(f"{outdir}/combined_files/civic_cgi_vep.tsv")
 
     # add tiers
-    vep_civic_cgi_merge["report_tier"] = vep_civic_cgi_merge.apply(lambda x: subset_variants_into_tiers(x), axis=1)
+    vep_civic_cgi_merge["report_tier"] = variants.apply(lambda x: subset_variants_into_tiers(x), axis=1)
 
     # add ranking-score
-    vep_civic_cgi_merge["ranking_score"] = vep_civic_cgi_merge.apply(lambda x: scoring_variants(x), axis=1)
+    vep_civic_cgi_merge["ranking_score"] = variants.apply(lambda x: scoring_variants(x), axis=1)
 
     # write tiers & scores to result dir
     vep_civic_cgi_merge.to_csv(f"{outdir}/combined_files/civic_cgi_vep.tsv", sep="\t", index=False)
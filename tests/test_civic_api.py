@@ -0,0 +1,887 @@
+#!/usr/bin/env python
+
+"""Tests for the CIViC query functions that run without the CIViCpy cache."""
+
+import csv
+import logging
+import os
+import tempfile
+import time
+import unittest
+from datetime import datetime
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+from civicpy import civic
+
+from querynator.helper_functions import CsqSchema, ontology
+from querynator.query_api.civic_api import (
+    CIVIC_FIELD_PROFILES,
+    ExtractionMemo,
+    access_civic_by_coordinate,
+    compile_evidence_filter,
+    create_civic_results,
+    disease_is_allowed,
+    get_allowed_disease_keys,
+    get_assertion_information_from_variant,
+    get_civic_result,
+    get_coordinates_from_vcf,
+    get_evidence_information_from_variant,
+    get_gene_information_from_variant,
+    get_molecular_profile_information_from_variant,
+    get_variant_information_from_variant,
+    get_vep_match_keys,
+    load_civic_cache,
+    read_cached_results,
+    resolve_civic_fields,
+    write_civic_results,
+)
+from querynator.query_api.civic_index import (
+    CivicCoordinateIndex,
+    CivicLocusFilter,
+    CivicProteinIndex,
+    get_allele_index,
+    get_coordinate_index,
+    hgvs_keys,
+    protein_change,
+    resolve_allele_registry_ids,
+)
+from querynator.query_api.civic_result_cache import CivicResultCache
+from querynator.query_api.civic_snapshot import CivicSnapshot, write_civic_snapshot
+from querynator.query_api.civic_tsv import CivicTsvRelease
+
+
+def fake_variant(variant_id, chrom, start, stop, ref, alt, build="GRCh37", **coordinates):
+    """create an object resembling a CIViCpy variant with the given coordinates"""
+    return SimpleNamespace(
+        id=variant_id,
+        coordinates=SimpleNamespace(
+            chromosome=chrom,
+            start=start,
+            stop=stop,
+            reference_bases=ref,
+            variant_bases=alt,
+            reference_build=build,
+            chromosome2=coordinates.get("chromosome2"),
+            start2=coordinates.get("start2"),
+            stop2=coordinates.get("stop2"),
+        ),
+    )
+
+
+class testCivicCoordinateIndex(unittest.TestCase):
+    """Test the local CIViC coordinate index"""
+
+    def setUp(self):
+        self.braf = fake_variant(12, "7", 140453136, 140453136, "A", "T")
+        self.braf_region = fake_variant(13, "7", 140453100, 140453200, None, None)
+        self.egfr_del = fake_variant(33, "7", 55242465, 55242479, "GGAATTAAGAGAAGC", None)
+        self.fusion = fake_variant(
+            5, "22", 23522552, 23632600, None, None, chromosome2="9", start2=133729451, stop2=133763062
+        )
+        self.grch38 = fake_variant(99, "7", 140753336, 140753336, "A", "T", build="GRCh38")
+        self.index = CivicCoordinateIndex.from_variants(
+            [self.braf, self.braf_region, self.egfr_del, self.fusion, self.grch38], "GRCh37"
+        )
+
+    def query(self, chrom, start, stop, ref, alt):
+        return civic.CoordinateQuery(chr=chrom, start=start, stop=stop, ref=ref, alt=alt, build="GRCh37")
+
+    def test_exact(self):
+        """Test exact coordinate and allele matching"""
+        self.assertEqual(self.index.search(self.query("7", 140453136, 140453136, "A", "T")), [self.braf])
+        self.assertEqual(self.index.search(self.query("7", 140453136, 140453136, "A", "G")), [])
+        self.assertEqual(self.index.search(self.query("7", 140453136, 140453136, "*", "*")), [self.braf])
+        self.assertEqual(
+            self.index.search(self.query("7", 55242465, 55242479, "GGAATTAAGAGAAGC", None)), [self.egfr_del]
+        )
+        self.assertEqual(self.index.search(self.query("7", 55242465, 55242479, "GGAATTAAGAGAAGC", "")), [])
+        with self.assertRaises(ValueError):
+            self.index.search(self.query("7", 140453136, 140453136, "A", "-"))
+
+    def test_overlap(self):
+        """Test overlap based search modes"""
+        query = self.query("7", 140453130, 140453140, "*", "*")
+        self.assertEqual(self.index.search(query, "any"), [self.braf_region, self.braf])
+        self.assertEqual(self.index.search(query, "query_encompassing"), [self.braf])
+        self.assertEqual(self.index.search(query, "record_encompassing"), [self.braf_region])
+        self.assertEqual(self.index.search(self.query("9", 133730000, 133730000, "*", "*"), "any"), [self.fusion])
+
+    def test_build(self):
+        """Test that only coordinates of the requested build are indexed"""
+        self.assertEqual(len(self.index), 5)
+        self.assertEqual(self.index.search(self.query("7", 140753336, 140753336, "A", "T")), [])
+
+    def test_bulk_search(self):
+        """Test that bulk search only reports queries with hits"""
+        hit = self.query("7", 140453136, 140453136, "A", "T")
+        miss = self.query("1", 1000, 1000, "C", "G")
+        self.assertEqual(self.index.bulk_search([miss, hit]), {hit: [self.braf]})
+
+    def test_locus_filter(self):
+        """Test that only vcf records near CIViC-curated loci are queried"""
+        locus_filter = CivicLocusFilter(self.index)
+        # BRAF variant and region are merged
+        self.assertEqual(len(locus_filter), 4)
+        self.assertTrue(locus_filter.overlaps("7", 140453201, 140453300))
+        self.assertFalse(locus_filter.overlaps("7", 140453202, 140453300))
+        self.assertFalse(locus_filter.overlaps("X", 1, 1000))
+
+        def record(chrom, pos, ref, alt):
+            return SimpleNamespace(
+                CHROM=chrom, POS=pos, start=pos - 1, end=pos + len(ref) - 1, REF=ref, ALT=[alt], INFO={"QID": pos}
+            )
+
+        records = [
+            record("chr7", 140453136, "A", "T"),
+            record("chr7", 55242464, "AGGAATTAAGAGAAGC", "A"),
+            record("chr1", 1000, "C", "G"),
+        ]
+        coord_dict = get_coordinates_from_vcf(records, "GRCh37", logging.getLogger("Querynator"), None, locus_filter)
+        self.assertEqual(sorted(coord_dict.values()), [55242464, 140453136])
+        self.assertEqual(self.index.bulk_search(coord_dict).keys(), {list(coord_dict)[0]})
+
+
+class testAlleleRegistry(unittest.TestCase):
+    """Test the bulk resolution of allele registry IDs"""
+
+    def test_resolve_allele_registry_ids(self):
+        """Test that queries are sent in chunks and mapped back in order"""
+        snv = civic.CoordinateQuery(chr="7", start=140753336, stop=140753336, ref="A", alt="T", build="GRCh38")
+        unregistered = civic.CoordinateQuery(chr="1", start=1000, stop=1000, ref="C", alt="G", build="GRCh38")
+        deletion = civic.CoordinateQuery(
+            chr="7", start=55174772, stop=55174786, ref="GGAATTAAGAGAAGC", alt="", build="GRCh38"
+        )
+        responses = [
+            [{"@id": "http://reg.genome.network/allele/CA123643"}, {"@id": "_:CA"}],
+            [{"@id": "http://reg.genome.network/allele/CA133641"}],
+        ]
+        with mock.patch("requests.Session.post") as post:
+            post.return_value.json.side_effect = responses
+            caids = resolve_allele_registry_ids([snv, unregistered, deletion], chunk_size=2)
+
+        self.assertEqual(caids, {snv: "CA123643", deletion: "CA133641"})
+        self.assertEqual(post.call_count, 2)
+        self.assertEqual(post.call_args_list[0].kwargs["data"], "NC_000007.14:g.140753336A>T\nNC_000001.11:g.1000C>G")
+        self.assertEqual(post.call_args_list[1].kwargs["data"], "NC_000007.14:g.55174772_55174786del")
+
+
+class testCivicpyIndexes(unittest.TestCase):
+    """Test that the indexes of the CIViCpy cache select the same variants as CIViCpy's searches"""
+
+    def setUp(self):
+        # CIViCpy records of variants with accepted, rejected, submitted and without evidence
+        self.cache = {}
+        with mock.patch.object(civic, "CACHE", self.cache):
+            self.variants = []
+            for variant_id, status in [(1, "accepted"), (2, "rejected"), (3, "submitted"), (4, None)]:
+                variant = civic.Variant(
+                    id=variant_id,
+                    partial=True,
+                    allele_registry_id=f"CA{variant_id}",
+                    coordinates={
+                        "chromosome": "7",
+                        "start": 140453130 + variant_id,
+                        "stop": 140453130 + variant_id,
+                        "reference_bases": "A",
+                        "variant_bases": "T",
+                    },
+                )
+                profile = civic.MolecularProfile(type="molecular_profile", id=variant_id, partial=True)
+                evidence = civic.Evidence(type="evidence", id=variant_id, partial=True, status=status)
+                profile.evidence_items = [evidence] if status else []
+                variant.molecular_profiles = [profile]
+                for record in [variant, profile] + profile.evidence_items:
+                    record._partial = False
+                    self.cache[hash(record)] = record
+                self.variants.append(variant)
+            self.cache.update(
+                variants_all_ids=[1, 2, 3, 4],
+                evidence_items_all_ids=[1, 2, 3],
+                assertions_all_ids=[0],
+                full_cached=datetime.now(),
+            )
+
+    def test_search(self):
+        """Test that coordinate and allele registry lookups agree with CIViCpy's searches"""
+        with mock.patch.multiple(
+            civic,
+            CACHE=self.cache,
+            COORDINATE_TABLE=None,
+            COORDINATE_TABLE_START=None,
+            COORDINATE_TABLE_STOP=None,
+            COORDINATE_TABLE_CHR=None,
+        ):
+            civic._build_coordinate_table(self.variants)
+            for variant in self.variants:
+                query = civic.CoordinateQuery(
+                    chr="7", start=variant.coordinates.start, stop=variant.coordinates.stop, ref="A", alt="T"
+                )
+                self.assertEqual(
+                    get_coordinate_index("GRCh37").search(query),
+                    civic.search_variants_by_coordinates(query, search_mode="exact"),
+                )
+                self.assertEqual(
+                    get_allele_index().get(variant.allele_registry_id, []),
+                    civic.search_variants_by_allele_registry_id(variant.allele_registry_id),
+                )
+            # evidence of every status is reported
+            self.assertEqual([len(i.molecular_profiles) for i in get_allele_index()["CA2"]], [1])
+
+
+class testEvidenceFilter(unittest.TestCase):
+    """Test the compiled evidence filters"""
+
+    def evidence(self, level, evidence_type, status="accepted", rating=3):
+        return SimpleNamespace(
+            evidence_level=level,
+            evidence_type=evidence_type,
+            significance="Sensitivity/Response",
+            rating=rating,
+            status=status,
+            evidence_direction="Supports",
+        )
+
+    def test_compile_evidence_filter(self):
+        """Test levels, accepted values and combined filters"""
+        filters = {"level": ["c", "b"], "type": ["predictive", "diagnostic"], "rating": ["3", "4"]}
+        passes = compile_evidence_filter(filters)
+        self.assertTrue(passes(self.evidence("A", "Predictive")))
+        self.assertTrue(passes(self.evidence("B", "Diagnostic")))
+        self.assertFalse(passes(self.evidence("C", "Predictive")))
+        self.assertFalse(passes(self.evidence("A", "Prognostic")))
+        self.assertFalse(passes(self.evidence("A", "Predictive", rating=2)))
+        self.assertTrue(compile_evidence_filter({})(self.evidence("E", "Prognostic")))
+        self.assertIs(compile_evidence_filter(dict(filters)), passes)
+        self.assertFalse(
+            compile_evidence_filter({"status": ["accepted"]})(self.evidence("A", "Predictive", "submitted"))
+        )
+
+
+class testAllowedDiseases(unittest.TestCase):
+    """Test the matching of evidence diseases against the allowed diseases"""
+
+    def test_disease_is_allowed(self):
+        """Test case insensitive matching by name and DOID"""
+        cancer = ontology.Ontology.Term({"id": "DOID:162", "name": "cancer"})
+        allowed = get_allowed_disease_keys([cancer, ontology.Ontology.Term({"id": "DOID:4"})])
+        self.assertEqual(allowed, frozenset(["doid:162", "cancer", "doid:4"]))
+        self.assertTrue(disease_is_allowed(SimpleNamespace(name="Cancer", doid=None), allowed))
+        self.assertTrue(disease_is_allowed(SimpleNamespace(name="DOID:4", doid=None), allowed))
+        self.assertTrue(disease_is_allowed(SimpleNamespace(name="renamed cancer", doid="162"), allowed))
+        self.assertFalse(disease_is_allowed(SimpleNamespace(name="Melanoma", doid="1909"), allowed))
+
+
+class testExtractionMemo(unittest.TestCase):
+    """Test the per-run memo of extracted CIViC information"""
+
+    def setUp(self):
+        self.variant = fake_variant(12, "7", 140453136, 140453136, "A", "T")
+        self.variant.gene_id = 5
+        self.coords = [
+            civic.CoordinateQuery(chr="7", start=140453136, stop=140453136, ref="A", alt="T", build="GRCh37"),
+            civic.CoordinateQuery(chr="7", start=140453136, stop=140453136, ref="*", alt="T", build="GRCh37"),
+        ]
+
+    def test_memo(self):
+        """Test that every variant and gene is extracted once and evidence once per filter set"""
+        memo = ExtractionMemo()
+        extract = "querynator.query_api.civic_api.get_{}_information_from_variant"
+        groups = ["variant", "gene", "molecular_profile", "assertion"]
+        patches = {group: mock.patch(extract.format(group), return_value={group: group}) for group in groups}
+        patches["evidence"] = mock.patch(
+            "querynator.query_api.civic_api.get_evidence_items_from_variant", return_value=[]
+        )
+        mocks = {group: patch.start() for group, patch in patches.items()}
+        self.addCleanup(mock.patch.stopall)
+
+        rows = [
+            get_civic_result({coord: 1000001}, [self.variant], (None, None), False, filters, memo)[0]
+            for coord in self.coords
+            for filters in [{}, {"type": ["predictive"]}]
+        ]
+
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[0]["variant"], "variant")
+        for group in ["variant", "gene", "molecular_profile", "assertion"]:
+            self.assertEqual(mocks[group].call_count, 1)
+        self.assertEqual(mocks["evidence"].call_count, 2)
+        self.assertEqual(memo.hits["variant"], 3)
+        self.assertEqual(memo.misses["evidence"], 2)
+
+
+class testCivicFields(unittest.TestCase):
+    """Test the selection of CIViC result columns"""
+
+    def test_resolve_civic_fields(self):
+        """Test profiles, groups and columns"""
+        self.assertIsNone(resolve_civic_fields("full"))
+        self.assertIsNone(resolve_civic_fields("variant,gene,mol_profile,assertion,evidence"))
+        self.assertEqual(
+            resolve_civic_fields("evidence_level, Gene,assertion_amp_level"),
+            ("gene_name", "gene_aliases", "gene_description", "gene_entrez_id", "gene_source")
+            + ("assertion_amp_level", "evidence_level"),
+        )
+        self.assertEqual(resolve_civic_fields("minimal,evidence_name"), tuple(CIVIC_FIELD_PROFILES["minimal"]))
+        with self.assertRaises(ValueError):
+            resolve_civic_fields("evidence_summary")
+
+    def test_fields(self):
+        """Test that groups without selected column are not extracted"""
+        query = civic.CoordinateQuery(chr="7", start=140453136, stop=140453136, ref="A", alt="T", build="GRCh37")
+        variant = annotated_fake_variant(12, "7", 140453136, 140453136, "A", "T")
+        memo = ExtractionMemo()
+        fields = resolve_civic_fields("minimal")
+        row, evidence_rows = get_civic_result({query: 1000001}, [variant], (None, None), True, {}, memo, fields)
+
+        self.assertEqual(
+            list(row),
+            ["chr", "start", "stop", "ref", "alt", "querynator_id"] + CIVIC_FIELD_PROFILES["minimal"],
+        )
+        self.assertEqual(row["evidence_level"], "A,B")
+        self.assertEqual(set(memo.misses), {"variant", "gene", "assertion", "evidence items", "evidence"})
+
+    def test_fields_without_evidence(self):
+        """Test that evidence items are not touched and no evidence table is written without evidence column"""
+        query = civic.CoordinateQuery(chr="7", start=140453136, stop=140453136, ref="A", alt="T", build="GRCh37")
+        variant_list = [[{query: 1000001}, [annotated_fake_variant(12, "7", 140453136, 140453136, "A", "T")]]]
+        fields = resolve_civic_fields("gene,assertion_amp_level")
+        logger = logging.getLogger("Querynator")
+        with tempfile.TemporaryDirectory() as tmp_dir, mock.patch(
+            "querynator.query_api.civic_api.get_evidence_items_from_variant"
+        ) as get_evidence_items:
+            out_path = os.path.join(tmp_dir, "sample")
+            create_civic_results(variant_list, out_path, None, logger, True, {}, fields=fields)
+            self.assertEqual(sorted(os.listdir(out_path)), ["sample.civic_results.tsv"])
+
+            # variants that are not cached yet are annotated the same way
+            cache = CivicResultCache(os.path.join(tmp_dir, "cache"), "2024-01-01")
+            create_civic_results(variant_list, out_path, None, logger, True, {}, 1, cache, {query: 1000001}, fields)
+            cache.close()
+        get_evidence_items.assert_not_called()
+
+
+def annotated_fake_variant(variant_id, chrom, start, stop, ref, alt, **coordinates):
+    """create a fake CIViCpy variant with gene, molecular profile and evidence"""
+    name = SimpleNamespace
+    variant = fake_variant(variant_id, chrom, start, stop, ref, alt, **coordinates)
+    evidence = [
+        name(
+            id=variant_id * 10 + i,
+            name=f"EID{variant_id * 10 + i}",
+            description="evidence description",
+            disease=disease,
+            evidence_level=level,
+            evidence_direction="Supports",
+            evidence_type="Predictive",
+            phenotypes=[],
+            rating=3,
+            significance="Sensitivity/Response",
+            source=name(name="Source"),
+            status="accepted",
+            therapies=[name(name="Vemurafenib"), name(name="Cobimetinib")],
+            therapy_interaction_type="Combination",
+        )
+        for i, (disease, level) in enumerate([(name(name="Melanoma", doid="1909"), "A"), ({}, "B")])
+    ]
+    variant.__dict__.update(
+        gene_id=5,
+        name="V600E",
+        aliases=["VAL600GLU"],
+        types=[name(name="Missense Variant")],
+        clinvar_entries=["13961"],
+        entrez_id=673,
+        entrez_name="BRAF",
+        hgvs_expressions=["NM_004333.4:c.1799T>A"],
+        variant_groups=[],
+        allele_registry_id=f"CA{variant_id}",
+        gene=name(name="BRAF", aliases=["B-RAF1"], description="gene description", entrez_id=673, sources=[]),
+        molecular_profiles=[
+            name(
+                id=variant_id,
+                name="BRAF V600E",
+                description="",
+                molecular_profile_score=1.5,
+                evidence=evidence,
+                assertions=[],
+            )
+        ],
+    )
+    return variant
+
+
+class testProteinIndex(unittest.TestCase):
+    """Test matching CIViC variants by HGVS expression and protein change"""
+
+    def setUp(self):
+        self.braf = annotated_fake_variant(12, "7", 140453136, 140453136, "A", "T")
+        self.braf.hgvs_expressions = ["NM_004333.4:c.1799T>A", "NP_004324.2:p.Val600Glu"]
+        self.kras = fake_variant(30, "12", 25398284, 25398284, "C", "A")
+        self.kras.__dict__.update(entrez_name="KRAS", name="G12V", hgvs_expressions=[])
+        self.index = CivicProteinIndex.from_variants([self.braf, self.kras])
+
+    def test_protein_change(self):
+        """Test the conversion of HGVS protein expressions"""
+        self.assertEqual(protein_change("ENSP00000288602.6:p.Val600Glu"), "V600E")
+        self.assertEqual(protein_change("p.(Gly12Ter)"), "G12*")
+        self.assertEqual(protein_change("ENSP00000288602.6:p.Leu597%3D"), "L597=")
+        self.assertIsNone(protein_change("NM_004333.4:c.1799T>A"))
+
+    def test_search(self):
+        """Test that HGVS expressions are preferred over protein changes"""
+        self.assertEqual(self.index.search(hgvs_keys("NM_004333.6:c.1799T>A")), ([self.braf], "hgvs"))
+        self.assertEqual(self.index.search([("protein_change", "BRAF", "V600E")]), ([self.braf], "protein_change"))
+        self.assertEqual(self.index.search([("protein_change", "KRAS", "G12V")]), ([self.kras], "protein_change"))
+        self.assertEqual(self.index.search([("protein_change", "NRAS", "G12V")]), ([], None))
+
+    def test_vep_match_keys(self):
+        """Test that only the annotations of the respective ALT are used"""
+        csq_schema = CsqSchema(["Allele", "SYMBOL", "HGVSc", "HGVSp"])
+        record = SimpleNamespace(
+            REF="A",
+            ALT=["T", "C"],
+            INFO={
+                "CSQ": [
+                    "T|BRAF|ENST00000288602.10:c.1799T>A|ENSP00000288602.6:p.Val600Glu",
+                    "C|BRAF|ENST00000288602.10:c.1799T>G|ENSP00000288602.6:p.Val600Gly",
+                ]
+            },
+        )
+        keys = get_vep_match_keys(record, "T", csq_schema)
+        self.assertIn(("protein_change", "BRAF", "V600E"), keys)
+        self.assertIn(("hgvs", "ENST00000288602:c.1799T>A"), keys)
+        self.assertNotIn(("protein_change", "BRAF", "V600G"), keys)
+
+    def test_match_mode(self):
+        """Test that the match type is reported for hits of the protein index"""
+        query = civic.CoordinateQuery(chr="7", start=140453136, stop=140453136, ref="A", alt="T", build="GRCh38")
+        logger = logging.getLogger("Querynator")
+        with mock.patch("querynator.query_api.civic_api.get_protein_index", return_value=self.index):
+            variant_list = access_civic_by_coordinate(
+                {query: 1000001}, logger, "GRCh38", None, 1, "hgvs", {query: [("protein_change", "BRAF", "V600E")]}
+            )
+        self.assertEqual(variant_list, [[{query: 1000001}, [self.braf], "protein_change"]])
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            out_path = os.path.join(tmpdir, "sample")
+            create_civic_results(variant_list, out_path, None, logger, True, {}, match_mode="hgvs")
+            with open(os.path.join(out_path, "sample.civic_results.tsv")) as f:
+                row = next(csv.DictReader(f, delimiter="\t"))
+        self.assertEqual(list(row)[5:7], ["querynator_id", "match_type"])
+        self.assertEqual(row["match_type"], "protein_change")
+
+
+class testCivicSnapshot(unittest.TestCase):
+    """Test writing and reading a CIViC snapshot"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.variants = [
+            annotated_fake_variant(12, "7", 140453136, 140453136, "A", "T"),
+            annotated_fake_variant(5, "22", 23522552, 23632600, None, None, chromosome2="9", start2=1, stop2=2),
+        ]
+        write_civic_snapshot(self.variants, self.tmpdir.name, "2024-10-01", logging.getLogger("Querynator"))
+        self.snapshot = CivicSnapshot(self.tmpdir.name)
+
+    def tearDown(self):
+        self.snapshot.close()
+        self.tmpdir.cleanup()
+
+    def test_search(self):
+        """Test that the snapshot index finds the same variants as the CIViCpy index"""
+        query = civic.CoordinateQuery(chr="7", start=140453136, stop=140453136, ref="A", alt="T", build="GRCh37")
+        hits = self.snapshot.bulk_search([query], "GRCh37", logging.getLogger("Querynator"))
+        self.assertEqual([v.id for v in hits[query]], [12])
+        self.assertEqual(self.snapshot.snapshot_date, "2024-10-01")
+        self.assertEqual(len(self.snapshot), 2)
+        self.assertEqual(dict(self.snapshot.allele_index()), {"CA12": [0], "CA5": [1]})
+        hits = self.snapshot.protein_search({query: hgvs_keys("NM_004333.4:c.1799T>A")})
+        variants, match_type = hits[query]
+        # both fake variants carry the same HGVS expression
+        self.assertEqual(([v.id for v in variants], match_type), ([12, 5], "hgvs"))
+
+    def test_protein_index(self):
+        """Test that the protein index is built without decoding the records"""
+        query = civic.CoordinateQuery(chr="7", start=140453136, stop=140453136, ref="A", alt="T", build="GRCh37")
+        self.assertEqual(self.snapshot.protein_search({query: [("protein_change", "NRAS", "G12V")]}), {})
+        self.assertEqual(self.snapshot._loaded, {})
+        self.assertEqual(len(self.snapshot.protein_index()), len(CivicProteinIndex.from_variants(self.variants)))
+
+    def test_extraction(self):
+        """Test that the result columns of a snapshot record equal the ones of the CIViCpy object"""
+        for n, variant in enumerate(self.variants):
+            record = self.snapshot.get(n)
+            for get_information in [
+                get_variant_information_from_variant,
+                get_gene_information_from_variant,
+                get_molecular_profile_information_from_variant,
+                get_assertion_information_from_variant,
+            ]:
+                self.assertEqual(get_information(record), get_information(variant))
+            self.assertEqual(
+                get_evidence_information_from_variant(record, (None, None), {"level": ["b"]}),
+                get_evidence_information_from_variant(variant, (None, None), {"level": ["b"]}),
+            )
+
+    def test_assertion_disease(self):
+        """Test that the assertion disease of CIViCpy objects and snapshot records is reported alike"""
+        name = SimpleNamespace
+        variant = annotated_fake_variant(7, "7", 140453136, 140453136, "A", "T")
+        disease = civic.Disease(
+            type="disease",
+            id=8,
+            name="Melanoma",
+            display_name="Melanoma",
+            doid="1909",
+            disease_url="https://www.disease-ontology.org/?id=DOID:1909",
+            aliases=["Malignant Melanoma", "Naevocarcinoma"],
+        )
+        variant.molecular_profiles[0].assertions = [
+            name(
+                id=1,
+                name="AID1",
+                acmg_codes=[],
+                amp_level="Tier I - Level A",
+                assertion_direction="Supports",
+                assertion_type="Predictive",
+                description="assertion description",
+                disease=disease,
+                phenotypes=[],
+                significance="Sensitivity/Response",
+                status="accepted",
+                summary="assertion summary",
+                therapies=[name(name="Vemurafenib", ncit_id="C64768", aliases=["PLX4032"])],
+                therapy_interaction_type="",
+                variant_origin="Somatic",
+            )
+        ]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            write_civic_snapshot([variant], tmp_dir, "2024-10-01", logging.getLogger("Querynator"))
+            snapshot = CivicSnapshot(tmp_dir)
+            record = snapshot.get(0)
+            snapshot.close()
+
+        for obj in [variant, record]:
+            assertion_info = get_assertion_information_from_variant(obj)
+            self.assertEqual(assertion_info["assertion_disease_name"], "Melanoma")
+            self.assertEqual(assertion_info["assertion_disease_doid"], "1909")
+            self.assertEqual(assertion_info["assertion_disease_url"], "https://www.disease-ontology.org/?id=DOID:1909")
+            self.assertEqual(assertion_info["assertion_disease_aliases"], "Malignant Melanoma, Naevocarcinoma")
+
+
+class testCivicTsvRelease(unittest.TestCase):
+    """Test querying CIViC from the TSV files of a release"""
+
+    files = {
+        "nightly-VariantSummaries.tsv": [
+            ["variant_id", "gene", "entrez_id", "variant", "variant_groups", "chromosome", "start", "stop"]
+            + ["reference_bases", "variant_bases", "reference_build", "chromosome2", "start2", "stop2"]
+            + ["variant_types", "hgvs_descriptions", "allele_registry_id", "clinvar_ids", "variant_aliases", "gene_id"],
+            ["12", "BRAF", "673", "V600E", "", "7", "140453136", "140453136", "A", "T", "GRCh37", "", "", ""]
+            + ["Missense Variant", "NM_004333.4:c.1799T>A", "CA123643", "13961", "VAL600GLU,RS113488022", "5"],
+            ["99", "BRAF", "673", "V600K", "", "7", "140453136", "140453137", "CA", "TT", "GRCh37", "", "", ""]
+            + ["", "", "", "", "", "5"],
+        ],
+        "nightly-MolecularProfileSummaries.tsv": [
+            ["name", "molecular_profile_id", "summary", "variant_ids", "evidence_score"],
+            ["BRAF V600E", "12", "", "12", "1.5"],
+            ["BRAF V600K", "99", "", "99", "0"],
+        ],
+        "nightly-ClinicalEvidenceSummaries.tsv": [
+            ["molecular_profile_id", "disease", "doid", "phenotypes", "therapies", "therapy_interaction_type"]
+            + ["evidence_type", "evidence_direction", "evidence_level", "significance", "evidence_statement"]
+            + ["citation", "rating", "evidence_status", "evidence_id"],
+            ["12", "Melanoma", "1909", "", "Vemurafenib,Cobimetinib", "Combination", "Predictive", "Supports"]
+            + ["A", "Sensitivity/Response", 'a "quoted" statement', "Source", "3", "accepted", "1"],
+            ["12", "", "", "", "", "", "Prognostic", "Supports", "B", "Poor Outcome", "", "Source", "2"]
+            + ["submitted", "2"],
+        ],
+        "nightly-GeneSummaries.tsv": [
+            ["gene_id", "name", "entrez_id", "description"],
+            ["5", "BRAF", "673", "gene description"],
+        ],
+    }
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        for name, rows in self.files.items():
+            with open(os.path.join(self.tmpdir.name, name), "w") as f:
+                f.writelines("\t".join(row) + "\n" for row in rows)
+        self.release = CivicTsvRelease(self.tmpdir.name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_release(self):
+        """Test the joined records and the result columns"""
+        query = civic.CoordinateQuery(chr="7", start=140453136, stop=140453136, ref="A", alt="T", build="GRCh37")
+        hits = self.release.bulk_search([query], "GRCh37", logging.getLogger("Querynator"))
+        variant = hits[query][0]
+        self.assertEqual(variant.id, 12)
+        self.assertEqual(get_variant_information_from_variant(variant)["variant_aliases"], "VAL600GLU, RS113488022")
+        self.assertEqual(get_gene_information_from_variant(variant)["gene_description"], "gene description")
+        evidence_info = get_evidence_information_from_variant(variant, (None, None), {})
+        # one value per evidence item
+        self.assertEqual(evidence_info["evidence_therapies"], "Vemurafenib+Cobimetinib,")
+        self.assertEqual(evidence_info["evidence_description"], 'a "quoted" statement|')
+        self.assertEqual(evidence_info["evidence_status"], "accepted,submitted")
+        # molecular profiles without evidence are not reported, like in CIViCpy
+        self.assertEqual(self.release.variants[1].molecular_profiles, [])
+        self.assertEqual(len(self.release.checksums), 4)
+
+
+class testMultipleDiseases(unittest.TestCase):
+    """Test writing one result table per cancer type"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.out_path = os.path.join(self.tmpdir.name, "sample")
+        terms = {
+            "melanoma": ontology.Ontology.Term({"id": "DOID:1909", "name": "melanoma"}),
+            "lung cancer": ontology.Ontology.Term({"id": "DOID:1324", "name": "lung cancer"}),
+        }
+        doid = mock.patch("querynator.helper_functions.ontology.DiseaseOntology").start()
+        doid.return_value.get.side_effect = terms.get
+        doid.return_value.get_all_ancestors.side_effect = lambda disease: [terms[disease]]
+        self.addCleanup(mock.patch.stopall)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_multiple_diseases(self):
+        """Test that evidence is evaluated per cancer type on the same hits"""
+        query = civic.CoordinateQuery(chr="7", start=140453136, stop=140453136, ref="A", alt="T", build="GRCh37")
+        variant_list = [[{query: 1000001}, [annotated_fake_variant(12, "7", 140453136, 140453136, "A", "T")]]]
+        logger = logging.getLogger("Querynator")
+        create_civic_results(variant_list, self.out_path, ("melanoma", "lung cancer"), logger, False, {})
+
+        self.assertEqual(
+            sorted(os.listdir(self.out_path)),
+            [
+                "sample.DOID_1324.civic_evidence.tsv",
+                "sample.DOID_1324.civic_results.tsv",
+                "sample.DOID_1909.civic_evidence.tsv",
+                "sample.DOID_1909.civic_results.tsv",
+            ],
+        )
+        levels = {}
+        for doid in ["DOID_1909", "DOID_1324"]:
+            with open(os.path.join(self.out_path, f"sample.{doid}.civic_results.tsv")) as f:
+                header, row = [line.rstrip("\n").split("\t") for line in f]
+            levels[doid] = dict(zip(header, row))["evidence_level"]
+        # level A evidence of another tumor counts as level C
+        self.assertEqual(levels, {"DOID_1909": "A,B", "DOID_1324": "C,B"})
+
+
+class testCivicCache(unittest.TestCase):
+    """Test the refresh policies of the CIViCpy cache"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache_path = os.path.join(self.tmpdir.name, "cache.pkl")
+        self.logger = logging.getLogger("Querynator")
+        self.download = mock.patch("civicpy.civic.download_remote_cache").start()
+        self.load = mock.patch("civicpy.civic.load_cache").start()
+        self.addCleanup(mock.patch.stopall)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write_cache(self, age_days):
+        with open(self.cache_path, "w") as f:
+            f.write("")
+        mtime = time.time() - age_days * 86400
+        os.utime(self.cache_path, (mtime, mtime))
+
+    def test_offline(self):
+        """Test that the offline mode never downloads and requires a cache file"""
+        with self.assertRaises(SystemExit):
+            load_civic_cache(self.logger, "offline", self.cache_path)
+        self.write_cache(100)
+        load_civic_cache(self.logger, "offline", self.cache_path)
+        self.download.assert_not_called()
+        self.load.assert_called_once_with(local_cache_path=self.cache_path, on_stale="ignore")
+
+    def test_ttl(self):
+        """Test that the ttl mode only downloads missing or outdated caches"""
+        self.write_cache(2)
+        load_civic_cache(self.logger, "ttl", self.cache_path, cache_ttl=7)
+        self.download.assert_not_called()
+        load_civic_cache(self.logger, "ttl", self.cache_path, cache_ttl=1)
+        self.download.assert_called_once_with(local_cache_path=self.cache_path)
+
+    def test_refresh(self):
+        """Test that the refresh mode always downloads"""
+        self.write_cache(0)
+        load_civic_cache(self.logger, "refresh", self.cache_path)
+        self.download.assert_called_once_with(local_cache_path=self.cache_path)
+
+
+class testCivicResultCache(unittest.TestCase):
+    """Test the CIViC result cache shared between runs"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmpdir.name, "cache")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def query(self, start):
+        return civic.CoordinateQuery(chr="7", start=start, stop=start, ref="A", alt="T", build="GRCh37")
+
+    def test_cache(self):
+        """Test negative entries, LRU eviction and entries of several CIViC versions"""
+        cache = CivicResultCache(self.cache_dir, "2024-01-01", max_entries=2)
+        keys = [CivicResultCache.key(self.query(i), "Melanoma ", ()) for i in range(3)]
+        self.assertEqual(keys[0], CivicResultCache.key(self.query(0), "melanoma", ()))
+        self.assertNotEqual(keys[0], CivicResultCache.key(self.query(0), "melanoma", (("level", ("a",)),)))
+        cache.put_many({keys[0]: [{"variant": "V600E"}], keys[1]: []})
+        self.assertEqual(cache.get_many(keys), {keys[0]: [{"variant": "V600E"}], keys[1]: []})
+
+        # keys[0] was used most recently
+        time.sleep(0.01)
+        cache.get_many(keys[:1])
+        cache.put_many({keys[2]: []})
+        self.assertEqual(set(cache.get_many(keys)), {keys[0], keys[2]})
+        cache.close()
+
+        cache = CivicResultCache(self.cache_dir, "2024-01-01")
+        self.assertEqual(len(cache), 2)
+        cache.close()
+
+        # runs on another CIViC version share the cache without removing the entries of the first one
+        cache = CivicResultCache(self.cache_dir, "2024-02-01")
+        self.assertEqual((len(cache), cache.get_many(keys)), (2, {}))
+        cache.put_many({keys[0]: []})
+        self.assertEqual(cache.get_many(keys), {keys[0]: []})
+        cache.close()
+        cache = CivicResultCache(self.cache_dir, "2024-01-01")
+        self.assertEqual(cache.get_many(keys[:1]), {keys[0]: [{"variant": "V600E"}]})
+        cache.close()
+
+    def test_cached_results(self):
+        """Test that cached variants give the same result rows without being searched"""
+        logger = logging.getLogger("Querynator")
+        query, no_hit = self.query(140453136), self.query(1000)
+        coord_dict = {query: 1000001, no_hit: 1000002}
+        variant_list = [[{query: 1000001}, [annotated_fake_variant(12, "7", 140453136, 140453136, "A", "T")]]]
+
+        tables = []
+        for hits in [variant_list, []]:
+            out_path = os.path.join(self.tmpdir.name, f"sample{len(tables)}")
+            cache = CivicResultCache(self.cache_dir, "2024-01-01")
+            create_civic_results(hits, out_path, None, logger, True, {}, 1, cache, coord_dict)
+            self.assertEqual(len(cache), 2)
+            cache.close()
+            tables.append([])
+            for table in ["civic_results", "civic_evidence"]:
+                with open(os.path.join(out_path, f"sample{len(tables) - 1}.{table}.tsv")) as f:
+                    tables[-1].append(f.read())
+        self.assertEqual(tables[0], tables[1])
+        self.assertIn("1000001", tables[0][0])
+        self.assertEqual(len(tables[0][1].splitlines()), 3)
+
+    def test_evicted_results(self):
+        """Test that entries evicted after the cache was read are still reported and not cached without hit"""
+        logger = logging.getLogger("Querynator")
+        query = self.query(140453136)
+        coord_dict = {query: 1000001}
+        variant_list = [[{query: 1000001}, [annotated_fake_variant(12, "7", 140453136, 140453136, "A", "T")]]]
+        cache = CivicResultCache(self.cache_dir, "2024-01-01")
+        create_civic_results(
+            variant_list, os.path.join(self.tmpdir.name, "sample0"), None, logger, True, {}, 1, cache, coord_dict
+        )
+
+        cached_results, fully_cached = read_cached_results(cache, coord_dict, None, {})
+        self.assertEqual(fully_cached, {query})
+        # evicted by another run sharing the cache
+        with cache.connection:
+            cache.connection.execute("DELETE FROM entries")
+        out_path = os.path.join(self.tmpdir.name, "sample1")
+        create_civic_results([], out_path, None, logger, True, {}, 1, cache, coord_dict, cached_results=cached_results)
+
+        with open(os.path.join(out_path, "sample1.civic_results.tsv")) as f:
+            self.assertIn("1000001", f.read())
+        self.assertEqual(len(cache), 0)
+        cache.close()
+
+
+class testCivicEvidenceTable(unittest.TestCase):
+    """Test writing the civic_evidence.tsv"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.out_path = os.path.join(self.tmpdir.name, "sample")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def read(self, table):
+        with open(os.path.join(self.out_path, f"sample.{table}.tsv")) as f:
+            return list(csv.DictReader(f, delimiter="\t"))
+
+    def test_evidence_table(self):
+        """Test one row per evidence item, keyed by the querynator ID"""
+        query = civic.CoordinateQuery(chr="7", start=140453136, stop=140453136, ref="A", alt="T", build="GRCh37")
+        variant = annotated_fake_variant(12, "7", 140453136, 140453136, "A", "T")
+        variant.molecular_profiles[0].evidence[0].description = "BRAF V600E, a driver. Responsive, in melanoma"
+        logger = logging.getLogger("Querynator")
+        create_civic_results([[{query: 1000001}, [variant]]], self.out_path, None, logger, False, {})
+
+        evidence = self.read("civic_evidence")
+        self.assertEqual([row["evidence_id"] for row in evidence], ["120", "121"])
+        self.assertEqual({row["querynator_id"] for row in evidence}, {"1000001"})
+        self.assertEqual(evidence[0]["evidence_description"], "BRAF V600E, a driver. Responsive, in melanoma")
+        self.assertEqual([row["evidence_disease"] for row in evidence], ["Melanoma", ""])
+        results = self.read("civic_results")
+        self.assertEqual(results[0]["evidence_level"], "A,B")
+        # without filter_vep, the tables are joined via the coordinates
+        self.assertNotIn("querynator_id", results[0])
+        coordinates = ["chr", "start", "stop", "ref", "alt"]
+        self.assertEqual(
+            {tuple(row[i] for i in coordinates) for row in evidence}, {tuple(results[0][i] for i in coordinates)}
+        )
+
+    def test_empty_evidence_table(self):
+        """Test that a run without hits writes the header of the evidence table"""
+        create_civic_results([], self.out_path, None, logging.getLogger("Querynator"), False, {})
+        with open(os.path.join(self.out_path, "sample.civic_evidence.tsv")) as f:
+            self.assertEqual(f.readline().split("\t")[:3], ["querynator_id", "chr", "start"])
+
+
+class testCivicResults(unittest.TestCase):
+    """Test writing the civic_results.tsv"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.out_file = os.path.join(self.tmpdir.name, "sample.civic_results.tsv")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def read(self):
+        with open(self.out_file) as f:
+            return f.read()
+
+    def test_write_civic_results(self):
+        """Test column order, missing values and quoting"""
+        rows = [
+            {"chr": "7", "start": 140453136, "evidence_level": "A,B", "mol_profile_score": np.nan},
+            {"chr": "12", "start": 25398284, "evidence_level": None, "mol_profile_score": 'say "hi"'},
+        ]
+        self.assertEqual(write_civic_results(iter(rows), self.out_file), 2)
+        self.assertEqual(
+            self.read(),
+            'chr\tstart\tevidence_level\tmol_profile_score\n7\t140453136\tA,B\t\n12\t25398284\t\t"say ""hi"""\n',
+        )
+
+    def test_write_empty_civic_results(self):
+        """Test that a run without hits writes an empty table"""
+        self.assertEqual(write_civic_results(iter([]), self.out_file), 0)
+        self.assertEqual(self.read(), "\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
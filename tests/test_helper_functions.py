@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+
+"""Tests for the helper functions shared by the querynator scripts."""
+
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import vcf
+
+from querynator.helper_functions import (
+    CsqSchema,
+    QuerynatorIds,
+    VcfReader,
+    collapse_csq,
+    create_querynator_id,
+    fetch_vcf_regions,
+    get_unindexed_chromosomes,
+    gunzip_compressed_files,
+    open_vcf_reader,
+    open_vcf_writer,
+    ordered_map,
+    parse_region,
+    read_bed_regions,
+    select_csq,
+)
+
+
+class testOrderedMap(unittest.TestCase):
+    """Test the order preserving thread pool map"""
+
+    def test_order(self):
+        """Test that results keep the input order, regardless of which worker finishes first"""
+
+        def slow_square(i):
+            time.sleep(0.001 * (10 - i))
+            return i * i
+
+        for threads in [1, 4]:
+            self.assertEqual(list(ordered_map(slow_square, range(10), threads)), [i * i for i in range(10)])
+
+    def test_threads(self):
+        """Test that the items are processed by worker threads"""
+        names = set(ordered_map(lambda i: threading.current_thread().name, range(20), threads=2))
+        self.assertNotIn(threading.current_thread().name, names)
+
+    def test_bounded(self):
+        """Test that items are only consumed from the input as results are consumed"""
+        consumed = []
+
+        def items():
+            for i in range(100):
+                consumed.append(i)
+                yield i
+
+        results = ordered_map(lambda i: i, items(), threads=2, max_pending=4)
+        self.assertEqual(next(results), 0)
+        self.assertLessEqual(len(consumed), 4)
+        results.close()
+
+
+class testQuerynatorIds(unittest.TestCase):
+    """Test the content-derived querynator IDs"""
+
+    def test_stable(self):
+        """Test that the ID only depends on the variant and the reference genome"""
+        querynator_id = create_querynator_id("chr7", 140453136, "A", "T", "GRCh37")
+        self.assertEqual(create_querynator_id("7", "140453136", "a", "t", "hg19"), querynator_id)
+        self.assertEqual(QuerynatorIds("GRCh37", logging.getLogger()).get("7", 140453136, "A", "T"), querynator_id)
+        self.assertNotEqual(create_querynator_id("7", 140453136, "A", "C", "GRCh37"), querynator_id)
+        self.assertNotEqual(create_querynator_id("7", 140453136, "A", "T", "GRCh38"), querynator_id)
+        self.assertLess(querynator_id, 2**53)
+
+    def test_collision(self):
+        """Test that a colliding variant gets the ID of the next salt, while a repeated variant keeps its ID"""
+
+        def colliding_id(chrom, pos, ref, alt, build, salt=0):
+            return salt
+
+        querynator_ids = QuerynatorIds("GRCh37", logging.getLogger())
+        with mock.patch("querynator.helper_functions.helper_functions.create_querynator_id", colliding_id):
+            with self.assertLogs(level="WARNING"):
+                self.assertEqual(
+                    [querynator_ids.get(*variant) for variant in [("1", 10, "A", "T"), ("2", 20, "G", "C")]], [0, 1]
+                )
+            self.assertEqual(querynator_ids.get("chr2", 20, "G", "C"), 1)
+
+
+class testCompressedVcf(unittest.TestCase):
+    """Test reading gzip and BGZF compressed vcf files"""
+
+    def setUp(self):
+        self.input_dir = tempfile.mkdtemp()
+        self.vcf_gz = shutil.copy(f"{os.getcwd()}/example_files/example.vcf.gz", self.input_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.input_dir)
+
+    def test_inStream(self):
+        """Test that a BGZF compressed vcf is read without writing a decompressed copy"""
+        records = [(r.CHROM, r.POS, r.REF) for r in open_vcf_reader(self.vcf_gz)]
+        plain = [(r.CHROM, r.POS, r.REF) for r in open_vcf_reader(f"{os.getcwd()}/example_files/example.vcf")]
+        self.assertEqual(records, plain)
+        self.assertEqual(os.listdir(self.input_dir), ["example.vcf.gz"])
+
+    def test_gunzipToScratch(self):
+        """Test that files are decompressed into the scratch directory"""
+        with tempfile.TemporaryDirectory() as scratch:
+            vcf_path = gunzip_compressed_files(self.vcf_gz, logging.getLogger(), scratch)
+            self.assertEqual(vcf_path, os.path.join(scratch, "example.vcf"))
+            with open(vcf_path) as f, open(f"{os.getcwd()}/example_files/example.vcf") as plain:
+                self.assertEqual(f.read().rstrip(), plain.read().rstrip())
+        self.assertEqual(os.listdir(self.input_dir), ["example.vcf.gz"])
+
+
+class testSelectCsq(unittest.TestCase):
+    """Test the selection of one CSQ entry per variant"""
+
+    schema = CsqSchema(["Feature", "IMPACT", "CANONICAL", "MANE_SELECT"])
+    annotations = ["ENST1|MODIFIER||", "ENST2|MODERATE|YES|", "ENST3|HIGH||", "ENST4|MODERATE||NM_4.1"]
+
+    def test_modes(self):
+        """Test that each mode selects its transcript"""
+        self.assertEqual(select_csq(self.annotations, self.schema, "all"), self.annotations)
+        self.assertEqual(select_csq(self.annotations, self.schema, "canonical"), ["ENST2|MODERATE|YES|"])
+        self.assertEqual(select_csq(self.annotations, self.schema, "mane"), ["ENST4|MODERATE||NM_4.1"])
+        self.assertEqual(select_csq(self.annotations, self.schema, "worst"), ["ENST3|HIGH||"])
+
+    def test_fallback(self):
+        """Test that mane falls back to canonical and canonical to the most severe impact"""
+        self.assertEqual(select_csq(self.annotations[:3], self.schema, "mane"), ["ENST2|MODERATE|YES|"])
+        self.assertEqual(select_csq(self.annotations[::2], self.schema, "canonical"), ["ENST3|HIGH||"])
+        self.assertEqual(select_csq(self.annotations[:1], CsqSchema(["Feature"]), "worst"), self.annotations[:1])
+
+    def test_multiallelic(self):
+        """Test that one entry is selected per ALT allele of a multiallelic record"""
+        schema = CsqSchema(["Allele", "Feature", "IMPACT", "CANONICAL", "MANE_SELECT"])
+        annotations = [f"A|{annotation}" for annotation in self.annotations]
+        annotations += ["T|ENST1|LOW||", "T|ENST2|MODIFIER|YES|"]
+        self.assertEqual(
+            select_csq(annotations, schema, "canonical"), ["A|ENST2|MODERATE|YES|", "T|ENST2|MODIFIER|YES|"]
+        )
+        self.assertEqual(select_csq(annotations, schema, "mane"), ["A|ENST4|MODERATE||NM_4.1", "T|ENST2|MODIFIER|YES|"])
+        self.assertEqual(select_csq(annotations, schema, "worst"), ["A|ENST3|HIGH||", "T|ENST1|LOW||"])
+
+
+class testVcfReader(unittest.TestCase):
+    """Test the native vcf reader"""
+
+    vcf_path = f"{os.getcwd()}/example_files/example.vcf"
+
+    def test_fields(self):
+        """Test that the fields used by querynator are read like pyVCF3 reads them"""
+        native = open_vcf_reader(self.vcf_path)
+        self.assertIsInstance(native, VcfReader)
+        self.assertEqual(native.infos["CSQ"].desc, vcf.Reader(filename=self.vcf_path).infos["CSQ"].desc)
+        for record, expected in zip(native, vcf.Reader(filename=self.vcf_path)):
+            self.assertEqual(
+                (record.CHROM, record.POS, record.REF, [str(alt) for alt in record.ALT], record.start, record.end),
+                (
+                    expected.CHROM,
+                    expected.POS,
+                    expected.REF,
+                    [str(alt) for alt in expected.ALT],
+                    expected.start,
+                    expected.end,
+                ),
+            )
+            self.assertEqual(record.INFO["CSQ"], expected.INFO["CSQ"])
+
+    def test_fallback(self):
+        """Test that pyVCF3 reads files with space separated columns"""
+        with open(self.vcf_path) as f:
+            lines = [line.replace("\t", " ") if line.startswith("#CHROM") else line for line in f]
+        with tempfile.NamedTemporaryFile("w", suffix=".vcf") as spaced:
+            spaced.writelines(lines)
+            spaced.flush()
+            with open_vcf_reader(spaced.name) as reader:
+                self.assertIsInstance(reader, vcf.Reader)
+                self.assertEqual(len(list(reader)), len(list(vcf.Reader(filename=self.vcf_path))))
+
+    def test_close(self):
+        """Test that the file is closed after reading all records or leaving the with block"""
+        reader = open_vcf_reader(self.vcf_path)
+        list(reader)
+        self.assertTrue(reader._file.closed)
+        with open_vcf_reader(self.vcf_path) as reader:
+            next(iter(reader))
+        self.assertTrue(reader._file.closed)
+
+    def test_writer(self):
+        """Test that records are written as read, with added INFO fields"""
+        reader = open_vcf_reader(self.vcf_path)
+        with tempfile.NamedTemporaryFile("w+", suffix=".vcf") as out:
+            writer = open_vcf_writer(out, reader, [("QID", ".", "String", "Querynator ID")])
+            for record in reader:
+                record.add_info("QID", record.POS)
+                writer.write_record(record)
+            out.flush()
+            written = vcf.Reader(filename=out.name)
+            self.assertEqual(written.infos["QID"].desc, "Querynator ID")
+            records = list(written)
+        self.assertEqual([r.INFO["QID"] for r in records], [[str(r.POS)] for r in records])
+        self.assertEqual(len(records), len(list(vcf.Reader(filename=self.vcf_path))))
+
+    def test_writer_header(self):
+        """Test that new INFO lines follow the last INFO line and existing ones are redefined in place"""
+        info = ("QID", ".", "String", "Querynator ID")
+        with open_vcf_reader(self.vcf_path) as reader:
+            header_lines = reader.header_lines
+            with tempfile.NamedTemporaryFile("w+", suffix=".vcf") as out:
+                open_vcf_writer(out, reader, [info])
+                out.flush()
+                with open_vcf_reader(out.name) as written:
+                    written_lines = written.header_lines
+                with tempfile.NamedTemporaryFile("w+", suffix=".vcf") as rewritten:
+                    open_vcf_writer(rewritten, written, [info[:3] + ("Querynator ID of the variant",)])
+                    rewritten.flush()
+                    with open_vcf_reader(rewritten.name) as reread:
+                        rewritten_lines = reread.header_lines
+
+        csq = [n for n, line in enumerate(header_lines) if line.startswith("##INFO=<ID=CSQ,")][0]
+        self.assertEqual(written_lines[: csq + 1], header_lines[: csq + 1])
+        self.assertEqual(written_lines[csq + 1], '##INFO=<ID=QID,Number=.,Type=String,Description="Querynator ID">')
+        self.assertEqual(written_lines[csq + 2 :], header_lines[csq + 1 :])
+        self.assertEqual(len(rewritten_lines), len(written_lines))
+        self.assertEqual(rewritten_lines[csq + 1], written_lines[csq + 1].replace('ID">', 'ID of the variant">'))
+
+
+class testRegions(unittest.TestCase):
+    """Test region restricted reading of tabix-indexed vcf files"""
+
+    vcf_gz = f"{os.getcwd()}/example_files/example.vcf.gz"
+
+    def test_parseRegion(self):
+        """Test that regions are converted to 0-based, half-open coordinates"""
+        self.assertEqual(parse_region("chr7:140,453,136-140453137"), ("chr7", 140453135, 140453137))
+        self.assertEqual(parse_region("X:100"), ("X", 99, None))
+        self.assertEqual(parse_region("17"), ("17", 0, None))
+        for region in ["7:10-5", "7:0-5", "7:a-b", ""]:
+            with self.assertRaises(ValueError):
+                parse_region(region)
+
+    def test_readBedRegions(self):
+        """Test that header lines are skipped and malformed lines are reported"""
+        with tempfile.NamedTemporaryFile("w", suffix=".bed") as bed:
+            bed.write("track name=panel\nchr1\t100\t200\tGENE\n\n7\t5\t10\n")
+            bed.flush()
+            self.assertEqual(read_bed_regions(bed.name), [("chr1", 100, 200), ("7", 5, 10)])
+            bed.write("7\tx\t10\n")
+            bed.flush()
+            with self.assertRaises(ValueError):
+                read_bed_regions(bed.name)
+
+    def test_fetchVcfRegions(self):
+        """Test that only records of the regions are returned, once each and in vcf order"""
+        records = list(open_vcf_reader(self.vcf_gz))
+        chr1 = [r for r in records if r.CHROM == "1"]
+        start, middle, end = chr1[0].start, chr1[len(chr1) // 2].start, chr1[-1].end
+        regions = [("X", 0, None), ("chr1", middle, end), ("1", start, middle + 1), ("chrUn", 0, 10)]
+        fetched = list(fetch_vcf_regions(open_vcf_reader(self.vcf_gz), regions))
+        expected = chr1 + [r for r in records if r.CHROM == "X"]
+        self.assertEqual([(r.CHROM, r.POS, r.REF) for r in fetched], [(r.CHROM, r.POS, r.REF) for r in expected])
+        self.assertEqual(get_unindexed_chromosomes(self.vcf_gz, regions), ["chrUn"])
+
+
+class testCsqSchema(unittest.TestCase):
+    """Test the compiled CSQ decoder"""
+
+    def setUp(self):
+        self.schema = CsqSchema(["Allele", "Consequence", "IMPACT", "SYMBOL", "SIFT"])
+
+    def test_decoder(self):
+        """Test that the requested fields are returned in the requested order"""
+        decode = self.schema.decoder("IMPACT", "Consequence")
+        self.assertEqual(decode("T|synonymous_variant|LOW|BRAF|"), ("LOW", "synonymous_variant"))
+        self.assertIs(self.schema.decoder("IMPACT", "Consequence"), decode)
+        self.assertEqual(self.schema.decoder()("T|missense_variant|MODERATE|BRAF|deleterious(0)")[-1], "deleterious(0)")
+
+    def test_truncated(self):
+        """Test that fields missing in a truncated annotation are empty"""
+        self.assertEqual(self.schema.decoder("SYMBOL", "SIFT")("T|missense_variant"), ("", ""))
+
+    def test_collapse(self):
+        """Test that the distinct non-empty values of each field are joined, also if one contains another"""
+        annotations = ["T|intron_variant||BRAF|-1", "T|missense_variant|MODERATE|BRAF|1", "T|intron_variant||BRAF|-1"]
+        self.assertEqual(
+            collapse_csq(annotations, self.schema.decoder()),
+            ["T", "intron_variant,missense_variant", "MODERATE", "BRAF", "-1,1"],
+        )
+        self.assertEqual(collapse_csq(annotations[:1], self.schema.decoder("IMPACT", "SIFT")), ["", "-1"])
+
+    def test_unknown_field(self):
+        """Test that fields that are not part of the annotation are rejected"""
+        self.assertNotIn("PolyPhen", self.schema)
+        with self.assertRaises(KeyError):
+            self.schema.decoder("PolyPhen")
+
+
+if __name__ == "__main__":
+    unittest.main()
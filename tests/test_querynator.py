@@ -2,13 +2,31 @@
 
 """Tests for `querynator` package."""
 
+import logging
 import os
 import shutil
+import tempfile
+import types
 import unittest
 
+import pandas as pd
+import vcf
 from click.testing import CliRunner
 
-from querynator.__main__ import querynator_cli
+from querynator.__main__ import filter_vcf_by_vep, querynator_cli
+from querynator.helper_functions import QuerynatorIds
+from querynator.report_scripts import (
+    add_merge_coords,
+    add_tiers_and_scores_to_df,
+    combine_cgi,
+    combine_cgi_civic,
+    combine_civic,
+    get_civic_results_path,
+    merge_civic_cgi,
+    read_filtered_vcf,
+    read_shared_vep_table,
+    vcf_digest,
+)
 
 
 class CliTestCase(unittest.TestCase):
@@ -84,7 +102,7 @@ class testCliHelp(unittest.TestCase):
         """Test CREATE-REPORT help message"""
         report_help_result = self.runner.invoke(querynator_cli, ["create-report", "--help"])
         self.assertEqual(report_help_result.exit_code, 0)
-        self.assertIn("--help                 Show this message and exit.", report_help_result.output)
+        self.assertIn("--help                          Show this message and exit.", report_help_result.output)
 
     def test_nonExistingSubcommand(self):
         """Test non-existing subcommand"""
@@ -143,6 +161,44 @@ class testCliRun(CliTestCase):
         self.assertEqual(result.exit_code, 0, "non-zero exit code")
         self.assertIsFile(f"{outdir}/{outdir.split('/')[-1]}.civic_results.tsv", "civic_results.tsv not created")
 
+    def test_queryApiCivic_TsvBuild(self):
+        """Test that a CIViC TSV release is rejected for GRCh38 coordinates, which require the allele registry"""
+        result = self.runner.invoke(
+            querynator_cli,
+            [
+                "query-api-civic",
+                "--vcf",
+                f"{os.getcwd()}/example_files/example.vcf",
+                "--genome",
+                "GRCh38",
+                "--outdir",
+                self.get_testdir(),
+                "--civic_tsv",
+                f"{os.getcwd()}/example_files",
+            ],
+        )
+        self.assertEqual(result.exit_code, 2)
+        self.assertIn("--match_mode hgvs", result.output)
+
+    def test_queryApiCivic_OfflineBuild(self):
+        """Test that the offline mode is rejected for GRCh38 coordinates, which require the allele registry"""
+        result = self.runner.invoke(
+            querynator_cli,
+            [
+                "query-api-civic",
+                "--vcf",
+                f"{os.getcwd()}/example_files/example.vcf",
+                "--genome",
+                "GRCh38",
+                "--outdir",
+                self.get_testdir(),
+                "--cache_mode",
+                "offline",
+            ],
+        )
+        self.assertEqual(result.exit_code, 2)
+        self.assertIn("--match_mode hgvs", result.output)
+
     def test_queryApiCgi(self):
         """test querynator query-api-cgi with dummy credentials"""
         outdir = self.get_testdir()
@@ -232,6 +288,196 @@ class testCliRun(CliTestCase):
         self.assertIsFile(f"{outdir}/combined_files/civic_cgi_vep.tsv", "combined file not created")
         self.assertIsFile(f"{outdir}/report/{outdir.split('/')[-1]}_overall_report.html", "report not created")
 
+    def test_createReport_SeveralCancers(self):
+        """test that create-report reports the CIViC results of the cancer type given with --civic_cancer"""
+        outdir = self.get_testdir()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # CIViC results of a query-api-civic run for two cancer types
+            civic_path = f"{tmp_dir}/civic_multi"
+            example_path = f"{os.getcwd()}/example_files/civic_test_out"
+            os.makedirs(f"{civic_path}/vcf_files")
+            shutil.copy(f"{example_path}/metadata.txt", civic_path)
+            shutil.copy(
+                f"{example_path}/vcf_files/civic_test_out.filtered_variants.vcf",
+                f"{civic_path}/vcf_files/civic_multi.filtered_variants.vcf",
+            )
+            for label in ["DOID_1909", "DOID_1324"]:
+                shutil.copy(
+                    f"{example_path}/civic_test_out.civic_results.tsv",
+                    f"{civic_path}/civic_multi.{label}.civic_results.tsv",
+                )
+            args = ["create-report", "--cgi_path", f"{os.getcwd()}/example_files/cgi_test_out"]
+            args += ["--civic_path", civic_path, "--outdir", outdir]
+
+            result = self.runner.invoke(querynator_cli, args)
+            self.assertEqual(result.exit_code, 1)
+            self.assertFalse(os.path.exists(outdir))
+
+            result = self.runner.invoke(querynator_cli, args + ["--civic_cancer", "DOID:1909"])
+            self.assertEqual(result.exit_code, 0, "non-zero exit code")
+            self.assertIsFile(f"{outdir}/combined_files/civic_cgi_vep.tsv", "combined file not created")
+
+
+class testVepFilter(CliTestCase):
+    """Test the streaming VEP filter"""
+
+    def write_test_vcf(self, path):
+        """Write the first records of the example vcf, the last one annotated as low impact synonymous variant"""
+        with open(f"{os.getcwd()}/example_files/example.vcf") as f:
+            lines = f.read().splitlines()
+        header = [line for line in lines if line.startswith("#")]
+        records = [line.split("\t") for line in lines if not line.startswith("#")][:3]
+        csq_fields = vcf.Reader(header).infos["CSQ"].desc.split(":")[1].strip().split("|")
+        synonymous = {"Allele": records[-1][4], "Consequence": "synonymous_variant", "IMPACT": "LOW"}
+        records[-1][7] = "CSQ=" + "|".join(synonymous.get(field, "") for field in csq_fields)
+        with open(path, "w") as f:
+            f.write("\n".join(header + ["\t".join(record) for record in records]) + "\n")
+
+    def test_filterVcfByVep(self):
+        """Test that every record is written to either the filtered or the removed vcf file as it is consumed"""
+        outdir = self.get_testdir()
+        os.makedirs(outdir)
+        self.write_test_vcf(f"{outdir}/input.vcf")
+        logger = logging.getLogger()
+        kept = filter_vcf_by_vep(
+            f"{outdir}/input.vcf",
+            logger,
+            f"{outdir}/filtered_variants.vcf",
+            f"{outdir}/removed_variants.vcf",
+            QuerynatorIds("GRCh37", logger),
+        )
+        self.assertIsInstance(kept, types.GeneratorType)
+        kept_ids = [int("".join(record.INFO["QID"])) for record in kept]
+
+        filtered = list(vcf.Reader(filename=f"{outdir}/filtered_variants.vcf"))
+        removed = list(vcf.Reader(filename=f"{outdir}/removed_variants.vcf"))
+        self.assertEqual(len(filtered), 2)
+        self.assertEqual([int(record.INFO["QID"][0]) for record in filtered], kept_ids)
+        self.assertEqual(len(removed), 1)
+        self.assertNotIn(int(removed[0].INFO["QID"][0]), kept_ids)
+
+
+class testSharedVepTable(unittest.TestCase):
+    """Test the VEP table shared between the CIViC and CGI combine steps"""
+
+    cgi_path = f"{os.getcwd()}/example_files/cgi_test_out"
+    civic_path = f"{os.getcwd()}/example_files/civic_test_out"
+
+    def test_sharedTable(self):
+        """Test that the example runs share one table, as they filtered the same variants"""
+        civic_vep_df, cgi_vep_df = read_shared_vep_table(self.cgi_path, self.civic_path, logging.getLogger())
+        self.assertIs(civic_vep_df, cgi_vep_df)
+        self.assertEqual(list(civic_vep_df.columns[:5]), ["querynator_id", "chr_VEP", "pos_VEP", "ref_VEP", "alt_VEP"])
+
+    def test_separateTables(self):
+        """Test that runs on different variants read the CGI table separately"""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cgi_path = f"{tmp_dir}/cgi_run"
+            os.makedirs(f"{cgi_path}/vcf_files")
+            # drop the last variant of the CIViC run
+            with open(f"{self.civic_path}/vcf_files/civic_test_out.filtered_variants.vcf") as f:
+                lines = f.read().rstrip("\n").split("\n")[:-1]
+            with open(f"{cgi_path}/vcf_files/cgi_run.filtered_variants.vcf", "w") as f:
+                f.write("\n".join(lines) + "\n")
+
+            with self.assertLogs(level="WARNING"):
+                civic_vep_df, cgi_vep_df = read_shared_vep_table(cgi_path, self.civic_path, logging.getLogger())
+        self.assertIsNone(cgi_vep_df)
+
+    def test_vcfDigest(self):
+        """Test that the vcf comparison ignores the querynator IDs, but not the variants"""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            digests = []
+            for n, record in enumerate(["QID=123;CSQ=G|x", "QID=4567;CSQ=G|x", "QID=123;CSQ=T|x"]):
+                with open(f"{tmp_dir}/{n}.vcf", "w") as f:
+                    f.write(f"##fileformat=VCFv4.2\n1\t100\t.\tC\tG\t.\t.\t{record}\n")
+                digests.append(vcf_digest(f"{tmp_dir}/{n}.vcf"))
+        self.assertEqual(digests[0], digests[1])
+        self.assertNotEqual(digests[0], digests[2])
+
+    def test_mergeCoords(self):
+        """Test the CGI notation of deletions, insertions and SNVs"""
+        vep_df = pd.DataFrame(
+            [[1, 100, "ACGT", "A", "A", "x"], [2, 200, "A", "ACGT", "ACGT", "y"], [3, 300, "C", "T", "T", "z"]],
+            columns=["chr_VEP", "pos_VEP", "ref_VEP", "alt_VEP", "first_alt_VEP", "SYMBOL_VEP"],
+        )
+        merged = add_merge_coords(vep_df)
+        self.assertEqual(
+            list(merged.columns[4:8]), ["chr_merge_VEP", "pos_merge_VEP", "ref_merge_VEP", "alt_merge_VEP"]
+        )
+        self.assertEqual(
+            merged.iloc[:, 4:8].values.tolist(), [[1, 101, "CGT", "-"], [2, 200, "-", "CGT"], [3, 300, "C", "T"]]
+        )
+        self.assertEqual(merged["SYMBOL_VEP"].tolist(), ["x", "y", "z"])
+        self.assertNotIn("first_alt_VEP", merged.columns)
+
+    def test_mergeCoordsMultiallelic(self):
+        """Test that multiallelic records are connected to CGI by their first ALT allele"""
+        with open(f"{self.civic_path}/vcf_files/civic_test_out.filtered_variants.vcf") as f:
+            lines = f.read().rstrip("\n").split("\n")
+        header = [line for line in lines if line.startswith("#")]
+        record = [line for line in lines if not line.startswith("#")][0].split("\t")
+        # C>G becomes C>G,AT, whose joined ALT is longer than REF
+        record[4] = f"{record[4]},AT"
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            vcf_path = f"{tmp_dir}/multiallelic.vcf"
+            with open(vcf_path, "w") as f:
+                f.write("\n".join(header + ["\t".join(record)]) + "\n")
+            vep_df = read_filtered_vcf(vcf_path)
+        self.assertEqual(vep_df["alt_VEP"].tolist(), ["GAT"])
+        merged = add_merge_coords(vep_df)
+        self.assertEqual(merged.loc[0, ["ref_merge_VEP", "alt_merge_VEP"]].tolist(), ["C", "G"])
+
+    def test_mergeCivicCgi(self):
+        """Test that the VEP columns are only carried once through the merge"""
+        alterations_vep = add_merge_coords(
+            pd.DataFrame(
+                [[1, 100, "C", "T", "T", "BRAF", "A"]],
+                columns=["chr_VEP", "pos_VEP", "ref_VEP", "alt_VEP", "first_alt_VEP", "SYMBOL_VEP", "evidence_CGI"],
+            )
+        )
+        civic_vep = pd.DataFrame(
+            [[7, 1, 100, "C", "T", "BRAF", "V600E"]],
+            columns=["querynator_id", "chr_VEP", "pos_VEP", "ref_VEP", "alt_VEP", "SYMBOL_VEP", "variant_name_CIVIC"],
+        )
+        merged = merge_civic_cgi(alterations_vep, civic_vep)
+        self.assertEqual(
+            list(merged.columns),
+            [
+                "chr_VEP",
+                "pos_VEP",
+                "ref_VEP",
+                "alt_VEP",
+                "SYMBOL_VEP",
+                "evidence_CGI",
+                "querynator_id",
+                "variant_name_CIVIC",
+            ],
+        )
+        self.assertEqual(merged["variant_name_CIVIC"].tolist(), ["V600E"])
+
+    def test_combinedVepAnnotation(self):
+        """Test that the combined table keeps the VEP annotation as written by the CGI combine step"""
+        logger = logging.getLogger()
+        with tempfile.TemporaryDirectory() as report_dir:
+            os.makedirs(f"{report_dir}/combined_files")
+            civic_vep_df, cgi_vep_df = read_shared_vep_table(self.cgi_path, self.civic_path, logger)
+            civic_results = get_civic_results_path(self.civic_path, logger)
+            combine_civic(self.civic_path, report_dir, logger, vep_df=civic_vep_df, civic_results=civic_results)
+            combine_cgi(self.cgi_path, report_dir, logger, vep_df=cgi_vep_df)
+            combine_cgi_civic(report_dir, logger)
+            add_tiers_and_scores_to_df(report_dir, logger)
+
+            alterations_vep, vep_civic_cgi_merge = [
+                pd.read_csv(f"{report_dir}/combined_files/{name}", sep="\t", dtype=str, keep_default_na=False)
+                for name in ["alterations_vep.tsv", "civic_cgi_vep.tsv"]
+            ]
+        vep_cols = [col for col in vep_civic_cgi_merge.columns if col.endswith("_VEP")]
+        self.assertEqual(len(vep_civic_cgi_merge), len(alterations_vep))
+        pd.testing.assert_frame_equal(vep_civic_cgi_merge[vep_cols], alterations_vep[vep_cols])
+        # integer annotation with empty fields, which must not be written back as floats
+        self.assertEqual(set(vep_civic_cgi_merge["GENE_PHENO_VEP"]), {"", "1"})
+
 
 class testEvidenceFilter(CliTestCase):
     """Test evidence filter function"""